@@ -0,0 +1,161 @@
+# Answers of the permission checks run before chat and apply_filter handlers,
+# cached per (chat, user) and (filter, user). Handlers that change membership
+# or a user's filters drop their entries right away, changefeeds on `chats`,
+# `users` and `filters` drop the entries of changes made by other workers,
+# and the TTL bounds staleness while a changefeed reconnects.
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from rethinkdb import r
+
+from api.cache import LRUCache, MISSING
+from api.db import connect, run_steps
+
+logger = logging.getLogger(__name__)
+
+ACCESS_CONFIG = {
+    'maxsize': int(os.environ.get('ACCESS_CACHE_SIZE', 100000)),
+    # seconds an answer is trusted without a changefeed confirming it
+    'ttl': float(os.environ.get('ACCESS_CACHE_TTL', 30)),
+    'changefeed': os.environ.get('ACCESS_CACHE_CHANGEFEED', '1') == '1',
+}
+
+
+def _changed_members(change):
+    # Users that joined or left a chat, computed by the server so a change
+    # to a chat with thousands of members stays small on the wire
+    old = change['old_val'].default(None)
+    new = change['new_val'].default(None)
+    old_ids = r.branch(old.eq(None), [], old['user_ids'].default([]))
+    new_ids = r.branch(new.eq(None), [], new['user_ids'].default([]))
+    return {
+        'id': r.branch(new.eq(None), old['id'], new['id']),
+        'deleted': new.eq(None),
+        'user_ids': old_ids.set_difference(new_ids).union(new_ids.set_difference(old_ids))
+    }
+
+
+def _changed_filters(change):
+    old = change['old_val'].default(None)
+    new = change['new_val'].default(None)
+    old_ids = r.branch(old.eq(None), [], old['added_filter_ids'].default([]))
+    new_ids = r.branch(new.eq(None), [], new['added_filter_ids'].default([]))
+    return {
+        'id': r.branch(new.eq(None), old['id'], new['id']),
+        'filter_ids': old_ids.set_difference(new_ids).union(new_ids.set_difference(old_ids))
+    }
+
+
+class AccessCache(object):
+    def __init__(self, maxsize=100000, ttl=30, changefeed=True):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.changefeed = changefeed
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def _ensure_feeds(self):
+        if not self.changefeed:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._watch, name=f'access-feed-{name}',
+                                 args=(name, query, handle), daemon=True)
+                for name, query, handle in (
+                    ('chats', lambda: r.table('chats').changes().map(_changed_members)
+                     .filter(lambda c: c['deleted'].or_(c['user_ids'].is_empty().not_())),
+                     self._on_chat_change),
+                    ('users', lambda: r.table('users').changes().map(_changed_filters)
+                     .filter(lambda c: c['filter_ids'].is_empty().not_()),
+                     self._on_user_change),
+                    ('filters', lambda: r.table('filters').changes()
+                     .map(lambda c: c['old_val']['id'].default(None)),
+                     self._on_filter_change),
+                )
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def _watch(self, name, query, handle):
+        delay = 0.5
+        while True:
+            try:
+                conn = connect()
+                try:
+                    feed = query().run(conn)
+                    # Changes made while the feed was down were missed
+                    self.cache.clear()
+                    delay = 0.5
+                    for change in feed:
+                        handle(change)
+                finally:
+                    conn.close(noreply_wait=False)
+            except r.ReqlError as e:
+                logger.warning('Access changefeed on %s failed, reconnecting in %.1fs: %s',
+                               name, delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _on_chat_change(self, change):
+        if change['deleted']:
+            self.cache.invalidate_where(lambda key: key[0] == 'chat' and key[1] == change['id'])
+            return
+        for user_id in change['user_ids']:
+            self.cache.invalidate(('chat', change['id'], user_id))
+
+    def _on_user_change(self, change):
+        for filter_id in change['filter_ids']:
+            self.cache.invalidate(('filter', filter_id, change['id']))
+
+    def _on_filter_change(self, filter_id):
+        # A filter was replaced or deleted, a new one can not have been cached
+        if filter_id is not None:
+            self.cache.invalidate_where(lambda key: key[0] == 'filter' and key[1] == filter_id)
+
+    def chat_membership_steps(self, chat_id: str, user_id: str):
+        # None when the chat does not exist
+        self._ensure_feeds()
+        key = ('chat', chat_id, user_id)
+        member = self.cache.get(key)
+        if member is MISSING:
+            member = yield r.table('chats').get(chat_id).do(
+                lambda chat: r.branch(chat.eq(None), None, chat['user_ids'].contains(user_id)))
+            self.cache.put(key, member)
+        return member
+
+    def chat_membership(self, chat_id: str, user_id: str) -> Optional[bool]:
+        return run_steps(self.chat_membership_steps(chat_id, user_id))
+
+    def filter_permission_steps(self, filter_id: str, user_id: str):
+        # None when the filter does not exist, otherwise whether the user added it
+        self._ensure_feeds()
+        key = ('filter', filter_id, user_id)
+        allowed = self.cache.get(key)
+        if allowed is MISSING:
+            allowed = yield r.branch(
+                r.table('filters').get(filter_id).eq(None),
+                None,
+                r.table('users').get(user_id)['added_filter_ids'].contains(filter_id).default(False))
+            self.cache.put(key, allowed)
+        return allowed
+
+    def filter_permission(self, filter_id: str, user_id: str) -> Optional[bool]:
+        return run_steps(self.filter_permission_steps(filter_id, user_id))
+
+    def forget_chat_member(self, chat_id: str, user_id: str):
+        self.cache.invalidate(('chat', chat_id, user_id))
+
+    def forget_user_filter(self, filter_id: str, user_id: str):
+        self.cache.invalidate(('filter', filter_id, user_id))
+
+    def metrics(self) -> dict:
+        return self.cache.metrics()
+
+
+ACCESS = AccessCache(**ACCESS_CONFIG)
@@ -0,0 +1,509 @@
+# An asyncio server for the v1.0 API, for workers holding many concurrent and
+# mostly idle connections: an event stream or a request waiting on a filter
+# is a coroutine instead of one of the gunicorn threads.
+#
+# Chat lists, chat history, apply_filter and the event stream are served on
+# the loop, over the driver's asyncio connections and with aiohttp calling
+# the filters. They run the same query steps as the Flask handlers, see
+# api.db.run_steps. Every other route, swagger included, is the Flask app
+# behind a WSGI bridge on a thread pool, so both modes serve the same routes
+# and the same schema.
+#
+#   python -m api.aio --port 5000
+#   gunicorn 'api.aio:create_app()' --bind 0.0.0.0:5000 --worker-class aiohttp.GunicornWebWorker
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from urllib.parse import unquote_to_bytes
+
+from aiohttp import web
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.config import config as jwt_config
+from flask_jwt_extended.exceptions import JWTExtendedException
+from flask_restplus import abort, inputs, marshal
+from jwt import ExpiredSignatureError, InvalidTokenError
+from rethinkdb import RethinkDB, r
+from werkzeug.exceptions import HTTPException
+
+from api import init_app
+from api.access import ACCESS
+from api.apis.v1_0.chats import (chat_list_query,
+                                 chat_model,
+                                 chat_short_model,
+                                 chat_steps,
+                                 messages_page_model)
+from api.apis.v1_0.events import sse
+from api.apis.v1_0.messsages import apply_filter_steps, message_exists_query
+from api.db import Call, rdb_config
+from api.deliveries import DELIVERIES_TABLE
+from api.filtering import EXECUTOR
+from api.idempotency import idempotency_key
+from api.history import (BadCursor,
+                         HISTORY_MAX_PAGE_SIZE,
+                         HISTORY_PAGE_SIZE,
+                         format_cursor,
+                         messages_page_steps,
+                         parse_cursor)
+from api.instrumentation import (STATS,
+                                 InstrumentedConnection,
+                                 start_async_request,
+                                 stats_headers)
+from api.realtime import OVERFLOW, REALTIME_CONFIG, delivered_steps, message_event, replay_steps
+
+logger = logging.getLogger(__name__)
+
+AIO_CONFIG = {
+    # asyncio connections per worker, queries are multiplexed on each of them
+    'rdb_connections': int(os.environ.get('AIO_RDB_CONNECTIONS', 4)),
+    # threads serving the routes that go through the WSGI bridge
+    'bridge_threads': int(os.environ.get('AIO_BRIDGE_THREADS', 16)),
+}
+
+BASE = '/api/v1.0'
+
+# The loop type is set per driver instance, `r` stays synchronous
+r_async = RethinkDB()
+r_async.set_loop_type('asyncio')
+
+
+async def connect_async():
+    return InstrumentedConnection(await r_async.connect(**rdb_config()))
+
+
+class AsyncConnections(object):
+    # Handed out round robin, a closed connection is replaced the next time
+    # its turn comes
+    def __init__(self, size=4):
+        self.size = size
+        self._conns = [None] * size
+        self._connecting = {}
+        self._next = 0
+
+    async def get(self):
+        index = self._next = (self._next + 1) % self.size
+        conn = self._conns[index]
+        if conn is not None and conn.is_open():
+            return conn
+        pending = self._connecting.get(index)
+        if pending is None:
+            pending = self._connecting[index] = asyncio.ensure_future(connect_async())
+            pending.add_done_callback(lambda _: self._connecting.pop(index, None))
+        conn = self._conns[index] = await asyncio.shield(pending)
+        return conn
+
+    async def close(self):
+        conns, self._conns = self._conns, [None] * self.size
+        for conn in conns:
+            if conn is not None and conn.is_open():
+                await conn.close(noreply_wait=False)
+
+
+CONNECTIONS = AsyncConnections(AIO_CONFIG['rdb_connections'])
+
+
+async def run_query(query):
+    result = await query.run(await CONNECTIONS.get())
+    if isinstance(result, r.Cursor):
+        result = [item async for item in result]
+    return result
+
+
+async def run_steps(steps):
+    # api.db.run_steps on the loop. A Call without an `async_fn` runs on the
+    # loop's default executor.
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        try:
+            if not isinstance(step, Call):
+                result = await run_query(step)
+            elif step.async_fn is not None:
+                result = await step.async_fn(*step.args)
+            else:
+                result = await asyncio.get_event_loop().run_in_executor(None, step.fn, *step.args)
+            error = None
+        except Exception as e:
+            result, error = None, e
+
+
+class AsyncMessageFeed(object):
+    # api.realtime.MessageFeed for the loop: one changefeed task per worker
+    # routes changes to the asyncio queues of its event streams
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._task = None
+
+    def subscribe(self, receiver_id: str) -> asyncio.Queue:
+        subscription = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(receiver_id, set()).add(subscription)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return subscription
+
+    def unsubscribe(self, receiver_id: str, subscription: asyncio.Queue):
+        subscriptions = self._subscribers.get(receiver_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscribers[receiver_id]
+
+    def subscribers_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    def _dispatch(self, change: dict):
+        delivery = change.get('new_val')
+        if delivery is None:
+            return
+        for subscription in list(self._subscribers.get(delivery['receiver_id'], ())):
+            try:
+                subscription.put_nowait(change)
+            except asyncio.QueueFull:
+                self.unsubscribe(delivery['receiver_id'], subscription)
+                subscription.get_nowait()
+                subscription.put_nowait(OVERFLOW)
+
+    async def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                conn = await connect_async()
+                try:
+                    feed = await r.table(DELIVERIES_TABLE).changes().run(conn)
+                    delay = 0.5
+                    async for change in feed:
+                        self._dispatch(change)
+                finally:
+                    await conn.close(noreply_wait=False)
+            except r.ReqlError as e:
+                logger.warning('Message changefeed failed, reconnecting in %.1fs: %s', delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+FEED = AsyncMessageFeed(queue_size=REALTIME_CONFIG['queue_size'])
+
+
+class JWTError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def identity(request: web.Request, flask_app, query_token: bool = False) -> str:
+    # What jwt_required and get_jwt_identity do, with the token from the
+    # header or, for EventSource, from ?jwt=
+    header = request.headers.get('Authorization', '')
+    token = header[len('Bearer '):] if header.startswith('Bearer ') else \
+        request.query.get('jwt') if query_token else None
+    if not token:
+        raise JWTError(401, 'Missing Authorization Header')
+    try:
+        with flask_app.app_context():
+            claims = decode_token(token)
+            identity_claim = jwt_config.identity_claim_key
+    except ExpiredSignatureError:
+        raise JWTError(401, 'Token has expired')
+    except (InvalidTokenError, JWTExtendedException) as e:
+        raise JWTError(422, str(e))
+    if claims.get('type') != 'access':
+        raise JWTError(422, 'Only access tokens are allowed')
+    return claims[identity_claim]
+
+
+def cors_headers(request: web.Request) -> dict:
+    # What flask_cors adds to the responses of the Flask app
+    if 'Origin' not in request.headers:
+        return {}
+    return {'Access-Control-Allow-Origin': '*'}
+
+
+def json_response(data, status=200) -> web.Response:
+    return web.json_response(data, status=status, dumps=lambda d: json.dumps(d, default=str))
+
+
+def native(endpoint: str, query_token: bool = False):
+    # Authenticates, counts the request under the Flask endpoint it stands in
+    # for and answers aborts like flask_restplus does
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request: web.Request):
+            stats = start_async_request()
+            try:
+                user_id = identity(request, request.app['flask'], query_token)
+                response = await handler(request, user_id)
+            except JWTError as e:
+                response = json_response({'msg': str(e)}, e.status)
+            except HTTPException as e:
+                response = json_response(getattr(e, 'data', None) or {'message': e.description}, e.code)
+            STATS.record_request(endpoint, stats)
+            if not response.prepared:
+                response.headers.update(stats_headers(stats))
+                response.headers.update(cors_headers(request))
+            return response
+        return wrapper
+    return decorator
+
+
+def page_args(request: web.Request) -> dict:
+    args = {
+        'before': request.query.get('before'),
+        'after': request.query.get('after'),
+        'limit': HISTORY_PAGE_SIZE,
+    }
+    if 'limit' in request.query:
+        try:
+            args['limit'] = inputs.int_range(1, HISTORY_MAX_PAGE_SIZE)(request.query['limit'])
+        except ValueError as e:
+            abort(400, 'Input payload validation failed', errors={'limit': str(e)})
+    return args
+
+
+async def check_chat(chat_id: str, user_id: str):
+    member = await run_steps(ACCESS.chat_membership_steps(chat_id, user_id))
+    if member is None:
+        abort(404, 'Chat Not Found')
+    if not member:
+        abort(403, 'You do not have permission to access this chat')
+
+
+@native('api.chats_chats')
+async def chats(request: web.Request, user_id: str):
+    return json_response(marshal(await run_query(chat_list_query(user_id)), chat_short_model))
+
+
+@native('api.chats_chat')
+async def chat(request: web.Request, user_id: str):
+    chat_id = request.match_info['chat_id']
+    await check_chat(chat_id, user_id)
+    chat = await run_steps(chat_steps(chat_id, user_id, page_args(request)))
+    return json_response(marshal(chat, chat_model))
+
+
+@native('api.chats_chat_messages_text')
+async def chat_messages(request: web.Request, user_id: str):
+    chat_id = request.match_info['chat_id']
+    await check_chat(chat_id, user_id)
+    try:
+        page = await run_steps(messages_page_steps(chat_id, user_id, **page_args(request)))
+    except BadCursor as e:
+        return abort(400, str(e))
+    return json_response(marshal(page, messages_page_model))
+
+
+@native('api.messages_message_apply_filter')
+async def apply_filter(request: web.Request, user_id: str):
+    message_id, filter_id = request.match_info['message_id'], request.match_info['filter_id']
+    if not await run_query(message_exists_query(message_id, user_id)):
+        return abort(404, 'Message Not Found')
+    allowed = await run_steps(ACCESS.filter_permission_steps(filter_id, user_id))
+    if allowed is None:
+        return abort(404, 'Filter Not Found')
+    if not allowed:
+        return abort(403, 'You can not apply this filter since you have not '
+                          'added this filter to your user\'s filters')
+    key = idempotency_key(request.headers)
+    return json_response(await run_steps(apply_filter_steps(message_id, filter_id, user_id, key)))
+
+
+@native('api.events_events', query_token=True)
+async def events(request: web.Request, user_id: str):
+    cursor = request.headers.get('Last-Event-ID') or request.query.get('after')
+    try:
+        after = parse_cursor(cursor) if cursor else None
+    except BadCursor as e:
+        return abort(400, str(e))
+
+    response = web.StreamResponse(headers=dict(cors_headers(request), **{
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    }))
+    # Subscribe before replaying, so nothing sent in between is lost
+    subscription = FEED.subscribe(user_id)
+    try:
+        await response.prepare(request)
+        replayed = set()
+        if after is not None:
+            messages = await run_steps(replay_steps(user_id, after, REALTIME_CONFIG['replay_limit']))
+            if messages is None:
+                await response.write(sse({'type': 'reset'}).encode())
+                return response
+            for message in messages:
+                replayed.add((message['id'], message['version']))
+                await response.write(sse(message_event(message, 'message'),
+                                         format_cursor(message['created_at'])).encode())
+        await response.write(sse({'type': 'ready'}).encode())
+
+        while True:
+            try:
+                change = await asyncio.wait_for(subscription.get(), REALTIME_CONFIG['heartbeat'])
+            except asyncio.TimeoutError:
+                await response.write(b': keep-alive\n\n')
+                continue
+            if change is OVERFLOW:
+                await response.write(sse({'type': 'reset'}).encode())
+                return response
+            delivery = change['new_val']
+            key = (delivery['id'], delivery['version'])
+            if key in replayed:
+                replayed.discard(key)
+                continue
+            message = await run_steps(delivered_steps(delivery))
+            if change.get('old_val') is None:
+                await response.write(sse(message_event(message, 'message'),
+                                         format_cursor(message['created_at'])).encode())
+            else:
+                await response.write(sse(message_event(message, 'update')).encode())
+    except ConnectionResetError:
+        return response
+    finally:
+        FEED.unsubscribe(user_id, subscription)
+
+
+class RequestBody(object):
+    # wsgi.input of a bridged request, reads the body from the loop as the
+    # Flask app asks for it, so uploads are not held in memory
+    def __init__(self, content, loop):
+        self._content = content
+        self._loop = loop
+
+    def _wait(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def read(self, size=-1):
+        return self._wait(self._content.read(-1 if size is None else size))
+
+    def readline(self, size=-1):
+        return self._wait(self._content.readline())
+
+
+class WSGIBridge(object):
+    # Serves a request with the Flask app on a thread, the response is
+    # written chunk by chunk as the app's iterable produces it
+    HOP_BY_HOP = {'connection', 'keep-alive', 'transfer-encoding'}
+
+    def __init__(self, wsgi_app, threads=16):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    def environ(self, request: web.Request, body: RequestBody) -> dict:
+        host, _, port = request.host.partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(request.raw_path.split('?', 1)[0]).decode('latin-1'),
+            'QUERY_STRING': request.query_string,
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': request.headers.get('Content-Length', ''),
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or ('443' if request.secure else '80'),
+            'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+            'REMOTE_ADDR': request.remote or '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                continue
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def __call__(self, request: web.Request) -> web.StreamResponse:
+        loop = asyncio.get_event_loop()
+        environ = self.environ(request, RequestBody(request.content, loop))
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+
+        def call():
+            iterable = self.wsgi_app(environ, start_response)
+            return iterable, iter(iterable)
+
+        iterable, chunks = await loop.run_in_executor(self.executor, call)
+        try:
+            # start_response may be called as late as with the first chunk
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            code, _, reason = started['status'].partition(' ')
+            response = web.StreamResponse(status=int(code), reason=reason or None)
+            for name, value in started['headers']:
+                if name.lower() not in self.HOP_BY_HOP:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            while chunk is not None:
+                if chunk:
+                    await response.write(chunk)
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await response.write_eof()
+            return response
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def add_route(app: web.Application, method: str, path: str, handler):
+    # Flask matches with and without the trailing slash
+    path = path.rstrip('/')
+    app.router.add_route(method, path, handler)
+    app.router.add_route(method, path + '/', handler)
+
+
+async def _close(app: web.Application):
+    await FEED.close()
+    await CONNECTIONS.close()
+    await EXECUTOR.close_async()
+    app['bridge'].close()
+
+
+def create_app() -> web.Application:
+    flask_app = init_app()
+    app = web.Application()
+    app['flask'] = flask_app
+    app['bridge'] = WSGIBridge(flask_app, AIO_CONFIG['bridge_threads'])
+    add_route(app, 'GET', f'{BASE}/chats/', chats)
+    add_route(app, 'GET', f'{BASE}/chats/{{chat_id}}', chat)
+    add_route(app, 'GET', f'{BASE}/chats/{{chat_id}}/messages', chat_messages)
+    add_route(app, 'POST', f'{BASE}/messages/{{message_id}}/apply_filter/{{filter_id}}', apply_filter)
+    add_route(app, 'GET', f'{BASE}/events/', events)
+    # Routes of other methods on the same paths fall through to the bridge
+    app.router.add_route('*', '/{path:.*}', app['bridge'])
+    app.on_cleanup.append(_close)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the API on asyncio')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,21 @@ import os
 def add_apis(app):
     app.config['BUNDLE_ERRORS'] = os.environ['BUNDLE_API_ERRORS']
     app.config['JWT_SECRET_KEY'] = os.environ['JWT_SECRET_KEY']
+    # Tokens in URLs end up in logs and browser history, only the event
+    # stream reads one from ?jwt=, see api.apis.v1_0.events
+    app.config['JWT_TOKEN_LOCATION'] = ['headers']
+
+    from api.db import release_request_connection
+    app.teardown_appcontext(release_request_connection)
+
+    from api.instrumentation import add_response_headers
+    app.after_request(add_response_headers)
+    from api.metrics import metrics_view
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
 
     from . import v1_0
     app.register_blueprint(v1_0.api_bp, url_prefix='/api/v1.0')
     v1_0.jwt.init_app(app)
+
+    from api.swagger import load_schema
+    load_schema(v1_0.api)
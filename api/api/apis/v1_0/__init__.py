@@ -1,6 +1,8 @@
 from flask import Blueprint
 from flask_jwt_extended import JWTManager
-from flask_restplus import Api, apidoc
+from flask_restplus import Api
+
+from api.db import PoolTimeout
 
 api_bp = Blueprint('api', __name__)
 authorizations = {
@@ -18,22 +20,18 @@ api = Api(api_bp,
           description='Simple API Documentation')
 jwt = JWTManager()
 jwt._set_error_handler_callbacks(api)
+
+
+@api.errorhandler(PoolTimeout)
+def handle_pool_timeout(error):
+    return {'message': 'Database is busy, try again later'}, 503
+
+
 from . import (
     auth,
     chats,
+    events,
     filters,
     messsages,
     users
 )
-
-# Use it to export documentation
-API_DOCS_DIR = 'swagger_docs'
-from flask import json
-
-
-@api.documentation
-def export_docs():
-    api_version = '.'.join(__name__.rsplit('.', 1)[-1].split('_'))
-    with open(f'{API_DOCS_DIR}/{api_version}.json', 'w+') as f:
-        f.write(json.dumps(api.__schema__))
-    return apidoc.ui_for(api)
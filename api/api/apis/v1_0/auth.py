@@ -9,8 +9,11 @@ from flask_restplus import (Resource,
 
 from . import api, authorizations
 from api.db import db_connection
+from api.idempotency import keep_existing
 from api.models import User
-import rethinkdb as r
+from api.search import user_created
+from api.summaries import refresh_members
+from rethinkdb import r
 
 ns = api.namespace('auth', description='Auth', authorizations=authorizations)
 
@@ -71,35 +74,58 @@ class Auth(Resource):
         password = args['password']
 
         with db_connection() as conn:
-            user_exists = r.table('users').filter({
-                'username': username,
-            }).count().eq(1).run(conn)
-            if not user_exists:
-                res = r.table('users').insert({
+            # One query: the user with this username, or a new one. The id
+            # is derived from the username, of two concurrent first logins
+            # one inserts and the other finds its row
+            found = r.table('users').get_all(
+                username, index='username'
+            ).coerce_to('array').do(
+                lambda users: r.branch(
+                    users.is_empty(),
+                    r.table('users').insert({
+                        'id': r.uuid(username),
+                        'username': username,
+                        'name': username,
+                        'password': password,
+                        'avatar': None,
+                        'added_filter_ids': list(),
+                        'filter_ids_by_type': dict(),
+                        'default_filter_ids': list()
+                    }, conflict=keep_existing, return_changes='always').do(
+                        lambda res: {
+                            'created': res['inserted'].eq(1),
+                            'user': res['changes'][0]['new_val']
+                        }
+                    ),
+                    {'created': False, 'user': users[0]}
+                )
+            ).do(
+                lambda found: {
+                    'created': found['created'],
+                    'password_ok': found['user']['password'].eq(password),
+                    'user': found['user']
+                }
+            ).run(conn)
+            if not found['password_ok']:
+                return abort(400, 'Bad password')
+            user = User(**found['user'])
+            if found['created']:
+                user_created({
+                    'id': user.id,
                     'username': username,
                     'name': username,
-                    'password': password,
-                    'avatar': None,
-                    'added_filter_ids': list(),
-                    'default_filter_ids': list()
-                }).run(conn)
-                r.table('chats').filter({
-                    'name': 'Shared Chat'
-                }).update(
+                    'avatar': None
+                })
+                joined = r.table('chats').get_all(
+                    'Shared Chat', index='name'
+                ).update(
                     lambda chat: {
-                        'user_ids': chat['user_ids'].append(res['generated_keys'][0])
-                    }
+                        'user_ids': chat['user_ids'].set_insert(user.id)
+                    },
+                    return_changes=True
                 ).run(conn)
-            elif r.table('users').filter({
-                'username': username,
-                'password': password
-            }).count().ne(1).run(conn):
-                return abort(400, 'Bad password')
-            user = r.table('users').filter({
-                'username': username,
-                'password': password
-            }).nth(0).run(conn)
-            user = User(**user)
+                for change in joined['changes']:
+                    refresh_members(conn, change['new_val']['id'])
 
         return {
             'access_token': {
@@ -1,6 +1,4 @@
-from api.db import db_connection
-from datetime import datetime
-import pytz
+from api.db import db_connection, run_steps
 from flask_restplus import (inputs,
                             Model,
                             Namespace,
@@ -11,14 +9,32 @@ from flask_restplus import (inputs,
 from flask import request
 from flask_jwt_extended import (jwt_required,
                                 get_jwt_identity)
-from typing import List
 from uuid import uuid4
-import requests
 from . import api
 from api import models
-import rethinkdb as r
+from api.access import ACCESS
+from api.blobs import BLOB_TYPES, BLOBS, BlobTooLarge
+from api.deliveries import DELIVERIES_TABLE, delivery_id
+from api.idempotency import (IDEMPOTENCY_DOC,
+                             IDEMPOTENCY_HEADER,
+                             idempotency_key,
+                             idempotent_id,
+                             keep_existing)
+from api.jobs import enqueue
+from api.history import (BadCursor,
+                         messages_page,
+                         messages_page_steps,
+                         HISTORY_MAX_PAGE_SIZE,
+                         HISTORY_PAGE_SIZE)
+from api.summaries import (SUMMARIES_TABLE,
+                           record_message,
+                           refresh_members)
+from rethinkdb import r
 from functools import wraps
 
+# Receivers' deliveries written per insert query
+FANOUT_BATCH_SIZE = 1000
+
 ns: Namespace = api.namespace('chats', description='Chats Ednpoint',
                               decorators=[jwt_required])
 
@@ -37,7 +53,19 @@ message_model = ns.model(
         'message_id': fields.String,
         'sender_id': fields.String,
         'created_at': fields.String,
-        'values': fields.List(fields.Nested(value_model))
+        'values': fields.List(fields.Nested(value_model)),
+        'filters_pending': fields.Boolean(
+            description='Default filters are still being applied to this message')
+    }
+)
+
+last_message_model: Model = ns.model(
+    name='Last Message',
+    model={
+        'sender_name': fields.String,
+        'created_at': fields.DateTime,
+        'content': fields.Raw,
+        'type': fields.String
     }
 )
 
@@ -46,12 +74,7 @@ chat_short_model: Model = ns.model(
     model={
         'id': fields.String,
         'name': fields.String,
-        'last_message': fields.Nested({
-            'sender_name': fields.String,
-            'created_at': fields.DateTime,
-            'content': fields.Raw,
-            'type': fields.String
-        }),
+        'last_message': fields.Nested(last_message_model),
         'participants_count': fields.Integer
     }
 )
@@ -64,6 +87,9 @@ chat_model: Model = ns.model(
         'name': fields.String(
             example='Example Chat Name'),
         'messages': fields.List(fields.Nested(message_model)),
+        'has_more': fields.Boolean(
+            description='There are older messages, load them with the \'before\' cursor'),
+        'before': fields.String(example='1543093561.816'),
         'user_ids': fields.List(fields.String(
             example='54cefb93-972a-4a67-be2e-25d5c8592ff6')),
         'default_filter_ids': fields.List(fields.String(
@@ -72,17 +98,63 @@ chat_model: Model = ns.model(
 )
 
 
+messages_page_model: Model = ns.model(
+    name='Messages Page',
+    model={
+        'messages': fields.List(fields.Nested(message_model)),
+        'has_more': fields.Boolean(
+            description='More messages exist in the paging direction'),
+        'before': fields.String(
+            description='Cursor to load older messages',
+            example='1543093561.816'),
+        'after': fields.String(
+            description='Cursor to load newer messages',
+            example='1543093561.816')
+    }
+)
+
+page_parser: reqparse.RequestParser = ns.parser()
+page_parser.add_argument('before',
+                         type=str,
+                         location='args',
+                         help='Only messages older than this cursor')
+page_parser.add_argument('after',
+                         type=str,
+                         location='args',
+                         help='Only messages newer than this cursor')
+page_parser.add_argument('limit',
+                         type=inputs.int_range(1, HISTORY_MAX_PAGE_SIZE),
+                         default=HISTORY_PAGE_SIZE,
+                         location='args')
+
+
+def receive_upload():
+    # A multipart form with a 'file' field or the raw content as the body,
+    # either way it is written to the blob store chunk by chunk
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            return abort(400, 'The form has no \'file\'')
+        stream, mime_type = upload.stream, upload.mimetype
+    else:
+        stream, mime_type = request.stream, request.mimetype
+    type = request.args.get('type') or mime_type.split('/')[0]
+    if type not in BLOB_TYPES:
+        return abort(400, f'Uploads are one of {", ".join(BLOB_TYPES)}, not {type}')
+    try:
+        return BLOBS.put_stream(stream, mime_type or 'application/octet-stream'), type
+    except BlobTooLarge as e:
+        return abort(413, str(e))
+
+
 @ns.response(403, 'This user has not permission to access this chat')
 def check_access(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         user_id = get_jwt_identity()
         chat_id = kwargs['chat_id']
-        with db_connection() as conn:
-            access_allowed = r.table('chats').get(
-                chat_id)['user_ids'].contains(user_id).run(conn)
-            if not access_allowed:
-                return abort(403, 'You do not have permission to access this chat')
+        if not ACCESS.chat_membership(chat_id, user_id):
+            return abort(403, 'You do not have permission to access this chat')
         return f(*args, **kwargs)
     return wrapper
 
@@ -91,16 +163,38 @@ def check_access(f):
 def check_if_chat_exists(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
+        user_id = get_jwt_identity()
         chat_id = kwargs['chat_id']
-        with db_connection() as conn:
-            chat_exists = r.table('chats').get_all(
-                chat_id).count().eq(1).run(conn)
-            if not chat_exists:
-                return abort(404, 'Chat Not Found')
+        # The answer is cached together with the membership check_access needs
+        if ACCESS.chat_membership(chat_id, user_id) is None:
+            return abort(404, 'Chat Not Found')
         return f(*args, **kwargs)
     return wrapper
 
 
+def chat_list_query(user_id: str):
+    return r.table(SUMMARIES_TABLE).get_all(
+        user_id, index='user_id'
+    ).map(
+        lambda summary: {
+            'id': summary['chat_id'],
+            'name': summary['name'],
+            'last_message': summary['last_message'],
+            'participants_count': summary['participants_count']
+        }
+    )
+
+
+def chat_steps(chat_id: str, user_id: str, args: dict):
+    # See api.db.run_steps, api.aio runs the same steps on asyncio
+    chat = yield r.table('chats').get(chat_id)
+    try:
+        chat.update((yield from messages_page_steps(chat_id, user_id, **args)))
+    except BadCursor as e:
+        return abort(400, str(e))
+    return chat
+
+
 @ns.route('/')
 class Chats(Resource):
 
@@ -108,45 +202,7 @@ class Chats(Resource):
     def get(self):
         user_id = get_jwt_identity()
         with db_connection() as conn:
-            chats = r.table('chats').filter(
-                lambda chat:
-                    chat['user_ids'].contains(user_id)
-            ).merge(
-                lambda chat: {
-                    'last_message': r.branch(r.table('messages').filter({
-                        'chat_id': chat['id'],
-                        'receiver_id': user_id,
-                    }).count().eq(0), None,
-                        r.table('messages').filter({
-                            'chat_id': chat['id'],
-                            'receiver_id': user_id,
-                        }).order_by(r.desc('created_at'))[0].merge(
-                        lambda message: {
-                            'content': r.table('values').get(message['value_ids'][-1])['content'],
-                            'sender_name': r.table('users').get(message['sender_id'])['name'],
-                            'type': r.table('values').get(message['value_ids'][-1])['type']
-                        }
-                    ).pluck(
-                        'created_at',
-                        'sender_name',
-                        'content',
-                        'type'
-                    )),
-                    'participants_count': chat['user_ids'].count()
-                }
-            ).pluck(
-                'id',
-                'name',
-                {
-                    'last_message': [
-                        'content',
-                        'sender_name',
-                        'type',
-                        'created_at'
-                    ]
-                },
-                'participants_count'
-            ).run(conn)
+            chats = chat_list_query(user_id).run(conn)
         listed_chats = list(chats)
         return listed_chats, 200
 
@@ -155,31 +211,14 @@ class Chats(Resource):
 class Chat(Resource):
     method_decorators = [check_if_chat_exists]
 
+    @ns.expect(page_parser)
     @ns.marshal_with(chat_model)
     @check_access
     def get(self, chat_id: str):
         user_id = get_jwt_identity()
+        args = page_parser.parse_args()
         with db_connection() as conn:
-            chat = r.table('chats').get(chat_id).merge(
-                lambda chat: {
-                    'messages': r.table('messages').filter({
-                        'chat_id': chat_id,
-                        'receiver_id': user_id,
-                    }).order_by(r.asc('created_at')).merge(
-                        lambda message: {
-                            'values': r.table('values').filter(
-                                lambda value: message['value_ids'].contains(
-                                    value['id'])
-                            ).coerce_to('array')
-                        }
-                    ).pluck(
-                        'message_id',
-                        'sender_id',
-                        'created_at',
-                        'values'
-                    ).coerce_to('array')
-                }
-            ).run(conn)
+            chat = run_steps(chat_steps(chat_id, user_id, args), conn)
         return chat, 200
 
     def post(self, chat_id):
@@ -190,6 +229,8 @@ class Chat(Resource):
                     'user_ids': chat['user_ids'].append(user_id)
                 }
             ).run(conn)
+            refresh_members(conn, chat_id)
+        ACCESS.forget_chat_member(chat_id, user_id)
         return
 
 
@@ -197,6 +238,18 @@ class Chat(Resource):
 class ChatMessagesText(Resource):
     method_decorators = [check_if_chat_exists, check_access]
 
+    @ns.expect(page_parser)
+    @ns.marshal_with(messages_page_model)
+    def get(self, chat_id: str):
+        user_id = get_jwt_identity()
+        args = page_parser.parse_args()
+        with db_connection() as conn:
+            try:
+                page = messages_page(conn, chat_id, user_id, **args)
+            except BadCursor as e:
+                return abort(400, str(e))
+        return page, 200
+
     post_parser: reqparse.RequestParser = ns.parser()
     post_parser.add_argument('type',
                              type=str,
@@ -223,107 +276,106 @@ class ChatMessagesText(Resource):
             )
         }
     ))
+    @ns.doc(params={'type': 'Type of an uploaded image or audio, by default the major type of its Content-Type',
+                    IDEMPOTENCY_HEADER: IDEMPOTENCY_DOC})
+    @ns.response(400, 'A JSON value refers to a stored file, files are uploaded')
+    @ns.response(503, 'The message could not be written to every member, a retry with the same key completes it')
     def post(self, chat_id: str):
         user_id = get_jwt_identity()
-        with db_connection() as conn:
-            # Group filters
-            chat_response = r.table('chats').get(chat_id).run(conn)
-            chat = models.Chat(**chat_response)
+        if request.mimetype == 'application/json':
             args = self.post_parser.parse_args()
             value = args['value']
             type = args['type']
-            filters: List[str] = r.table('filters').filter(
-                lambda f:
-                    r.table('chats').get(chat_id)[
-                        'default_filter_ids'].contains(f['id'])
-            ).pluck(
-                'external_url',
-                'input_type',
-                'output_type'
+            # References to stored files come from uploads and filters only,
+            # whatever the parser makes of the value
+            sent_value = request.get_json().get('value')
+            if isinstance(sent_value, dict) and 'blob' in sent_value:
+                return abort(400, 'Files are sent as the body or a multipart form, not as a JSON value')
+        else:
+            value, type = receive_upload()
+        key = idempotency_key(request.headers)
+        # A retry with the same key derives the same ids, the rows its first
+        # attempt wrote are kept and the same message id is answered
+        message_id = idempotent_id(key, user_id, chat_id) if key is not None else str(uuid4())
+        new_value = {
+            'content': value,
+            'type': type,
+            'created_at': r.now()
+        }
+        if key is not None:
+            new_value['id'] = idempotent_id(message_id, 'value')
+        with db_connection() as conn:
+            # The raw value is delivered right away, chat and receivers'
+            # default filters are applied later by `api.jobs` workers
+            sent = r.table('chats').get(chat_id).do(
+                lambda chat: {
+                    'chat': chat,
+                    'participants': r.table('users').get_all(
+                        r.args(chat['user_ids'])
+                    ).pluck('id', 'name', 'default_filter_ids').coerce_to('array'),
+                    'value': r.table('values').insert(new_value, conflict=keep_existing)
+                }
             ).run(conn)
-            current_value = value
-            current_type = type
-
-            for f in filters:
-                f = models.Filter(**f)
-                if not (current_type == f.input_type):
-                    break
-
-                if f.input_type == 'text':
-                    res = requests.post(
-                        f.external_url,
-                        json={
-                            'value': current_value
-                        })
-                    try:
-                        current_value = res.json()['value']
-                        current_type = f.output_type
-                    except:
-                        pass
-                # elif f.input_type == 'image':
-                #     res = requests.post(
-                #         f.external_url,
-                #         data=current_value
-                #     )
-                #     current_value = res.content
-                # elif f.input_type == 'audio':
-                #     res = requests.post(
-                #         f.external_url,
-                #         data=
-                #     )
-                
-
-            res = r.table('values').insert({
-                'content': current_value,
-                'type': current_type
-            }).run(conn)
-            if 'generated_keys' not in res or len(res['generated_keys']) != 1:
-                raise NotImplementedError
-            value_id = res['generated_keys'][0]
-            # send message b
-            for current_user_id in chat.user_ids:
-                current_user_response = r.table(
-                    'users').get(current_user_id).run(conn)
-                current_user = models.User(**current_user_response)
-                message_generated_res = r.table('messages').insert({
-                    'message_id': r.uuid(),
-                    'chat_id': chat_id,
-                    'sender_id': user_id,
-                    'receiver_id': current_user.id,
-                    'created_at': r.now(),
-                    'value_ids': [value_id],
-                    'filter_ids': list()
-                }).run(conn)
-                if 'generated_keys' not in message_generated_res or len(message_generated_res['generated_keys']) != 1:
-                    raise NotImplementedError
-                message_generated_id = message_generated_res['generated_keys'][0]
-
-                for f_id in current_user.default_filter_ids:
-                    current_filter_external_url = r.table(
-                        'filters').get(f_id).run(conn)
-                    current_filter_response = None  # do filter request
-                    r.table('messages').get(message_generated_id).update(
-                        lambda message: {
-                            'value_ids': message['value_ids'].append(current_filter_response),
-                            'filter_ids': message['filter_ids'].append(f_id)
-                        }
-                    ).run(conn)
-        return message_generated_id
-
-# UPLOAD_FOLDER = '/code/audios'
-# import os
-# @ns.route('/<string:chat_id>/messages')
-# class ChatMessages(Resource):
-#     def post(self, chat_id):
-#         user_id = get_jwt_identity()
-#         content_type = request.headers.get('Content-Type')
-#         with db_connection() as conn:
-#             chat_response = r.table('chats').get(chat_id).run(conn)
-#             chat = models.Chat(**chat_response)
-
-#             if content_type == 'application/json':
-#                 value = request.json()['value']
-#             elif content_type == 'multipart/form-data':
-#                 print('====================')
-#                 f = request.files['audio']
-#                 f.save(os.path.join(UPLOAD_FOLDER, f'{uuid4()}.wav'))
+            chat = models.Chat(**sent['chat'])
+            participants = sent['participants']
+            if 'id' in new_value:
+                value_id = new_value['id']
+            elif len(sent['value'].get('generated_keys', [])) == 1:
+                value_id = sent['value']['generated_keys'][0]
+            else:
+                return abort(503, f"The message could not be stored: {sent['value'].get('first_error')}")
+            filters_pending = bool(chat.default_filter_ids) or any(
+                p['default_filter_ids'] for p in participants)
+
+            # One message, and a delivery per receiver for their history and
+            # event streams. A retry derives the same delivery ids.
+            message = {
+                'id': message_id,
+                'chat_id': chat_id,
+                'sender_id': user_id,
+                'created_at': r.now(),
+                'value_ids': [value_id],
+                'filter_ids': list(),
+                'filters_pending': filters_pending
+            }
+            deliveries = [{
+                'id': delivery_id(message_id, participant['id']),
+                'message_id': message_id,
+                'chat_id': chat_id,
+                'receiver_id': participant['id'],
+                'created_at': r.now(),
+                'version': 0
+            } for participant in participants]
+            for start in range(0, len(deliveries), FANOUT_BATCH_SIZE):
+                batch = deliveries[start:start + FANOUT_BATCH_SIZE]
+                insert = r.table(DELIVERIES_TABLE).insert(batch, conflict=keep_existing)
+                deliver = insert
+                if start == 0:
+                    # The message is written first, its deliveries are
+                    # resolved through it as soon as they are
+                    deliver = r.table('messages').insert(message, conflict=keep_existing).do(
+                        lambda res: r.branch(res['errors'].eq(0), insert, r.error(res['first_error'])))
+                delivery_res = deliver.run(conn)
+                if delivery_res['inserted'] + delivery_res['unchanged'] != len(batch):
+                    # Deliveries written so far stay, a retry with the same
+                    # Idempotency-Key writes the others
+                    return abort(503, f"The message was not delivered to every member: "
+                                      f"{delivery_res.get('first_error')}")
+
+            # The raw value is recorded before the job can record the
+            # filtered one, which then is the newest
+            sender_name = next((p['name'] for p in participants if p['id'] == user_id), None)
+            last_messages = [{
+                'user_id': participant['id'],
+                'message_id': message_id,
+                'sender_name': sender_name,
+                'content': value,
+                'type': type
+            } for participant in participants]
+            for start in range(0, len(last_messages), FANOUT_BATCH_SIZE):
+                record_message(conn, chat_id, chat.name, len(chat.user_ids),
+                               last_messages[start:start + FANOUT_BATCH_SIZE])
+            # The job id is the message id, a retry's enqueue is a no-op
+            if filters_pending:
+                enqueue(conn, message_id, chat_id, value_id)
+        return message_id
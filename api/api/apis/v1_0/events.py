@@ -0,0 +1,129 @@
+import queue
+
+from flask import Response, json, request
+from flask_jwt_extended import (decode_token,
+                                get_jwt_identity,
+                                verify_jwt_in_request)
+from flask_jwt_extended.config import config as jwt_config
+from flask_jwt_extended.exceptions import JWTExtendedException
+from flask_restplus import (Namespace,
+                            Resource,
+                            abort)
+
+from jwt import ExpiredSignatureError, InvalidTokenError
+
+from . import api
+from api.db import pooled_connection
+from api.history import BadCursor, format_cursor, parse_cursor
+from api.realtime import (FEED,
+                          OVERFLOW,
+                          REALTIME_CONFIG,
+                          delivered,
+                          message_event,
+                          replay)
+
+ns: Namespace = api.namespace('events',
+                              description='Server-Sent Events with new messages')
+
+
+def stream_identity() -> str:
+    # EventSource can not send headers, the event stream alone also takes
+    # ?jwt=<token>. The header wins when both are there.
+    token = request.args.get('jwt')
+    if token is None or 'Authorization' in request.headers:
+        verify_jwt_in_request()
+        return get_jwt_identity()
+    try:
+        claims = decode_token(token)
+    except ExpiredSignatureError:
+        return abort(401, 'Token has expired')
+    except (InvalidTokenError, JWTExtendedException) as e:
+        return abort(422, str(e))
+    if claims.get('type') != 'access':
+        return abort(422, 'Only access tokens are allowed')
+    return claims[jwt_config.identity_claim_key]
+
+
+def sse(event: dict, event_id: str = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f"event: {event['type']}")
+    lines.append(f'data: {json.dumps(event, default=str)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+@ns.route('/')
+class Events(Resource):
+    get_parser = ns.parser()
+    get_parser.add_argument('after',
+                            type=str,
+                            location='args',
+                            help='Cursor of the last received message, '
+                                 'the \'Last-Event-ID\' header takes precedence')
+    get_parser.add_argument('jwt',
+                            type=str,
+                            location='args',
+                            help='Access token, for clients that can not send the '
+                                 '\'Authorization\' header')
+
+    @ns.expect(get_parser)
+    @ns.response(200, '\'text/event-stream\' with \'message\', \'update\', '
+                      '\'ready\' and \'reset\' events')
+    def get(self):
+        user_id = stream_identity()
+        args = self.get_parser.parse_args()
+        cursor = request.headers.get('Last-Event-ID') or args['after']
+        try:
+            after = parse_cursor(cursor) if cursor else None
+        except BadCursor as e:
+            return abort(400, str(e))
+
+        # Subscribe before replaying, so nothing sent in between is lost
+        subscription = FEED.subscribe(user_id)
+
+        def stream():
+            try:
+                replayed = set()
+                if after is not None:
+                    with pooled_connection() as conn:
+                        messages = replay(conn, user_id, after, REALTIME_CONFIG['replay_limit'])
+                    if messages is None:
+                        yield sse({'type': 'reset'})
+                        return
+                    for message in messages:
+                        replayed.add((message['id'], message['version']))
+                        yield sse(message_event(message, 'message'),
+                                  format_cursor(message['created_at']))
+                yield sse({'type': 'ready'})
+
+                while True:
+                    try:
+                        change = subscription.get(timeout=REALTIME_CONFIG['heartbeat'])
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                    if change is OVERFLOW:
+                        yield sse({'type': 'reset'})
+                        return
+                    delivery = change['new_val']
+                    key = (delivery['id'], delivery['version'])
+                    if key in replayed:
+                        replayed.discard(key)
+                        continue
+                    with pooled_connection() as conn:
+                        message = delivered(conn, delivery)
+                    if change.get('old_val') is None:
+                        yield sse(message_event(message, 'message'),
+                                  format_cursor(message['created_at']))
+                    else:
+                        yield sse(message_event(message, 'update'))
+            finally:
+                FEED.unsubscribe(user_id, subscription)
+
+        return Response(stream(),
+                        mimetype='text/event-stream',
+                        headers={
+                            'Cache-Control': 'no-cache',
+                            'X-Accel-Buffering': 'no'
+                        })
@@ -1,39 +1,49 @@
+from api import models
+from api.catalog import FILTER_CATALOG
 from api.db import db_connection
-from datetime import datetime
-import pytz
-from flask_restplus import (inputs,
-                            Model,
-                            Namespace,
-                            reqparse,
+from api.filter_health import FILTER_HEALTH
+from flask import request, Response
+from flask_restplus import (Namespace,
                             Resource,
-                            fields,
                             abort)
-from flask_jwt_extended import (jwt_required,
-                                get_jwt_identity)
-from typing import List
-import requests
 from . import api
-from api import models
-import rethinkdb as r
-from functools import wraps
+from rethinkdb import r
 
 ns: Namespace = api.namespace('filters',
                               description='Filters Endpoint',
                               decorators=[])
 
+type_parser = ns.parser()
+type_parser.add_argument('type',
+                         choices=('text', 'image', 'audio'),
+                         location='args',
+                         help='Only filters taking this type')
+
+
+def catalog_response(body: bytes, etag: str) -> Response:
+    # Bodies are serialized with the catalog snapshot, a client sending its
+    # ETag back gets a 304 before anything else is done
+    if request.method == 'GET' and request.if_none_match.contains(etag):
+        FILTER_CATALOG.count('not_modified')
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def filters_by_type(input_type: str = None):
+    snapshot = FILTER_CATALOG.current()
+    if snapshot is not None:
+        if input_type is None:
+            return catalog_response(snapshot.body, snapshot.etag)
+        return catalog_response(snapshot.bodies_by_input_type.get(input_type, b'[]\n'), snapshot.etag)
+    with db_connection() as conn:
+        if input_type is None:
+            return list(r.table('filters').run(conn))
+        return list(r.table('filters').get_all(input_type, index='input_type').run(conn))
 
-@ns.response(404, 'Filter with given \'filter_id\' not found')
-def check_if_filter_exists(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        filter_id = kwargs['filter_id']
-        with db_connection() as conn:
-            filter_exists = r.table('filters').get_all(
-                filter_id).count().eq(1).run(conn)
-            if not filter_exists:
-                return abort(404, 'Filter Not Found')
-        return f(*args, **kwargs)
-    return wrapper
 
 @ns.route('/')
 class Filters(Resource):
@@ -44,24 +54,75 @@ class Filters(Resource):
                              required=True,
                              nullable=False)
 
+    @ns.expect(type_parser)
+    @ns.response(304, 'The filters did not change since the ETag in If-None-Match')
     def get(self):
-        with db_connection() as conn:
-            filters = r.table('filters').run(conn)
-        return list(filters)
+        return filters_by_type(type_parser.parse_args()['type'])
 
     def post(self):
         args = self.post_parser.parse_args()
-        input_type = args['type']
-        with db_connection() as conn:
-            filters = r.table('filters').filter({
-                'input_type': input_type
-            }).run(conn)
-        return list(filters)
+        return filters_by_type(args['type'])
+
+
+def filters_health(filters: list) -> dict:
+    # A pipeline is available while all of its stages are
+    by_id = {f['id']: f for f in filters}
+    health = {}
+
+    def status(filter_id, path=()):
+        if filter_id not in health:
+            f = by_id.get(filter_id)
+            if f is None or filter_id in path:
+                return {'available': False, 'urls': []}
+            if f.get('is_pipeline'):
+                health[filter_id] = {
+                    'available': all(status(stage_id, path + (filter_id,))['available']
+                                     for stage_id in f.get('filter_ids', [])),
+                    'urls': []
+                }
+            else:
+                health[filter_id] = FILTER_HEALTH.status(models.Filter(**f))
+        return health[filter_id]
+
+    for filter_id in by_id:
+        status(filter_id)
+    return health
+
+
+@ns.route('/health')
+class FiltersHealth(Resource):
+
+    @ns.expect(type_parser)
+    @ns.response(200, 'By filter id, \'available\' and its URLs with \'state\' '
+                      '(\'closed\', \'open\' or \'half_open\'), \'latency_ms\', '
+                      '\'error_rate\' and \'calls\', as seen by the worker answering')
+    def get(self):
+        input_type = type_parser.parse_args()['type']
+        snapshot = FILTER_CATALOG.current()
+        if snapshot is not None:
+            filters = list(snapshot.by_id.values())
+        else:
+            with db_connection() as conn:
+                filters = list(r.table('filters').run(conn))
+        health = filters_health(filters)
+        return {f['id']: health[f['id']] for f in filters
+                if input_type is None or f.get('input_type', 'text') == input_type}
+
 
 @ns.route('/<string:filter_id>')
 class Filter(Resource):
-    method_decorators=[check_if_filter_exists]
+
+    @ns.response(304, 'The filters did not change since the ETag in If-None-Match')
+    @ns.response(404, 'Filter with given \'filter_id\' not found')
     def get(self, filter_id):
+        snapshot = FILTER_CATALOG.current()
+        if snapshot is not None:
+            body = snapshot.bodies_by_id.get(filter_id)
+            if body is None:
+                return abort(404, 'Filter Not Found')
+            return catalog_response(body, snapshot.etag)
         with db_connection() as conn:
             f = r.table('filters').get(filter_id).run(conn)
+        if f is None:
+            return abort(404, 'Filter Not Found')
         return f
@@ -1,11 +1,31 @@
+import os
+from flask import request, send_file
 from flask_jwt_extended import (jwt_required,
                                 get_jwt_identity)
 from flask_restplus import (Resource,
                             fields, abort)
 from . import api
-from api.db import db_connection
-import rethinkdb as r
-import requests
+from api import models
+from api.access import ACCESS
+from api.blobs import BLOBS, is_blob
+from api.catalog import applicable_filters
+from api.db import Call, db_connection, run_steps
+from api.deliveries import (DELIVERIES_TABLE,
+                            append_overlays,
+                            delivery_id,
+                            touch)
+from api.filter_cache import FILTER_CACHE
+from api.filtering import FilterError, FilterUnavailable
+from api.history import HISTORY_MAX_PAGE_SIZE, receiver_message
+from api.idempotency import (IDEMPOTENCY_DOC,
+                             IDEMPOTENCY_HEADER,
+                             idempotency_key,
+                             idempotent_id,
+                             keep_existing)
+from api.jobs import DONE, job_status
+from api.pipelines import apply, apply_async
+from api.summaries import filtered_values_query
+from rethinkdb import r
 from functools import wraps
 ns = api.namespace(
     'messages', description='Messages Endpoint', decorators=[jwt_required])
@@ -17,19 +37,19 @@ def check_if_filter_exists(f):
     def wrapper(*args, **kwargs):
         user_id = get_jwt_identity()
         filter_id = kwargs['filter_id']
-        with db_connection() as conn:
-            filter_exists = r.table('filters').get_all(
-                filter_id).count().eq(1).run(conn)
-            if not filter_exists:
-                return abort(404, 'Filter Not Found')
-            user_has_this_filter = r.table('users').get(
-                user_id)['added_filter_ids'].contains(filter_id).run(conn)
-            if not user_has_this_filter:
-                return abort(403, 'You can not apply this filter since you have not added this filter to your user\'s filters')
+        allowed = ACCESS.filter_permission(filter_id, user_id)
+        if allowed is None:
+            return abort(404, 'Filter Not Found')
+        if not allowed:
+            return abort(403, 'You can not apply this filter since you have not added this filter to your user\'s filters')
         return f(*args, **kwargs)
     return wrapper
 
 
+def message_exists_query(message_id: str, user_id: str):
+    return receiver_message(message_id, user_id).ne(None)
+
+
 @ns.response(404, 'Message with given \'message_id\' not found')
 def check_if_message_exists(f):
     @wraps(f)
@@ -37,10 +57,7 @@ def check_if_message_exists(f):
         user_id = get_jwt_identity()
         message_id = kwargs['message_id']
         with db_connection() as conn:
-            message_exists = r.table('messages').filter({
-                'message_id': message_id,
-                'receiver_id': user_id
-            }).count().eq(1).run(conn)
+            message_exists = message_exists_query(message_id, user_id).run(conn)
             if not message_exists:
                 return abort(404, 'Message Not Found')
         return f(*args, **kwargs)
@@ -54,74 +71,196 @@ class MessageApplicableFilters(Resource):
     def get(self, message_id):
         user_id = get_jwt_identity()
         with db_connection() as conn:
-            filters = r.table('filters').filter(
-                lambda f: r.table('users').get(user_id)['added_filter_ids'].contains(f['id']).and_(
-                    f['input_type'].eq(
-                        r.table('values').get(
-                            r.table('messages').filter({
-                                'message_id': message_id,
-                                'receiver_id': user_id,
-                            })[-1]['value_ids'][-1]
-                        )['type']
-                    )
-                )
+            return applicable_filters(conn, [message_id], user_id).get(message_id, [])
+
+
+def message_id_list(value):
+    # A string is not taken for a list of its characters
+    if not isinstance(value, list) or not all(isinstance(message_id, str) for message_id in value) or \
+            not 0 < len(value) <= HISTORY_MAX_PAGE_SIZE:
+        raise ValueError(f'message_ids are 1 to {HISTORY_MAX_PAGE_SIZE} strings')
+    return value
+
+
+@ns.route('/applicable_filters')
+class MessagesApplicableFilters(Resource):
+    post_parser = ns.parser()
+    post_parser.add_argument('message_ids',
+                             type=message_id_list,
+                             location='json',
+                             required=True,
+                             nullable=False)
+
+    @ns.expect(ns.model(
+        name='Message Ids',
+        model={
+            'message_ids': fields.List(fields.String, required=True,
+                                       description=f'Up to {HISTORY_MAX_PAGE_SIZE} messages, e.g. a page of a chat')
+        }
+    ))
+    @ns.response(200, 'Applicable filters by message id, messages not found are left out')
+    def post(self):
+        user_id = get_jwt_identity()
+        ids = self.post_parser.parse_args()['message_ids']
+        with db_connection() as conn:
+            return applicable_filters(conn, list(set(ids)), user_id)
+
+
+@ns.route('/<string:message_id>/values/<string:value_id>/content')
+class MessageValueContent(Resource):
+
+    @ns.response(206, 'Part of the content, for a Range request')
+    @ns.response(404, 'Message with given \'message_id\' or its value not found')
+    def get(self, message_id, value_id):
+        user_id = get_jwt_identity()
+        with db_connection() as conn:
+            # Archived messages included, their files are kept
+            value = receiver_message(message_id, user_id).do(
+                lambda message: r.branch(
+                    message.eq(None), None,
+                    message['value_ids'].contains(value_id), r.table('values').get(value_id),
+                    None)
             ).run(conn)
-        return list(filters)
+        if value is None:
+            return abort(404, 'Value Not Found')
+        if not is_blob(value['content']):
+            return abort(404, 'The value has no file content, it is in the message')
+        path = BLOBS.path(value['content']['blob'])
+        if not os.path.exists(path):
+            return abort(404, 'The file of this value is gone')
+        # conditional=True answers Range and If-None-Match requests, the file
+        # itself goes out through the server's file wrapper
+        response = send_file(path, mimetype=value['content']['mime_type'], conditional=True)
+        response.cache_control.private = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        return response
+
+
+@ns.route('/<string:message_id>/status')
+class MessageStatus(Resource):
+    method_decorators = [check_if_message_exists]
+
+    @ns.marshal_with(ns.model(
+        name='Message Status',
+        model={
+            'message_id': fields.String,
+            'status': fields.String(
+                description='Default filters job: \'pending\', \'running\', \'done\' or \'failed\''),
+            'attempts': fields.Integer,
+            'error': fields.String,
+            'stages': fields.List(fields.Raw(
+                description='{\'filter_id\', \'seconds\', \'error\'} per filter or pipeline stage run')),
+            'updated_at': fields.DateTime
+        }))
+    def get(self, message_id):
+        with db_connection() as conn:
+            status = job_status(conn, message_id)
+        if status is None:
+            # Messages without default filters never get a job
+            status = {'status': DONE, 'attempts': 0}
+        status['message_id'] = message_id
+        return status
+
+
+def _apply(f: models.Filter, content, type: str):
+    with db_connection() as conn:
+        return apply(conn, f, content, type, cache=False)
+
+
+async def _apply_async(f: models.Filter, content, type: str):
+    return await apply_async(f, content, type, cache=False)
+
+
+def apply_filter_steps(message_id: str, filter_id: str, user_id: str, key: str = None):
+    # See api.db.run_steps, api.aio runs the same steps on asyncio.
+    # A retry with the same idempotency key finds the value of the first
+    # attempt and neither runs the filter nor appends it again
+    value_id = idempotent_id(key, user_id, message_id, filter_id) if key is not None else None
+    id = delivery_id(message_id, user_id)
+    found = yield receiver_message(message_id, user_id).do(
+        lambda message: r.branch(message.eq(None), None, {
+            'chat_id': message['chat_id'],
+            'value': r.table('values').get(message['value_ids'][-1]),
+            'filter': r.table('filters').get(filter_id),
+            'applied': r.table('values').get(value_id) if value_id is not None else None
+        })
+    )
+    if found is None:
+        return abort(404, 'Message Not Found')
+    if found['filter'] is None:
+        # Deleted after the permission check was cached, before the
+        # changefeed dropped it
+        return abort(404, 'Filter Not Found')
+    value = found['value']
+    f = models.Filter(**found['filter'])
+    if value['type'] != f.input_type:
+        return abort(400, f'The filter takes {f.input_type}, not {value["type"]}')
+
+    v = found['applied']
+    # A cached result of a deterministic filter already has its own
+    # value row, reuse it instead of inserting a duplicate
+    cached = None if v is not None else (yield Call(FILTER_CACHE.get, f, value['content']))
+    if cached is not None and cached['value_id'] is not None:
+        v = yield r.table('values').get(cached['value_id'])
+        if v is None:
+            # Collected by api.compaction since, its blob may be gone too
+            cached = None
+    if v is None:
+        if cached is not None:
+            content = cached['content']
+        else:
+            try:
+                content = yield Call(_apply, f, value['content'], value['type'],
+                                     async_fn=_apply_async)
+            except FilterUnavailable as e:
+                return abort(503, str(e))
+            except FilterError as e:
+                return abort(502, str(e))
+        new_value = {
+            'type': f.output_type,
+            'content': content,
+            'created_at': r.now()
+        }
+        if value_id is not None:
+            new_value['id'] = value_id
+        # 'always' has the row in the changes even when a concurrent retry
+        # inserted it first, no second read is needed
+        res = yield r.table('values').insert(new_value, conflict=keep_existing,
+                                             return_changes='always')
+        if len(res['changes']) != 1 or res['changes'][0]['new_val'] is None:
+            return abort(503, f"The filter's value could not be stored: {res.get('first_error')}")
+        v = res['changes'][0]['new_val']
+        yield Call(FILTER_CACHE.put, f, value['content'], content, v['id'])
+    # The value is the receiver's own, it goes to their overlay of the
+    # message, an archived delivery has no version to touch
+    yield receiver_message(message_id, user_id).do(
+        lambda message: r.branch(
+            message.eq(None),
+            None,
+            message['value_ids'].contains(v['id']),
+            None,
+            append_overlays([{
+                'id': id,
+                'message_id': message_id,
+                'receiver_id': user_id,
+                'value_ids': [v['id']],
+                'filter_ids': [filter_id]
+            }]).do(lambda _: touch(r.table(DELIVERIES_TABLE).get(id))))
+    ).do(
+        lambda _: filtered_values_query(found['chat_id'], message_id, {user_id: v})
+    )
+    return {key: v[key] for key in ('id', 'type', 'content')}
 
 
 @ns.route('/<string:message_id>/apply_filter/<string:filter_id>')
 class MessageApplyFilter(Resource):
     method_decorators = [check_if_message_exists, check_if_filter_exists]
 
+    @ns.doc(params={IDEMPOTENCY_HEADER: IDEMPOTENCY_DOC})
+    @ns.response(502, 'The filter failed')
+    @ns.response(503, 'The filter\'s service is failing and calls to it are suspended, see GET /filters/health')
     def post(self, message_id, filter_id):
         user_id = get_jwt_identity()
+        key = idempotency_key(request.headers)
         with db_connection() as conn:
-            value = r.table('values').get(
-                r.table('messages').filter({
-                    'message_id': message_id,
-                    'receiver_id': user_id
-                })[0]['value_ids'][-1]
-            ).run(conn)
-            f = r.table('filters').get(filter_id).run(conn)
-            if value['type'] == 'text':
-                res = requests.post(
-                    f['external_url'],
-                    json={
-                        'value': value['content']
-                    }
-                )
-                try:
-                    content = res.json()['value']
-                except:
-                    raise NotImplementedError
-
-                new_value = {
-                    'type': f['output_type'],
-                    'content': content
-                }
-            else:
-                return abort(400, 'Bad value (use only text)')
-            # elif value['type'] == 'image':
-            #     res = requests.post(
-            #         f['external_url'],
-            #         data=value['content']
-            #     )
-            #     new_value = {
-            #         'type': f['output_type'],
-            #         'content': res.content
-            #     }
-            generated_value = r.table('values').insert(new_value).run(conn)
-            if 'generated_keys' not in generated_value or len(generated_value['generated_keys']) != 1:
-                raise NotImplementedError
-            value_generated_id = generated_value['generated_keys'][0]
-            r.table('messages').filter({
-                'message_id': message_id,
-                'receiver_id': user_id
-            }).update(
-                lambda message: {
-                    'value_ids': message['value_ids'].append(value_generated_id),
-                    'filter_ids': message['filter_ids'].append(filter_id)
-                }
-            ).run(conn)
-            v = r.table('values').get(value_generated_id).run(conn)
-        return v
+            return run_steps(apply_filter_steps(message_id, filter_id, user_id, key), conn)
@@ -1,10 +1,16 @@
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
-from flask_restplus import (Resource,
+from flask_restplus import (abort,
+                            inputs,
+                            Resource,
                             Namespace)
 from . import api
+from api.access import ACCESS
+from api.catalog import add_user_filter_query
 from api.db import db_connection
-import rethinkdb as r
+from api.search import SEARCH_CONFIG, search_users
+from api.summaries import refresh_members
+from rethinkdb import r
 
 ns: Namespace = api.namespace('users', description='Chats Ednpoint',
                               decorators=[jwt_required])
@@ -20,9 +26,8 @@ class UserFilters(Resource):
     def get(self, user_id):
         user_id = get_jwt_identity()
         with db_connection() as conn:
-            filters = r.table('filters').filter(
-                lambda f: r.table('users').get(user_id)[
-                    'added_filter_ids'].contains(f['id'])
+            filters = r.table('filters').get_all(
+                r.args(r.table('users').get(user_id)['added_filter_ids'])
             ).run(conn)
         return list(filters)
 
@@ -32,20 +37,19 @@ class UserFilters(Resource):
                              required=True,
                              nullable=False)
 
+    @ns.response(404, 'Filter with given \'filter_id\' not found')
     def post(self, user_id):
         args = self.post_parser.parse_args()
         filter_id = args['filter_id']
         user_id = get_jwt_identity()
         with db_connection() as conn:
-            user_already_has_filter = r.table('users').get(
-                user_id)['added_filter_ids'].contains(filter_id).run(conn)
-            if user_already_has_filter:
-                return
-            r.table('users').get(user_id).update(
-                lambda user: {
-                    'added_filter_ids': user['added_filter_ids'].append(filter_id)
-                }
-            ).run(conn)
+            # set_insert leaves the lists as they are when the filter is
+            # already added
+            res = add_user_filter_query(user_id, filter_id).run(conn)
+        if res is None:
+            return abort(404, 'Filter Not Found')
+        if res['replaced']:
+            ACCESS.forget_user_filter(filter_id, user_id)
         return
 
 
@@ -56,20 +60,16 @@ class Search(Resource):
                              required=True,
                              nullable=False,
                              location='json')
+    post_parser.add_argument('limit',
+                             type=inputs.int_range(1, SEARCH_CONFIG['max_limit']),
+                             default=SEARCH_CONFIG['limit'],
+                             location='json')
 
     def post(self):
+        # Users whose username or name starts with, or for three characters
+        # and more contains, the query; exact usernames first
         args = self.post_parser.parse_args()
-        query = args['query']
-        with db_connection() as conn:
-            users = r.table('users').filter(
-                lambda user: user['username'].match(query)
-            ).pluck(
-                'id',
-                'username',
-                'name',
-                'avatar'
-            ).run(conn)
-        return list(users)
+        return search_users(args['query'], args['limit'])
 
 
 @ns.route('/<string:with_user_id>/start_chat')
@@ -85,4 +85,7 @@ class UserStartChat(Resource):
                 'user_ids': [user_id, with_user_id]
             }).run(conn)
             chat_id = chat_response['generated_keys'][0]
+            refresh_members(conn, chat_id)
+        for member_id in (user_id, with_user_id):
+            ACCESS.forget_chat_member(chat_id, member_id)
         return chat_id
@@ -0,0 +1,138 @@
+# Content of image and audio values lives in files named after its sha256,
+# so the same upload is stored once. The value keeps a reference,
+# {'blob': '<sha256>', 'size': <bytes>, 'mime_type': '<type>'}.
+import hashlib
+import os
+import re
+import tempfile
+from typing import IO, Any, Iterable
+
+BLOB_CONFIG = {
+    'root': os.environ.get('BLOB_ROOT', '/data/blobs'),
+    # bytes read and written at a time, nothing bigger is held in memory
+    'chunk_size': int(os.environ.get('BLOB_CHUNK_SIZE', 64 * 1024)),
+    'max_size': int(os.environ.get('BLOB_MAX_SIZE', 50 * 1024 * 1024)),
+}
+
+BLOB_TYPES = ('image', 'audio')
+
+# Only a digest is ever joined to the root, never a path a client made up
+DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+def is_digest(digest: Any) -> bool:
+    return isinstance(digest, str) and DIGEST.fullmatch(digest) is not None
+
+
+def is_blob(content: Any) -> bool:
+    return isinstance(content, dict) and is_digest(content.get('blob'))
+
+
+class BlobStore(object):
+    def __init__(self, root='/data/blobs', chunk_size=64 * 1024, max_size=50 * 1024 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+    def path(self, digest: str) -> str:
+        if not is_digest(digest):
+            raise ValueError(f'{digest!r} is not a sha256 digest')
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def open(self, digest: str) -> IO[bytes]:
+        return open(self.path(digest), 'rb')
+
+    def read_chunks(self, stream: IO[bytes]) -> Iterable[bytes]:
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def put_chunks(self, chunks: Iterable[bytes], mime_type: str = 'application/octet-stream') -> dict:
+        # Written to a temporary file while hashing, then moved in place
+        # unless a blob with the same content is there already
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise BlobTooLarge(f'Content is larger than {self.max_size} bytes')
+                    sha256.update(chunk)
+                    f.write(chunk)
+            digest = sha256.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                # In use again, api.compaction leaves recently modified files alone
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return {
+            'blob': digest,
+            'size': size,
+            'mime_type': mime_type,
+        }
+
+    def put_stream(self, stream: IO[bytes], mime_type: str = 'application/octet-stream') -> dict:
+        return self.put_chunks(self.read_chunks(stream), mime_type)
+
+    def delete(self, digest: str, older_than: float = None) -> bool:
+        # With `older_than`, a time.time(), a file modified since is kept
+        if not is_digest(digest):
+            return False
+        path = self.path(digest)
+        try:
+            if older_than is not None and os.path.getmtime(path) >= older_than:
+                return False
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def digests(self, older_than: float) -> Iterable[str]:
+        # Blobs last written before `older_than`
+        if not os.path.isdir(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, prefix)
+            if prefix == 'tmp' or not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if is_digest(entry.name) and entry.is_file() and entry.stat().st_mtime < older_than:
+                    yield entry.name
+
+    def remove_temporary(self, older_than: float) -> int:
+        # Left behind by uploads interrupted before their cleanup
+        tmp_dir = os.path.join(self.root, 'tmp')
+        if not os.path.isdir(tmp_dir):
+            return 0
+        removed = 0
+        for entry in os.scandir(tmp_dir):
+            if entry.is_file() and entry.stat().st_mtime < older_than:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+BLOBS = BlobStore(**BLOB_CONFIG)
@@ -0,0 +1,232 @@
+# The filter catalog, a few dozen rows that rarely change, held in memory by
+# every worker and kept current by a changefeed. A snapshot is rebuilt on
+# every change with its responses already serialized and an ETag derived
+# from the content, so all workers agree on it and a client revalidating
+# gets a 304 without a query or any serialization.
+#
+# Users keep their added filters grouped by input type, in
+# `filter_ids_by_type`, so the filters applicable to a message are a lookup.
+#
+#   python -m api.catalog    builds `filter_ids_by_type` of users without it
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from rethinkdb import r
+
+from api.db import connect, db_connection
+from api.history import receiver_message
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CONFIG = {
+    'enabled': os.environ.get('FILTER_CATALOG', '1') == '1',
+    # seconds after a worker starts that requests wait for the first load,
+    # instead of reading the table
+    'load_wait': float(os.environ.get('FILTER_CATALOG_LOAD_WAIT', 1)),
+}
+
+
+def _dumps(data) -> bytes:
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode()
+
+
+class CatalogSnapshot(object):
+    def __init__(self, filters: List[dict]):
+        filters = sorted(filters, key=lambda f: f['id'])
+        self.by_id = {f['id']: f for f in filters}
+        self.by_input_type = {}
+        for f in filters:
+            self.by_input_type.setdefault(f.get('input_type', 'text'), []).append(f)
+        self.body = _dumps(filters)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.bodies_by_id = {filter_id: _dumps(f) for filter_id, f in self.by_id.items()}
+        self.bodies_by_input_type = {input_type: _dumps(fs)
+                                     for input_type, fs in self.by_input_type.items()}
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class FilterCatalog(object):
+    def __init__(self, enabled=True, load_wait=1):
+        self.enabled = enabled
+        self.load_wait = load_wait
+        self.snapshot = None
+        self._loaded = threading.Event()
+        # time.monotonic() until which requests wait for the first load
+        self._wait_until = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'changes': 0,
+            'not_modified': 0,
+        }
+
+    def count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def current(self) -> Optional[CatalogSnapshot]:
+        # None while it is not loaded or lost its changefeed, callers then
+        # read the table. Only the first requests of a worker wait for it, a
+        # reconnecting changefeed does not hold every request for load_wait.
+        if not self.enabled:
+            return None
+        self.ensure_loaded()
+        if self.snapshot is None:
+            remaining = self._wait_until - time.monotonic()
+            if remaining > 0:
+                self._loaded.wait(remaining)
+        return self.snapshot
+
+    def ensure_loaded(self):
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._wait_until = time.monotonic() + self.load_wait
+            self._pid = os.getpid()
+            self.snapshot = None
+            self._loaded.clear()
+            self._thread = threading.Thread(target=self._run, name='filter-catalog', daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        with db_connection() as conn:
+            self.snapshot = CatalogSnapshot(list(r.table('filters').run(conn)))
+        self._loaded.set()
+
+    def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                conn = connect()
+                try:
+                    # The feed is opened before loading, so no change made
+                    # during the load is missed
+                    feed = r.table('filters').changes().run(conn)
+                    started = time.monotonic()
+                    self._load()
+                    logger.info('Loaded %d filters in %.3fs', len(self.snapshot), time.monotonic() - started)
+                    delay = 0.5
+                    for _ in feed:
+                        # Reloading the whole catalog is cheaper than
+                        # patching the indexes and bodies
+                        self._load()
+                        self.count('changes')
+                finally:
+                    self.snapshot = None
+                    self._loaded.clear()
+                    conn.close(noreply_wait=False)
+            except r.ReqlError as e:
+                logger.warning('Filter catalog changefeed failed, reconnecting in %.1fs: %s', delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._counters)
+        snapshot = self.snapshot
+        metrics['ready'] = int(snapshot is not None)
+        metrics['size'] = len(snapshot) if snapshot is not None else 0
+        return metrics
+
+
+FILTER_CATALOG = FilterCatalog(**CATALOG_CONFIG)
+
+
+def add_user_filter_query(user_id: str, filter_id: str):
+    # None if the filter does not exist. Users without the grouped ids keep
+    # going without them until `python -m api.catalog` builds them
+    return r.table('filters').get(filter_id).do(
+        lambda f: r.branch(
+            f.eq(None), None,
+            r.table('users').get(user_id).update(
+                lambda user: r.branch(
+                    user.has_fields('filter_ids_by_type'),
+                    {
+                        'added_filter_ids': user['added_filter_ids'].set_insert(filter_id),
+                        'filter_ids_by_type': r.object(
+                            f['input_type'],
+                            user['filter_ids_by_type'][f['input_type']].default([]).set_insert(filter_id))
+                    },
+                    {
+                        'added_filter_ids': user['added_filter_ids'].set_insert(filter_id)
+                    }
+                )
+            )
+        )
+    )
+
+
+def applicable_filters(conn: r.Connection, message_ids: List[str], user_id: str) -> Dict[str, List[dict]]:
+    # {message_id: filters the user added that take the message's latest
+    # value}, for the messages of `message_ids` delivered to the user
+    found = r.expr({
+        'types': r.expr(
+            [receiver_message(message_id, user_id) for message_id in message_ids]
+        ).filter(lambda message: message.ne(None)).map(
+            lambda message: [message['message_id'],
+                             r.table('values').get(message['value_ids'][-1])['type']]
+        ).coerce_to('array'),
+        'filter_ids_by_type': r.table('users').get(user_id).do(
+            lambda user: user['filter_ids_by_type'].default(
+                r.table('filters').get_all(r.args(user['added_filter_ids'])).group(
+                    'input_type'
+                )['id'].ungroup().map(
+                    lambda group: [group['group'], group['reduction']]
+                ).coerce_to('object')
+            )
+        )
+    }).run(conn)
+    filter_ids = {filter_id for ids in found['filter_ids_by_type'].values() for filter_id in ids}
+    snapshot = FILTER_CATALOG.current()
+    if snapshot is not None:
+        filters = {filter_id: snapshot.by_id[filter_id]
+                   for filter_id in filter_ids if filter_id in snapshot.by_id}
+    else:
+        filters = {f['id']: f for f in r.table('filters').get_all(r.args(list(filter_ids))).run(conn)} \
+            if filter_ids else {}
+    # A filter whose input type changed since it was added is left out
+    return {
+        message_id: [filters[filter_id] for filter_id in found['filter_ids_by_type'].get(type, [])
+                     if filter_id in filters and filters[filter_id]['input_type'] == type]
+        for message_id, type in found['types']
+    }
+
+
+def rebuild_user_filter_index(conn: r.Connection, force: bool = False) -> int:
+    users = r.table('users') if force else r.table('users').filter(
+        lambda user: user.has_fields('filter_ids_by_type').not_())
+    return users.update(
+        lambda user: {
+            'filter_ids_by_type': r.literal(
+                r.table('filters').get_all(r.args(user['added_filter_ids'])).group(
+                    'input_type'
+                )['id'].ungroup().map(
+                    lambda group: [group['group'], group['reduction']]
+                ).coerce_to('object'))
+        },
+        non_atomic=True
+    ).run(conn)['replaced']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Group the added filters of users by input type')
+    parser.add_argument('--force', action='store_true', help='also users that have them grouped')
+    args = parser.parse_args()
+    with db_connection() as conn:
+        updated = rebuild_user_filter_index(conn, args.force)
+    print(f'{updated} users updated')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# Retention and garbage collection, run in the background like the filter
+# job workers:
+#   - deliveries older than MESSAGE_ARCHIVE_AFTER_DAYS move to the archive
+#     table, chat history still pages them from there (see api.history)
+#   - values no message or overlay references are deleted
+#     once they are VALUES_GC_GRACE seconds old, along with their cached
+#     filter results, and so are the blob files no value uses anymore.
+#     Those come from apply_filter retries, sends that failed halfway and
+#     failed filter jobs.
+#   - blob files no value was ever written for, from uploads of failed
+#     sends, once they are VALUES_GC_GRACE seconds old
+# Everything is done in batches with a pause in between, so the API keeps
+# most of the database to itself.
+#
+#   python -m api.compaction [--once] [--dry-run]
+import argparse
+import itertools
+import logging
+import os
+import threading
+import time
+
+from rethinkdb import r
+
+from api.blobs import BLOBS
+from api.db import pooled_connection
+from api.deliveries import DELIVERIES_TABLE, LEGACY_ARCHIVE_TABLE, OVERLAYS_TABLE
+from api.filter_cache import RESULTS_TABLE
+from api.history import ARCHIVE_AFTER_DAYS, ARCHIVE_TABLE
+
+logger = logging.getLogger(__name__)
+
+COMPACTION_CONFIG = {
+    'archive_after_days': ARCHIVE_AFTER_DAYS,
+    # A send or a filter job writes a value before the message referencing
+    # it, younger values are never collected. Blob files modified since,
+    # e.g. by an upload of the same content, are kept too.
+    'value_grace': float(os.environ.get('VALUES_GC_GRACE', 24 * 3600)),
+    'batch_size': int(os.environ.get('COMPACTION_BATCH_SIZE', 200)),
+    # seconds between two batches
+    'pause': float(os.environ.get('COMPACTION_PAUSE', 0.5)),
+    # seconds between two passes
+    'interval': float(os.environ.get('COMPACTION_INTERVAL', 3600)),
+}
+
+
+def _referenced(value_id):
+    # Messages are never archived, only their deliveries
+    return r.table('messages').get_all(value_id, index='value_ids').limit(1).count().gt(0).or_(
+        r.table(OVERLAYS_TABLE).get_all(value_id, index='value_ids').limit(1).count().gt(0))
+
+
+def _collectable(value, cutoff):
+    # Values written before the grace period was introduced have no created_at
+    return value['created_at'].default(r.minval).lt(cutoff).and_(
+        _referenced(value['id']).not_())
+
+
+def _blob(value):
+    return r.branch(value['content'].type_of().eq('OBJECT'),
+                    value['content']['blob'].default(None), None)
+
+
+class Compactor(object):
+    def __init__(self, archive_after_days=0, value_grace=24 * 3600, batch_size=200,
+                 pause=0.5, interval=3600):
+        self.archive_after_days = archive_after_days
+        self.value_grace = value_grace
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def archive_deliveries(self, dry_run: bool = False) -> dict:
+        stats = {'deliveries_archived': 0}
+        if not self.archive_after_days:
+            return stats
+        old = r.table(DELIVERIES_TABLE).between(
+            r.minval, r.now().sub(self.archive_after_days * 24 * 3600), index='created_at'
+        )
+        if dry_run:
+            with pooled_connection() as conn:
+                stats['deliveries_archived'] = old.count().run(conn)
+            return stats
+        while not self._stopped.is_set():
+            # Copied first and deleted only if all copies are written, a
+            # failure in between leaves a delivery in both tables, which
+            # history reads once
+            with pooled_connection() as conn:
+                moved = old.limit(self.batch_size).coerce_to('array').do(
+                    lambda deliveries: r.branch(
+                        deliveries.is_empty(), 0,
+                        r.table(ARCHIVE_TABLE).insert(deliveries, conflict='replace').do(
+                            lambda res: r.branch(
+                                res['errors'].eq(0),
+                                r.table(DELIVERIES_TABLE).get_all(
+                                    r.args(deliveries['id'])).delete()['deleted'],
+                                r.error(res['first_error'])))
+                    )
+                ).run(conn)
+            stats['deliveries_archived'] += moved
+            if moved < self.batch_size:
+                break
+            self._stopped.wait(self.pause)
+        return stats
+
+    def collect_values(self, dry_run: bool = False) -> dict:
+        stats = {'values_scanned': 0, 'values_deleted': 0, 'results_deleted': 0, 'blobs_deleted': 0}
+        cutoff = r.now().sub(self.value_grace)
+        older_than = time.time() - self.value_grace
+        last_id = r.minval
+        while not self._stopped.is_set():
+            # Walks the primary key, a batch is read and checked in one query
+            with pooled_connection() as conn:
+                batch = r.table('values').between(
+                    last_id, r.maxval, left_bound='open'
+                ).order_by(index='id').limit(self.batch_size).map(
+                    lambda value: {
+                        'id': value['id'],
+                        'blob': _blob(value),
+                        'collectable': _collectable(value, cutoff)
+                    }
+                ).coerce_to('array').run(conn)
+                if not batch:
+                    break
+                last_id = batch[-1]['id']
+                stats['values_scanned'] += len(batch)
+                ids = [value['id'] for value in batch if value['collectable']]
+                if ids and not dry_run:
+                    # Checked again, a message may have taken a value meanwhile
+                    deleted = r.table('values').get_all(r.args(ids)).filter(
+                        lambda value: _collectable(value, cutoff)
+                    ).delete(return_changes=True).run(conn)
+                    ids = [change['old_val']['id'] for change in deleted['changes']]
+                if ids:
+                    # Cached results would hand the deleted values out again
+                    results = r.table(RESULTS_TABLE).get_all(r.args(ids), index='value_id')
+                    stats['results_deleted'] += (results.count() if dry_run else
+                                                 results.delete()['deleted']).run(conn)
+                stats['values_deleted'] += len(ids)
+                digests = list({value['blob'] for value in batch
+                                if value['blob'] is not None and value['id'] in ids})
+                if digests:
+                    # A file is shared by every value with the same content
+                    unused = r.expr(digests).filter(
+                        lambda digest: r.table('values').get_all(
+                            digest, index='blob'
+                        )['id'].coerce_to('array').set_difference(ids).is_empty()
+                    ).run(conn)
+                    if not dry_run:
+                        unused = [digest for digest in unused if BLOBS.delete(digest, older_than)]
+                    stats['blobs_deleted'] += len(unused)
+            if len(batch) < self.batch_size:
+                break
+            self._stopped.wait(self.pause)
+        return stats
+
+    def sweep_blobs(self, dry_run: bool = False) -> dict:
+        # Files of uploads whose value was never written
+        stats = {'orphan_blobs_deleted': 0, 'temporary_files_deleted': 0}
+        older_than = time.time() - self.value_grace
+        digests = BLOBS.digests(older_than)
+        while not self._stopped.is_set():
+            batch = list(itertools.islice(digests, self.batch_size))
+            if not batch:
+                break
+            with pooled_connection() as conn:
+                unused = r.expr(batch).filter(
+                    lambda digest: r.table('values').get_all(digest, index='blob').is_empty()
+                ).run(conn)
+            if not dry_run:
+                unused = [digest for digest in unused if BLOBS.delete(digest, older_than)]
+            stats['orphan_blobs_deleted'] += len(unused)
+            if len(batch) < self.batch_size:
+                break
+            self._stopped.wait(self.pause)
+        if not dry_run:
+            stats['temporary_files_deleted'] = BLOBS.remove_temporary(older_than)
+        return stats
+
+    def run_once(self, dry_run: bool = False) -> dict:
+        started = time.perf_counter()
+        stats = self.archive_deliveries(dry_run)
+        with pooled_connection() as conn:
+            legacy = LEGACY_ARCHIVE_TABLE in r.table_list().run(conn)
+        if legacy:
+            # The values of archived messages not migrated yet look unused
+            logger.warning('Values are not collected until %s is migrated with '
+                           '`python -m api.deliveries`', LEGACY_ARCHIVE_TABLE)
+        else:
+            stats.update(self.collect_values(dry_run))
+            stats.update(self.sweep_blobs(dry_run))
+        stats['seconds'] = round(time.perf_counter() - started, 1)
+        return stats
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                logger.info('Compaction done: %s', self.run_once())
+            except r.ReqlError:
+                logger.exception('Compaction failed')
+            self._stopped.wait(self.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old deliveries and delete unused values')
+    parser.add_argument('--once', action='store_true', help='one pass instead of one every interval')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count what a pass would archive and delete')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    compactor = Compactor(**COMPACTION_CONFIG)
+    if args.once or args.dry_run:
+        stats = compactor.run_once(args.dry_run)
+        for name, value in stats.items():
+            print(f'{name}: {value}')
+        return
+    try:
+        compactor.run()
+    except KeyboardInterrupt:
+        compactor.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,246 @@
 import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
 
-import rethinkdb as r
+from rethinkdb import r
+from flask import g, has_app_context
 
-RDB_CONFIG = {
-    'host': os.environ['RDB_HOST'],
-    'port': int(os.environ['RDB_PORT']),
-    'db': os.environ['RDB_DB'],
+from api.instrumentation import InstrumentedConnection
+
+
+def rdb_config() -> dict:
+    # Read when connecting rather than on import, so the package imports
+    # without a database configured, e.g. to build the swagger schema
+    return {
+        'host': os.environ['RDB_HOST'],
+        'port': int(os.environ['RDB_PORT']),
+        'db': os.environ['RDB_DB'],
+    }
+
+
+POOL_CONFIG = {
+    'min_size': int(os.environ.get('RDB_POOL_MIN_SIZE', 1)),
+    'max_size': int(os.environ.get('RDB_POOL_MAX_SIZE', 10)),
+    # seconds an unused connection is kept above `min_size`
+    'idle_timeout': float(os.environ.get('RDB_POOL_IDLE_TIMEOUT', 300)),
+    # seconds to wait for a free connection before giving up
+    'checkout_timeout': float(os.environ.get('RDB_POOL_CHECKOUT_TIMEOUT', 5)),
+    # connections idle for longer than this are pinged before being handed out
+    'health_check_interval': float(os.environ.get('RDB_POOL_HEALTH_CHECK_INTERVAL', 30)),
 }
 
-def db_connection() -> r.Connection:
-    return r.connect(host=RDB_CONFIG['host'], port=RDB_CONFIG['port'], db=RDB_CONFIG['db'])
\ No newline at end of file
+
+def connect() -> r.Connection:
+    # Queries run on the connection are timed, see api.instrumentation
+    return InstrumentedConnection(r.connect(**rdb_config()))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, connect=connect, min_size=1, max_size=10, idle_timeout=300,
+                 checkout_timeout=5, health_check_interval=30):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # Connections must not be shared with a forked gunicorn worker
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._counters = {
+            'checkouts': 0,
+            'checkout_failures': 0,
+            'created': 0,
+            'closed': 0,
+            'evicted': 0,
+            'health_check_failures': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _evict_idle(self, now):
+        while len(self._idle) and self._size > self.min_size:
+            conn, last_used = self._idle[0]
+            if now - last_used < self.idle_timeout:
+                break
+            self._idle.popleft()
+            self._size -= 1
+            self._counters['evicted'] += 1
+            self._close(conn)
+
+    def _close(self, conn):
+        self._counters['closed'] += 1
+        try:
+            conn.close(noreply_wait=False)
+        except Exception:
+            pass
+
+    def _healthy(self, conn, last_used) -> bool:
+        if not conn.is_open():
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            r.expr(1).run(conn)
+            return True
+        except r.ReqlDriverError:
+            return False
+
+    def acquire(self) -> r.Connection:
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        with self._condition:
+            if self._pid != os.getpid():
+                self._reset()
+            while True:
+                self._evict_idle(time.monotonic())
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['checkout_failures'] += 1
+                    raise PoolTimeout(
+                        f'No database connection available after {self.checkout_timeout}s')
+                self._condition.wait(remaining)
+            self._in_use += 1
+
+        if conn is not None and not self._healthy(conn, last_used):
+            with self._condition:
+                self._counters['health_check_failures'] += 1
+                self._close(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._counters['checkout_failures'] += 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self._counters['created'] += 1
+
+        waited = time.monotonic() - started
+        with self._condition:
+            self._counters['checkouts'] += 1
+            self._counters['wait_time_total'] += waited
+            self._counters['wait_time_max'] = max(self._counters['wait_time_max'], waited)
+        return conn
+
+    def release(self, conn: r.Connection, discard: bool = False):
+        with self._condition:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if discard or not conn.is_open():
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def metrics(self) -> dict:
+        with self._condition:
+            metrics = dict(self._counters)
+            metrics.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        return metrics
+
+
+POOL = ConnectionPool(**POOL_CONFIG)
+
+
+def request_connection() -> r.Connection:
+    # One connection per request, shared by the decorators and the handler
+    if 'db_connection' not in g:
+        g.db_connection = POOL.acquire()
+    return g.db_connection
+
+
+def release_request_connection(exception=None):
+    conn = g.pop('db_connection', None)
+    if conn is not None:
+        POOL.release(conn, discard=isinstance(exception, r.ReqlDriverError))
+
+
+@contextmanager
+def pooled_connection():
+    # A connection of its own, for work that outlives or runs beside a request
+    conn = POOL.acquire()
+    discard = False
+    try:
+        yield conn
+    except r.ReqlDriverError:
+        discard = True
+        raise
+    finally:
+        POOL.release(conn, discard=discard)
+
+
+@contextmanager
+def db_connection():
+    if has_app_context():
+        yield request_connection()
+        return
+    with pooled_connection() as conn:
+        yield conn
+
+
+class Call(object):
+    # A step that is not a query, `fn(*args)` is called as it is. On asyncio
+    # api.aio awaits `async_fn(*args)` instead, or runs `fn` on a thread when
+    # there is none, so `fn` takes its own connection if it needs one.
+    def __init__(self, fn, *args, async_fn=None):
+        self.fn = fn
+        self.args = args
+        self.async_fn = async_fn
+
+    def run(self, conn: r.Connection):
+        return self.fn(*self.args)
+
+
+def run_steps(steps, conn: r.Connection = None):
+    # Runs a generator that yields queries (or Calls) and is sent back their
+    # results, cursors read into lists, and returns what it returns. The same
+    # generators are run on asyncio by api.aio. A failed step raises inside
+    # the generator, which may handle it. Without `conn` a connection is only
+    # taken once the first query is yielded.
+    with ExitStack() as stack:
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            if conn is None and not isinstance(step, Call):
+                conn = stack.enter_context(db_connection())
+            try:
+                result, error = step.run(conn), None
+                if isinstance(result, r.Cursor):
+                    result = list(result)
+            except Exception as e:
+                result, error = None, e
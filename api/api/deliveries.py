@@ -0,0 +1,218 @@
+# A message is stored once, in `messages`, with the values all of its
+# receivers see. Who received it and when is a small row per receiver in
+# `deliveries`, id '<message_id>:<receiver_id>', which history and the event
+# streams read through their indexes. Values only one receiver sees, from
+# their default filters or filters they applied, are in `message_overlays`
+# under the same id. receiver_view() puts the three back together into the
+# receiver's message.
+#
+#   python -m api.deliveries    migrates messages stored once per receiver
+import argparse
+import itertools
+import os
+
+from rethinkdb import r
+
+from api.db import db_connection
+
+DELIVERIES_TABLE = 'deliveries'
+OVERLAYS_TABLE = 'message_overlays'
+
+# Tables and indexes of messages stored once per receiver
+LEGACY_ARCHIVE_TABLE = 'messages_archive'
+LEGACY_INDEXES = ['receiver_id', 'receiver_created_at', 'chat_receiver_created_at',
+                  'message_receiver', 'created_at']
+
+MIGRATION_BATCH_SIZE = int(os.environ.get('DELIVERIES_MIGRATION_BATCH_SIZE', 1000))
+
+
+def delivery_id(message_id: str, receiver_id: str) -> str:
+    return f'{message_id}:{receiver_id}'
+
+
+def receiver_view(delivery):
+    # What the receiver sees: the shared values, then their own
+    return r.table('messages').get(delivery['message_id']).do(
+        lambda message: r.table(OVERLAYS_TABLE).get(delivery['id']).do(
+            lambda overlay: {
+                'id': delivery['id'],
+                'message_id': delivery['message_id'],
+                'chat_id': delivery['chat_id'],
+                'receiver_id': delivery['receiver_id'],
+                'sender_id': message['sender_id'],
+                'created_at': delivery['created_at'],
+                'version': delivery['version'].default(0),
+                'value_ids': message['value_ids'].add(
+                    r.branch(overlay.eq(None), [], overlay['value_ids'])),
+                'filter_ids': message['filter_ids'].add(
+                    r.branch(overlay.eq(None), [], overlay['filter_ids'])),
+                'filters_pending': message['filters_pending'].default(False)
+            }
+        )
+    )
+
+
+def message_deliveries(message_id: str):
+    return r.table(DELIVERIES_TABLE).get_all(message_id, index='message_id')
+
+
+def touch(deliveries):
+    # A new version of a delivery is what the event streams send as an
+    # update, after the message or the receiver's overlay changed
+    return deliveries.update(lambda delivery: {'version': delivery['version'].default(0).add(1)})
+
+
+def _append_overlay(id, old, new):
+    # Values already in the overlay are not appended again, with the filters
+    # they came from
+    added = r.range(new['value_ids'].count()).filter(
+        lambda i: old['value_ids'].contains(new['value_ids'][i]).not_()
+    ).coerce_to('array')
+    return old.merge({
+        'value_ids': old['value_ids'].add(added.map(lambda i: new['value_ids'][i])),
+        'filter_ids': old['filter_ids'].add(added.map(lambda i: new['filter_ids'][i]))
+    })
+
+
+def append_overlays(overlays: list):
+    # [{'id': delivery id, 'message_id', 'receiver_id', 'value_ids', 'filter_ids'}]
+    return r.table(OVERLAYS_TABLE).insert(overlays, conflict=_append_overlay)
+
+
+def _common_prefix(lists: list) -> list:
+    prefix = []
+    for items in zip(*lists):
+        if any(item != items[0] for item in items):
+            break
+        prefix.append(items[0])
+    return prefix
+
+
+def split_legacy_rows(rows: list) -> tuple:
+    # The per receiver rows of one message: the values all of them have
+    # from the start are the message's, the rest goes to overlays
+    first = rows[0]
+    shared = _common_prefix([row['value_ids'] for row in rows])
+    # The last shared value is the raw one or the chat filters' result,
+    # filter ids are one behind the value ids
+    shared_filters = _common_prefix([row.get('filter_ids', []) for row in rows])[:max(len(shared) - 1, 0)]
+    message = {
+        'id': first['message_id'],
+        'chat_id': first['chat_id'],
+        'sender_id': first['sender_id'],
+        'created_at': min(row['created_at'] for row in rows),
+        'value_ids': shared,
+        'filter_ids': shared_filters,
+        'filters_pending': any(row.get('filters_pending', False) for row in rows)
+    }
+    deliveries, overlays = [], []
+    for row in rows:
+        id = delivery_id(row['message_id'], row['receiver_id'])
+        deliveries.append({
+            'id': id,
+            'message_id': row['message_id'],
+            'chat_id': row['chat_id'],
+            'receiver_id': row['receiver_id'],
+            'created_at': row['created_at'],
+            'version': 0
+        })
+        own_value_ids = row['value_ids'][len(shared):]
+        if own_value_ids:
+            overlays.append({
+                'id': id,
+                'message_id': row['message_id'],
+                'receiver_id': row['receiver_id'],
+                'value_ids': own_value_ids,
+                'filter_ids': row.get('filter_ids', [])[len(shared_filters):]
+            })
+    return message, deliveries, overlays
+
+
+def _write(conn, source: str, target: str, messages: list, deliveries: list,
+           overlays: list, row_ids: list):
+    # The legacy rows are deleted only once the new ones are all written, a
+    # migration stopped halfway is run again
+    r.expr([
+        r.table('messages').insert(messages, conflict='replace'),
+        r.table(target).insert(deliveries, conflict='replace'),
+        r.table(OVERLAYS_TABLE).insert(overlays, conflict='replace'),
+    ]).do(
+        lambda results: r.branch(
+            results.sum('errors').eq(0),
+            r.table(source).get_all(r.args(row_ids)).delete(),
+            r.error(results.map(lambda res: res['first_error'].default('')).reduce(
+                lambda left, right: left.add(right))))
+    ).run(conn)
+
+
+def migrate_table(conn, source: str, target: str, batch_size: int = MIGRATION_BATCH_SIZE) -> dict:
+    stats = {'messages': 0, 'deliveries': 0, 'overlays': 0}
+    if source not in r.table_list().run(conn):
+        return stats
+    if 'message_receiver' not in r.table(source).index_list().run(conn):
+        r.table(source).index_create(
+            'message_receiver', lambda message: [message['message_id'], message['receiver_id']]
+        ).run(conn)
+        r.table(source).index_wait('message_receiver').run(conn)
+    # The rows of a message are next to each other in this index, messages
+    # written once have no receiver_id and are not in it
+    rows = r.table(source).order_by(index='message_receiver').run(conn, max_batch_rows=batch_size)
+    batch = ([], [], [], [])
+    for _, group in itertools.groupby(rows, key=lambda row: row['message_id']):
+        group = list(group)
+        message, deliveries, overlays = split_legacy_rows(group)
+        batch[0].append(message)
+        batch[1].extend(deliveries)
+        batch[2].extend(overlays)
+        batch[3].extend(row['id'] for row in group)
+        stats['messages'] += 1
+        stats['deliveries'] += len(deliveries)
+        stats['overlays'] += len(overlays)
+        if len(batch[3]) >= batch_size:
+            _write(conn, source, target, *batch)
+            batch = ([], [], [], [])
+    if batch[3]:
+        _write(conn, source, target, *batch)
+    return stats
+
+
+def drop_legacy(conn) -> list:
+    # Once nothing is left to migrate
+    dropped = []
+    indexes = r.table('messages').index_list().run(conn)
+    if 'message_receiver' in indexes and \
+            r.table('messages').between(r.minval, r.maxval, index='message_receiver').is_empty().run(conn):
+        for index in LEGACY_INDEXES:
+            if index in indexes:
+                r.table('messages').index_drop(index).run(conn)
+                dropped.append(f'messages.{index}')
+    if LEGACY_ARCHIVE_TABLE in r.table_list().run(conn) and \
+            r.table(LEGACY_ARCHIVE_TABLE).is_empty().run(conn):
+        r.table_drop(LEGACY_ARCHIVE_TABLE).run(conn)
+        dropped.append(LEGACY_ARCHIVE_TABLE)
+    return dropped
+
+
+def main():
+    from api.history import ARCHIVE_TABLE
+    from api.schema import ensure_schema
+
+    parser = argparse.ArgumentParser(description='Migrate messages stored once per receiver')
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE,
+                        help='legacy rows migrated per write')
+    parser.add_argument('--keep-legacy', action='store_true',
+                        help='keep the legacy indexes and the empty messages_archive table')
+    args = parser.parse_args()
+    with db_connection() as conn:
+        ensure_schema(conn)
+        for source, target in (('messages', DELIVERIES_TABLE), (LEGACY_ARCHIVE_TABLE, ARCHIVE_TABLE)):
+            stats = migrate_table(conn, source, target, args.batch_size)
+            print(f"{source}: {stats['messages']} messages, {stats['deliveries']} deliveries, "
+                  f"{stats['overlays']} overlays")
+        if not args.keep_legacy:
+            for dropped in drop_legacy(conn):
+                print(f'dropped {dropped}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+# Export and import of the database in the format of `rethinkdb dump`:
+# a .tar.gz of <dump>/<db>/<table>.json, a JSON array with one document per
+# line, and <table>.info with the primary key and secondary indexes.
+#
+#   python -m api.dump export [--output dump.tar.gz] [--tables users chats]
+#   python -m api.dump import rethinkdb_dump_*.tar.gz [--batch-size 1000] [--workers 8]
+#
+# Neither side holds a table in memory. Export streams cursors to files,
+# `--workers` tables at a time. Import parses the arrays incrementally on one
+# thread and `--workers` threads insert the batches, at most two batches per
+# worker are queued. Indexes are created once the documents are in, which is faster
+# than updating them on every insert.
+import argparse
+import codecs
+import json
+import os
+import queue
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rethinkdb import r
+
+from api.db import rdb_config
+from api.schema import ensure_schema
+
+DUMP_CONFIG = {
+    'batch_size': int(os.environ.get('DUMP_BATCH_SIZE', 1000)),
+    'workers': int(os.environ.get('DUMP_WORKERS', 8)),
+    # bytes read from a .json at a time
+    'read_size': 1 << 20,
+}
+
+INFO_INDEX_FIELDS = ('index', 'function', 'geo', 'multi', 'outdated')
+
+
+class DumpError(Exception):
+    pass
+
+
+def _connect():
+    return r.connect(**rdb_config())
+
+
+def _text(f):
+    # Files of a streamed tar are not seekable, which io.TextIOWrapper needs
+    return codecs.getreader('utf-8')(f)
+
+
+def iter_documents(f, read_size: int = DUMP_CONFIG['read_size']):
+    # The documents of a .json array one at a time, from a text file
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+    started = False
+    while True:
+        # Skip the separators between the documents
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise DumpError(f'Expected a JSON array, got {buffer[position]!r}')
+                started, position = True, position + 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                document, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Only a document cut by the end of the buffer can be
+                # completed by reading on
+                if eof:
+                    raise DumpError(f'Invalid JSON at {buffer[position:position + 80]!r}')
+            else:
+                # A document is followed by a separator or the end of the
+                # array. A number cut by the end of the buffer, e.g. 12 of
+                # 12.5, is taken only once the next chunk shows where it ends.
+                if eof or end < len(buffer) and buffer[end] in ' \t\r\n,]':
+                    position = end
+                    yield document
+                    continue
+        elif eof:
+            raise DumpError('The JSON array is not terminated')
+        chunk = f.read(read_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def _batches(documents, batch_size: int):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _dump_files(path: str):
+    # (table, 'json' or 'info', binary file) in the order they are stored,
+    # a .tar.gz is read as a stream and never extracted
+    if os.path.isdir(path):
+        for root, _, names in sorted(os.walk(path)):
+            for name in sorted(names):
+                table, _, kind = name.rpartition('.')
+                if kind in ('json', 'info'):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        yield table, kind, f
+        return
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            table, _, kind = os.path.basename(member.name).rpartition('.')
+            if member.isfile() and kind in ('json', 'info'):
+                yield table, kind, tar.extractfile(member)
+
+
+class Importer(object):
+    def __init__(self, db: str, batch_size: int, workers: int, force: bool):
+        self.db = db
+        self.batch_size = batch_size
+        self.force = force
+        self.infos = {}
+        self.counts = {}
+        self.created = set()
+        self.errors = []
+        self._lock = threading.Lock()
+        self._batches = queue.Queue(maxsize=workers * 2)
+        self.workers = workers
+
+    def _insert_batches(self, conn):
+        try:
+            while True:
+                item = self._batches.get()
+                if item is None:
+                    return
+                table, batch = item
+                try:
+                    if not self.errors:
+                        self._insert(conn, table, batch)
+                except Exception as e:
+                    self.errors.append(e)
+                finally:
+                    self._batches.task_done()
+        finally:
+            conn.close()
+
+    def _insert(self, conn, table: str, batch: list):
+        # Documents nest deeper than the driver's default of 20 levels
+        res = r.db(self.db).table(table).insert(
+            r.expr(batch, nesting_depth=100), conflict='replace' if self.force else 'error'
+        ).run(conn, durability='soft')
+        if res['errors']:
+            raise DumpError(f"{table}: {res['errors']} documents not inserted, {res['first_error']}")
+        with self._lock:
+            self.counts[table] = self.counts.get(table, 0) + len(batch)
+
+    def _create_table(self, conn, table: str):
+        if table in self.created:
+            return
+        primary_key = self.infos.get(table, {}).get('primary_key', 'id')
+        if table in r.db(self.db).table_list().run(conn):
+            if not self.force:
+                raise DumpError(f'Table {self.db}.{table} exists, import into it with --force')
+        else:
+            r.db(self.db).table_create(table, primary_key=primary_key).run(conn)
+        self.created.add(table)
+
+    def _read_info(self, conn, table: str, f):
+        info = json.load(_text(f))
+        # A stream may have the documents before the .info, the table was
+        # then created with the default primary key
+        if table in self.created and info.get('primary_key', 'id') != \
+                r.db(self.db).table(table).info()['primary_key'].run(conn):
+            raise DumpError(f'{table}: the primary key is {info["primary_key"]}, '
+                            f'but its documents came first and the table was created with another one')
+        self.infos[table] = info
+
+    def run(self, path: str, tables: list = None) -> dict:
+        conn = _connect()
+        workers = [threading.Thread(target=self._insert_batches, args=(_connect(),), daemon=True)
+                   for _ in range(self.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            if self.db not in r.db_list().run(conn):
+                r.db_create(self.db).run(conn)
+            for table, kind, f in _dump_files(path):
+                if tables and table not in tables:
+                    continue
+                if kind == 'info':
+                    self._read_info(conn, table, f)
+                    continue
+                self._create_table(conn, table)
+                self.counts.setdefault(table, 0)
+                documents = iter_documents(_text(f))
+                for batch in _batches(documents, self.batch_size):
+                    if self.errors:
+                        break
+                    self._batches.put((table, batch))
+            self._batches.join()
+            if self.errors:
+                raise self.errors[0]
+            indexes = self._create_indexes(conn)
+        finally:
+            for _ in workers:
+                self._batches.put(None)
+            conn.close()
+        return {'documents': dict(self.counts), 'indexes': indexes}
+
+    def _create_indexes(self, conn) -> list:
+        created = []
+        for table in sorted(self.created):
+            existing = r.db(self.db).table(table).index_list().run(conn)
+            for index in self.infos.get(table, {}).get('indexes', []):
+                if index['index'] in existing:
+                    continue
+                # The function is the server's own serialization, a binary
+                r.db(self.db).table(table).index_create(
+                    index['index'], index['function'],
+                    geo=index.get('geo', False), multi=index.get('multi', False)
+                ).run(conn)
+                created.append(f"{table}.{index['index']}")
+            r.db(self.db).table(table).index_wait().run(conn)
+        return created
+
+
+def _export_table(db: str, table: str, directory: str, batch_size: int) -> int:
+    conn = _connect()
+    try:
+        query = r.db(db).table(table)
+        info = query.info().run(conn)
+        info['indexes'] = [
+            {field: index[field] for field in INFO_INDEX_FIELDS if field in index}
+            for index in query.index_status().run(conn, binary_format='raw')
+        ]
+        with open(os.path.join(directory, f'{table}.info'), 'w') as f:
+            json.dump(info, f)
+        count = 0
+        # Times and binaries as their JSON pseudo types, the way they are imported
+        cursor = query.run(conn, time_format='raw', binary_format='raw',
+                           max_batch_rows=batch_size)
+        with open(os.path.join(directory, f'{table}.json'), 'w', encoding='utf-8') as f:
+            f.write('[')
+            for document in cursor:
+                f.write(',\n' if count else '\n')
+                f.write(json.dumps(document, ensure_ascii=False))
+                count += 1
+            f.write('\n]')
+        return count
+    finally:
+        conn.close()
+
+
+def export(output: str, db: str, tables: list = None, batch_size: int = DUMP_CONFIG['batch_size'],
+           workers: int = DUMP_CONFIG['workers']) -> dict:
+    with _connect() as conn:
+        tables = tables or r.db(db).table_list().run(conn)
+    name = os.path.basename(output)
+    for extension in ('.tar.gz', '.tgz'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, name, db)
+        os.makedirs(directory)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            counts = dict(zip(tables, executor.map(
+                lambda table: _export_table(db, table, directory, batch_size), tables)))
+        with tarfile.open(output, 'w:gz') as tar:
+            tar.add(os.path.join(tmp, name), arcname=name)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import the database as a rethinkdb dump')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    for command in ('export', 'import'):
+        subparser = commands.add_parser(command)
+        subparser.add_argument('--db', default=None, help='by default RDB_DB')
+        subparser.add_argument('--tables', nargs='+', default=None, help='by default all of them')
+        subparser.add_argument('--batch-size', type=int, default=DUMP_CONFIG['batch_size'])
+        subparser.add_argument('--workers', type=int, default=DUMP_CONFIG['workers'])
+    commands.choices['export'].add_argument(
+        '--output', default=time.strftime('rethinkdb_dump_%Y-%m-%dT%H:%M:%S.tar.gz'))
+    commands.choices['import'].add_argument('dump', help='a .tar.gz or an extracted dump directory')
+    commands.choices['import'].add_argument(
+        '--force', action='store_true', help='import into existing tables, replacing documents')
+    commands.choices['import'].add_argument(
+        '--no-schema', action='store_true', help='do not create the tables and indexes of api.schema')
+    args = parser.parse_args()
+    db = args.db or rdb_config()['db']
+
+    started = time.perf_counter()
+    if args.command == 'export':
+        counts = export(args.output, db, args.tables, args.batch_size, args.workers)
+        indexes = []
+    else:
+        imported = Importer(db, args.batch_size, args.workers, args.force).run(args.dump, args.tables)
+        counts, indexes = imported['documents'], imported['indexes']
+        if not args.no_schema:
+            with _connect() as conn:
+                indexes += ensure_schema(conn, db)['indexes']
+    for table, count in sorted(counts.items()):
+        print(f'{table}: {count} documents')
+    for index in indexes:
+        print(f'created index {index}')
+    print(f'{args.command}ed {sum(counts.values())} documents in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+
+from rethinkdb import r
+
+from api import models
+from api.cache import LRUCache, MISSING
+from api.db import db_connection
+
+FILTER_CACHE_CONFIG = {
+    'maxsize': int(os.environ.get('FILTER_CACHE_SIZE', 4096)),
+    # seconds an in-process entry lives
+    'ttl': float(os.environ.get('FILTER_CACHE_TTL', 3600)),
+    # also keep results in the `filter_results` table, shared by all workers
+    'persistent': os.environ.get('FILTER_CACHE_PERSISTENT', '0') == '1',
+    'persistent_ttl': float(os.environ.get('FILTER_CACHE_PERSISTENT_TTL', 7 * 24 * 3600)),
+}
+
+RESULTS_TABLE = 'filter_results'
+
+
+def content_hash(content: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, separators=(',', ':')).encode()
+    ).hexdigest()
+
+
+def cache_key(f: models.Filter, content: Any) -> str:
+    # The filter's url is part of the key, so repointing a filter drops its results
+    return hashlib.sha256(
+        f'{f.id}\n{f.external_url}\n{content_hash(content)}'.encode()
+    ).hexdigest()
+
+
+class FilterResultCache(object):
+    def __init__(self, maxsize=4096, ttl=3600, persistent=False, persistent_ttl=None):
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.persistent = persistent
+        self.persistent_ttl = persistent_ttl
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'persistent_hits': 0,
+            'persistent_misses': 0,
+            'persistent_errors': 0,
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _get_persistent(self, key: str) -> Optional[dict]:
+        try:
+            with db_connection() as conn:
+                row = r.table(RESULTS_TABLE).get(key).run(conn)
+        except r.ReqlError:
+            self._count('persistent_errors')
+            return None
+        if row is not None and self.persistent_ttl is not None:
+            expires_at = row['created_at'] + timedelta(seconds=self.persistent_ttl)
+            if expires_at <= datetime.now(timezone.utc):
+                row = None
+        self._count('persistent_hits' if row is not None else 'persistent_misses')
+        return row
+
+    def get(self, f: models.Filter, content: Any) -> Optional[dict]:
+        # Returns {'type', 'content', 'value_id'} of a previous run of `f` on `content`
+        if not f.cacheable:
+            return None
+        key = cache_key(f, content)
+        entry = self.memory.get(key)
+        if entry is MISSING and self.persistent:
+            row = self._get_persistent(key)
+            if row is not None:
+                entry = {
+                    'type': row['type'],
+                    'content': row['content'],
+                    'value_id': row.get('value_id'),
+                }
+                self.memory.put(key, entry)
+        if entry is MISSING:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return entry
+
+    def put(self, f: models.Filter, content: Any, result: Any, value_id: str = None):
+        if not f.cacheable:
+            return
+        key = cache_key(f, content)
+        entry = {
+            'type': f.output_type,
+            'content': result,
+            'value_id': value_id,
+        }
+        self.memory.put(key, entry)
+        if not self.persistent:
+            return
+        try:
+            with db_connection() as conn:
+                r.table(RESULTS_TABLE).insert(
+                    dict(entry, id=key, filter_id=f.id, created_at=r.now()),
+                    conflict='replace',
+                    durability='soft'
+                ).run(conn)
+        except r.ReqlError:
+            self._count('persistent_errors')
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._counters)
+        metrics['memory'] = self.memory.metrics()
+        return metrics
+
+
+FILTER_CACHE = FilterResultCache(**FILTER_CACHE_CONFIG)
@@ -0,0 +1,159 @@
+# Health of the external filter services, per URL and per worker process.
+# Every HTTP call to a filter is recorded with its latency and whether the
+# service failed it: a connection error, a timeout or a 5xx answer. A URL
+# that failed FILTER_BREAKER_ERROR_RATE of its calls in the last
+# FILTER_HEALTH_WINDOW seconds has its circuit opened, calls to it fail
+# right away for FILTER_BREAKER_OPEN_FOR seconds. Then a single call is let
+# through, which closes the circuit again if it succeeds.
+#
+# A filter with `replica_urls` is called on the URL with the lowest latency
+# among those with a closed circuit, a retry goes to another one if it can.
+import os
+import threading
+import time
+from collections import deque
+from typing import Iterable, List, Optional
+
+from api import models
+
+HEALTH_CONFIG = {
+    # seconds of calls the error rate is computed over
+    'window': float(os.environ.get('FILTER_HEALTH_WINDOW', 60)),
+    # calls in the window before the error rate can open a circuit
+    'min_calls': int(os.environ.get('FILTER_BREAKER_MIN_CALLS', 5)),
+    'error_rate': float(os.environ.get('FILTER_BREAKER_ERROR_RATE', 0.5)),
+    # seconds an open circuit fails calls before one is let through
+    'open_for': float(os.environ.get('FILTER_BREAKER_OPEN_FOR', 30)),
+    # weight of the latest call in a URL's average latency
+    'latency_weight': float(os.environ.get('FILTER_LATENCY_WEIGHT', 0.2)),
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def filter_urls(f: models.Filter) -> List[str]:
+    urls = [f.external_url] if f.external_url else []
+    return urls + [url for url in f.replica_urls if url not in urls]
+
+
+class Endpoint(object):
+    def __init__(self, url: str):
+        self.url = url
+        # (time.monotonic(), failed) of the calls in the window
+        self.calls = deque()
+        self.failures = 0
+        self.latency = None
+        self.state = CLOSED
+        self.opened_at = None
+        # A call is on its way to a half-open circuit
+        self.probing = False
+
+    def trim(self, now: float, window: float):
+        while self.calls and self.calls[0][0] < now - window:
+            _, failed = self.calls.popleft()
+            self.failures -= failed
+
+    def status(self) -> dict:
+        return {
+            'url': self.url,
+            'state': self.state,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'error_rate': round(self.failures / len(self.calls), 3) if self.calls else 0.0,
+            'calls': len(self.calls),
+        }
+
+
+class FilterHealth(object):
+    def __init__(self, window=60, min_calls=5, error_rate=0.5, open_for=30, latency_weight=0.2):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_for = open_for
+        self.latency_weight = latency_weight
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            'trips': 0,
+            'rejected': 0,
+        }
+
+    def _endpoint(self, url: str) -> Endpoint:
+        endpoint = self._endpoints.get(url)
+        if endpoint is None:
+            endpoint = self._endpoints[url] = Endpoint(url)
+        return endpoint
+
+    def _callable(self, endpoint: Endpoint, now: float) -> bool:
+        if endpoint.state == OPEN and now - endpoint.opened_at >= self.open_for:
+            endpoint.state = HALF_OPEN
+            endpoint.probing = False
+        return endpoint.state == CLOSED or (endpoint.state == HALF_OPEN and not endpoint.probing)
+
+    def choose(self, f: models.Filter, tried: Iterable[str] = ()) -> Optional[str]:
+        # The URL the next call of `f` goes to, None if every circuit is open
+        now = time.monotonic()
+        with self._lock:
+            endpoints = [endpoint for endpoint in map(self._endpoint, filter_urls(f))
+                         if self._callable(endpoint, now)]
+            if not endpoints:
+                self._counters['rejected'] += 1
+                return None
+            # URLs not tried by this run first, a half-open one gets its
+            # probe, then the fastest. A URL never called counts as fast.
+            endpoint = min(endpoints, key=lambda e: (e.url in tried, e.state != HALF_OPEN,
+                                                     e.latency or 0.0))
+            if endpoint.state == HALF_OPEN:
+                endpoint.probing = True
+            return endpoint.url
+
+    def record(self, url: str, seconds: float, failed: bool):
+        now = time.monotonic()
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint.latency = seconds if endpoint.latency is None else \
+                self.latency_weight * seconds + (1 - self.latency_weight) * endpoint.latency
+            endpoint.calls.append((now, failed))
+            endpoint.failures += failed
+            endpoint.trim(now, self.window)
+            if endpoint.state == HALF_OPEN:
+                if failed:
+                    self._open(endpoint, now)
+                else:
+                    # Failures from before the circuit opened no longer count
+                    endpoint.state = CLOSED
+                    endpoint.calls = deque([(now, False)])
+                    endpoint.failures = 0
+                endpoint.probing = False
+            elif endpoint.state == CLOSED and len(endpoint.calls) >= self.min_calls and \
+                    endpoint.failures >= self.error_rate * len(endpoint.calls):
+                self._open(endpoint, now)
+
+    def _open(self, endpoint: Endpoint, now: float):
+        endpoint.state = OPEN
+        endpoint.opened_at = now
+        self._counters['trips'] += 1
+
+    def status(self, f: models.Filter) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            urls = []
+            for endpoint in map(self._endpoint, filter_urls(f)):
+                endpoint.trim(now, self.window)
+                # An open circuit due for its probe is available again
+                self._callable(endpoint, now)
+                urls.append(endpoint.status())
+        return {
+            'available': any(url['state'] != OPEN for url in urls),
+            'urls': urls,
+        }
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics['open'] = sum(endpoint.state == OPEN for endpoint in self._endpoints.values())
+        return metrics
+
+
+FILTER_HEALTH = FilterHealth(**HEALTH_CONFIG)
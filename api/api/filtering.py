@@ -0,0 +1,395 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, List, Tuple
+from urllib.parse import urlsplit
+
+from api import models
+from api.blobs import BLOB_TYPES, BLOBS, BlobTooLarge, is_blob
+from api.filter_cache import FILTER_CACHE, FilterResultCache
+from api.filter_health import FILTER_HEALTH, FilterHealth
+from api.instrumentation import add_filter_time, record_filter_call
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+# requests, asyncio and aiohttp are imported where they are used, so a worker
+# starts without them and only pays for them with its first filter call
+
+FILTER_CONFIG = {
+    # seconds per HTTP attempt
+    'timeout': float(os.environ.get('FILTER_TIMEOUT', 10)),
+    'connect_timeout': float(os.environ.get('FILTER_CONNECT_TIMEOUT', 2)),
+    # seconds a single filter may spend on all of its attempts
+    'budget': float(os.environ.get('FILTER_BUDGET', 20)),
+    'retries': int(os.environ.get('FILTER_RETRIES', 2)),
+    # first retry waits `backoff` seconds, every next one twice as long
+    'backoff': float(os.environ.get('FILTER_BACKOFF', 0.2)),
+    # keep-alive connections per filter host
+    'pool_size': int(os.environ.get('FILTER_POOL_SIZE', 10)),
+    # filter calls running at the same time per worker
+    'workers': int(os.environ.get('FILTER_WORKERS', 16)),
+    # seconds a call of a batchable filter waits for others to join it
+    'batch_window': float(os.environ.get('FILTER_BATCH_WINDOW', 0.005)),
+    'max_batch_size': int(os.environ.get('FILTER_MAX_BATCH_SIZE', 32)),
+}
+
+
+class FilterError(Exception):
+    def __init__(self, f: models.Filter, message: str):
+        super().__init__(f'Filter {f.name or f.id or f.external_url} failed: {message}')
+        self.filter = f
+
+
+class RetryableFilterError(FilterError):
+    pass
+
+
+class FilterUnavailable(FilterError):
+    # Every URL of the filter has its circuit open, nothing was sent
+    pass
+
+
+class _Batch(object):
+    def __init__(self):
+        self.values = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class FilterExecutor(object):
+    def __init__(self, timeout=10, connect_timeout=2, budget=20, retries=2,
+                 backoff=0.2, pool_size=10, workers=16, batch_window=0.005,
+                 max_batch_size=32, cache: FilterResultCache = None,
+                 health: FilterHealth = None):
+        self.cache = cache
+        self.health = health if health is not None else FilterHealth()
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.budget = budget
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        # (filter id, url) -> the batch still taking values
+        self._batches = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._workers = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='filter')
+        # aiohttp session of the asyncio server, see run_async
+        self._async_session = None
+
+    def session(self, url: str) -> 'requests.Session':
+        # One keep-alive session per filter host, shared by all threads
+        import requests
+        from requests.adapters import HTTPAdapter
+        parts = urlsplit(url)
+        host = f'{parts.scheme}://{parts.netloc}'
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      max_retries=0)
+                session.mount(host, adapter)
+                self._sessions[host] = session
+        return session
+
+    def _url(self, f: models.Filter, tried: set) -> str:
+        url = self.health.choose(f, tried)
+        if url is None:
+            raise FilterUnavailable(f, 'its service is failing, calls are suspended')
+        tried.add(url)
+        return url
+
+    def _call(self, f: models.Filter, value: Any, timeout: float, tried: set, post=None) -> Any:
+        url = self._url(f, tried)
+        started = time.perf_counter()
+        error = failed = True
+        try:
+            result = (post or self._post)(f, url, value, timeout)
+            error = failed = False
+            return result
+        except RetryableFilterError:
+            raise
+        except FilterError:
+            # The service answered, only its answer was of no use
+            failed = False
+            raise
+        finally:
+            # Calls made by a request thread count towards its filter time,
+            # run_many accounts for the ones made by the worker threads
+            elapsed = time.perf_counter() - started
+            record_filter_call(f.id, elapsed, error)
+            add_filter_time(elapsed)
+            self.health.record(url, elapsed, failed)
+
+    def _post(self, f: models.Filter, url: str, value: Any, timeout: float) -> Any:
+        import requests
+        try:
+            if is_blob(value):
+                # The file is streamed, never read into memory as a whole
+                with BLOBS.open(value['blob']) as body:
+                    res = self.session(url).post(
+                        url,
+                        data=body,
+                        headers={'Content-Type': value['mime_type']},
+                        timeout=(min(self.connect_timeout, timeout), timeout),
+                        stream=True)
+            else:
+                res = self.session(url).post(
+                    url,
+                    json={
+                        'value': value
+                    },
+                    timeout=(min(self.connect_timeout, timeout), timeout),
+                    stream=True)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableFilterError(f, str(e))
+        except FileNotFoundError:
+            raise FilterError(f, f'content {value["blob"]} is missing')
+        with res:
+            if res.status_code >= 500:
+                raise RetryableFilterError(f, f'HTTP {res.status_code}')
+            if res.status_code >= 400:
+                raise FilterError(f, f'HTTP {res.status_code}')
+            mime_type = res.headers.get('Content-Type', '').split(';')[0].strip()
+            if f.output_type in BLOB_TYPES and mime_type != 'application/json':
+                # Binary output goes straight to the blob store
+                try:
+                    return BLOBS.put_chunks(res.iter_content(BLOBS.chunk_size), mime_type)
+                except BlobTooLarge as e:
+                    raise FilterError(f, str(e))
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    raise RetryableFilterError(f, str(e))
+            try:
+                return res.json()['value']
+            except (ValueError, KeyError, TypeError):
+                raise FilterError(f, 'response has no \'value\'')
+
+    def _batched(self, f: models.Filter, value: Any) -> bool:
+        return f.batchable and not is_blob(value) and f.output_type not in BLOB_TYPES
+
+    def _call_batched(self, f: models.Filter, value: Any, timeout: float, tried: set) -> Any:
+        # Calls of the filter arriving within `batch_window` of the first one
+        # go out as one request. The first caller waits for the others and
+        # sends it, every caller gets its own result or the batch's error.
+        key = (f.id, f.external_url)
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            index = len(batch.values)
+            batch.values.append(value)
+            if len(batch.values) >= (f.max_batch_size or self.max_batch_size):
+                del self._batches[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.batch_window)
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            try:
+                batch.results = self._call(f, batch.values, timeout, tried, self._post_batch)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def _post_batch(self, f: models.Filter, url: str, values: List[Any], timeout: float) -> List[Any]:
+        import requests
+        try:
+            res = self.session(url).post(
+                url,
+                json={
+                    'values': values
+                },
+                timeout=(min(self.connect_timeout, timeout), timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableFilterError(f, str(e))
+        with res:
+            if res.status_code >= 500:
+                raise RetryableFilterError(f, f'HTTP {res.status_code}')
+            if res.status_code >= 400:
+                raise FilterError(f, f'HTTP {res.status_code}')
+            try:
+                results = res.json()['values']
+            except (ValueError, KeyError, TypeError):
+                raise FilterError(f, 'response has no \'values\'')
+        if not isinstance(results, list) or len(results) != len(values):
+            raise FilterError(f, f'{len(values)} values sent, the response does not have as many')
+        return results
+
+    def run(self, f: models.Filter, value: Any, deadline: float = None,
+            cache: bool = True) -> Any:
+        if cache and self.cache is not None and f.cacheable:
+            cached = self.cache.get(f, value)
+            if cached is not None:
+                return cached['content']
+            result = self.run(f, value, deadline, cache=False)
+            self.cache.put(f, value, result)
+            return result
+
+        budget = f.budget if f.budget is not None else self.budget
+        retries = f.retries if f.retries is not None else self.retries
+        filter_deadline = time.monotonic() + budget
+        if deadline is not None:
+            filter_deadline = min(filter_deadline, deadline)
+
+        tried = set()
+        for attempt in range(retries + 1):
+            remaining = filter_deadline - time.monotonic()
+            if remaining <= 0:
+                raise FilterError(f, 'time budget exhausted')
+            timeout = min(f.timeout or self.timeout, remaining)
+            try:
+                if self._batched(f, value):
+                    return self._call_batched(f, value, timeout, tried)
+                return self._call(f, value, timeout, tried)
+            except RetryableFilterError as e:
+                if attempt == retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay >= filter_deadline:
+                    raise
+                logger.info('%s, retrying in %.2fs', e, delay)
+                time.sleep(delay)
+
+    def async_session(self):
+        # One session for all filter hosts, made on the event loop it serves
+        import aiohttp
+        if self._async_session is None or self._async_session.closed:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size))
+        return self._async_session
+
+    async def close_async(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    async def _post_async(self, f: models.Filter, value: Any, timeout: float, tried: set) -> Any:
+        import asyncio
+        import aiohttp
+        url = self._url(f, tried)
+        started = time.perf_counter()
+        error = failed = True
+        try:
+            async with self.async_session().post(
+                    url,
+                    json={
+                        'value': value
+                    },
+                    timeout=aiohttp.ClientTimeout(
+                        total=timeout, sock_connect=min(self.connect_timeout, timeout))) as res:
+                if res.status >= 500:
+                    raise RetryableFilterError(f, f'HTTP {res.status}')
+                failed = False
+                if res.status >= 400:
+                    raise FilterError(f, f'HTTP {res.status}')
+                try:
+                    result = (await res.json(content_type=None))['value']
+                except (ValueError, KeyError, TypeError):
+                    raise FilterError(f, 'response has no \'value\'')
+            error = False
+            return result
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failed = True
+            raise RetryableFilterError(f, str(e) or type(e).__name__)
+        finally:
+            elapsed = time.perf_counter() - started
+            record_filter_call(f.id, elapsed, error)
+            add_filter_time(elapsed)
+            self.health.record(url, elapsed, failed)
+
+    async def run_async(self, f: models.Filter, value: Any, deadline: float = None,
+                        cache: bool = True) -> Any:
+        # run() for the asyncio server. JSON values are posted with aiohttp,
+        # files, cached filters (the cache may read its table) and batchable
+        # ones, which join the batches of the threads, run on the filter threads.
+        import asyncio
+        if is_blob(value) or f.output_type in BLOB_TYPES or f.batchable or \
+                (cache and self.cache is not None and f.cacheable):
+            return await asyncio.wrap_future(self.submit(self.run, f, value, deadline, cache))
+
+        budget = f.budget if f.budget is not None else self.budget
+        retries = f.retries if f.retries is not None else self.retries
+        filter_deadline = time.monotonic() + budget
+        if deadline is not None:
+            filter_deadline = min(filter_deadline, deadline)
+
+        tried = set()
+        for attempt in range(retries + 1):
+            remaining = filter_deadline - time.monotonic()
+            if remaining <= 0:
+                raise FilterError(f, 'time budget exhausted')
+            timeout = min(f.timeout or self.timeout, remaining)
+            try:
+                return await self._post_async(f, value, timeout, tried)
+            except RetryableFilterError as e:
+                if attempt == retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay >= filter_deadline:
+                    raise
+                logger.info('%s, retrying in %.2fs', e, delay)
+                await asyncio.sleep(delay)
+
+    def run_chain(self, filters: List[models.Filter], value: Any, type: str,
+                  budget: float = None) -> Tuple[Any, str, List[str]]:
+        # Stages of a chain depend on each other, so they run in order and
+        # the chain stops at the first filter that can not take the value.
+        # A failed stage is skipped and the chain goes on with its input.
+        # Returns the output, its type and the ids of the applied filters.
+        deadline = time.monotonic() + budget if budget is not None else None
+        applied = []
+        for f in filters:
+            if type != f.input_type:
+                break
+            try:
+                value = self.run(f, value, deadline)
+                type = f.output_type
+                applied.append(f.id)
+            except FilterError as e:
+                logger.warning('%s', e)
+        return value, type, applied
+
+    def submit(self, fn, *args) -> Future:
+        # Runs `fn` on the filter worker threads
+        return self._workers.submit(fn, *args)
+
+    def run_many(self, filters: List[models.Filter], value: Any,
+                 budget: float = None) -> List[Any]:
+        # Independent filters over the same value run concurrently. The result
+        # list is in the order of `filters` and holds a FilterError for every
+        # filter that failed.
+        deadline = time.monotonic() + budget if budget is not None else None
+        started = time.perf_counter()
+        futures = [self.submit(self.run, f, value, deadline) for f in filters]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except FilterError as e:
+                results.append(e)
+        add_filter_time(time.perf_counter() - started)
+        return results
+
+
+EXECUTOR = FilterExecutor(cache=FILTER_CACHE, health=FILTER_HEALTH, **FILTER_CONFIG)
@@ -0,0 +1,120 @@
+import os
+from datetime import datetime
+from typing import List
+
+from rethinkdb import r
+
+from api.db import run_steps
+from api.deliveries import DELIVERIES_TABLE, delivery_id, receiver_view
+
+HISTORY_INDEX = 'chat_receiver_created_at'
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 50))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', 200))
+
+# Deliveries older than this many days are moved to the archive table by
+# `python -m api.compaction`, and paged from there while it is set
+ARCHIVE_TABLE = 'deliveries_archive'
+ARCHIVE_AFTER_DAYS = float(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', 0))
+
+
+class BadCursor(ValueError):
+    pass
+
+
+# Cursors are the `created_at` of a message as epoch seconds, e.g. '1543093561.816'
+def format_cursor(created_at: datetime) -> str:
+    return '%.3f' % created_at.timestamp()
+
+
+def parse_cursor(cursor: str) -> float:
+    try:
+        return float(cursor)
+    except (TypeError, ValueError):
+        raise BadCursor(f'Bad cursor {cursor!r}')
+
+
+def chat_messages(chat_id, receiver_id, after: float = None, before: float = None,
+                  table: str = DELIVERIES_TABLE):
+    # Deliveries of `chat_id` messages to `receiver_id`, both cursors are exclusive
+    lower = r.epoch_time(after) if after is not None else r.minval
+    upper = r.epoch_time(before) if before is not None else r.maxval
+    return r.table(table).between(
+        [chat_id, receiver_id, lower],
+        [chat_id, receiver_id, upper],
+        left_bound='open' if after is not None else 'closed',
+        index=HISTORY_INDEX)
+
+
+def resolve_values_steps(messages: List[dict]):
+    # One get_all for the values of a whole page
+    value_ids = list({value_id for message in messages for value_id in message['value_ids']})
+    values = {}
+    if value_ids:
+        values = {value['id']: value for value in
+                  (yield r.table('values').get_all(r.args(value_ids)).pluck('id', 'type', 'content'))}
+    for message in messages:
+        message['values'] = [values[value_id] for value_id in message['value_ids']
+                             if value_id in values]
+    return messages
+
+
+def resolve_values(conn: r.Connection, messages: List[dict]) -> List[dict]:
+    return run_steps(resolve_values_steps(messages), conn)
+
+
+def messages_page_steps(chat_id: str, receiver_id: str, before: str = None,
+                        after: str = None, limit: int = HISTORY_PAGE_SIZE):
+    # Without cursors returns the newest page. `before` pages towards older
+    # messages, `after` towards newer ones. Messages are always oldest first.
+    limit = max(1, min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE))
+    before_cursor, after_cursor = before, after
+    before = parse_cursor(before) if before is not None else None
+    after = parse_cursor(after) if after is not None else None
+    order = r.asc if after is not None and before is None else r.desc
+    tables = [DELIVERIES_TABLE, ARCHIVE_TABLE] if ARCHIVE_AFTER_DAYS else [DELIVERIES_TABLE]
+    # Each table's page is an indexed read, with the archive the two are
+    # merged and a delivery moved while the page was read is seen once.
+    # Only the page's deliveries are resolved to their messages.
+    pages = [chat_messages(chat_id, receiver_id, after=after, before=before, table=table).order_by(
+        index=order(HISTORY_INDEX)
+    ).limit(limit + 1) for table in tables]
+    page = r.union(*pages).order_by(order('created_at')).limit(limit + 1) if len(pages) > 1 else pages[0]
+    messages = yield page.map(receiver_view).pluck(
+        'message_id',
+        'sender_id',
+        'created_at',
+        'value_ids',
+        'filter_ids',
+        'filters_pending'
+    )
+    if len(pages) > 1:
+        messages = list({message['message_id']: message for message in messages}.values())
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not (after is not None and before is None):
+        messages.reverse()
+    yield from resolve_values_steps(messages)
+    return {
+        'messages': messages,
+        'has_more': has_more,
+        'before': format_cursor(messages[0]['created_at']) if messages else before_cursor,
+        'after': format_cursor(messages[-1]['created_at']) if messages else after_cursor,
+    }
+
+
+def messages_page(conn: r.Connection, chat_id: str, receiver_id: str,
+                  before: str = None, after: str = None,
+                  limit: int = HISTORY_PAGE_SIZE) -> dict:
+    return run_steps(messages_page_steps(chat_id, receiver_id, before, after, limit), conn)
+
+
+def receiver_message(message_id: str, receiver_id: str):
+    # The message as the receiver sees it, also when its delivery is
+    # archived. None if it was not delivered to them.
+    id = delivery_id(message_id, receiver_id)
+    delivery = r.table(DELIVERIES_TABLE).get(id)
+    if ARCHIVE_AFTER_DAYS:
+        delivery = delivery.do(
+            lambda found: r.branch(found.eq(None), r.table(ARCHIVE_TABLE).get(id), found))
+    return delivery.do(
+        lambda found: r.branch(found.eq(None), None, receiver_view(found)))
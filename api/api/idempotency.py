@@ -0,0 +1,32 @@
+# A client retrying a send or an apply_filter after a timeout passes the same
+# Idempotency-Key header. The rows written get ids derived from the key, so a
+# retry finds the rows of the first attempt instead of writing them again.
+from uuid import NAMESPACE_URL, uuid5
+
+from flask_restplus import abort
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+IDEMPOTENCY_DOC = {
+    'in': 'header',
+    'description': 'Any unique string, a retry with the same key does not write twice'
+}
+
+
+def idempotency_key(headers) -> str:
+    # Flask and aiohttp request headers alike
+    key = headers.get(IDEMPOTENCY_HEADER)
+    if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return abort(400, f'{IDEMPOTENCY_HEADER} is 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+    return key
+
+
+def idempotent_id(key: str, *scope: str) -> str:
+    # The same key from another user or for another chat is another row
+    return str(uuid5(NAMESPACE_URL, '/'.join((*scope, key))))
+
+
+def keep_existing(id, old, new):
+    # insert(..., conflict=keep_existing) leaves a row written by a first attempt as is
+    return old
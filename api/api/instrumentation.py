@@ -0,0 +1,217 @@
+import contextvars
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from rethinkdb import r
+from flask import g, has_app_context, has_request_context, request
+from rethinkdb import ast
+
+slow_query_logger = logging.getLogger('api.slow_queries')
+
+INSTRUMENTATION_CONFIG = {
+    # queries taking longer than this many milliseconds go to the slow log
+    'slow_query_ms': float(os.environ.get('SLOW_QUERY_MS', 100)),
+    # add X-DB-*, X-Filter-Time-Ms and Server-Timing headers to responses
+    'response_headers': os.environ.get('QUERY_STATS_HEADERS', '1') == '1',
+}
+
+
+def query_shape(term) -> str:
+    # r.table('messages').get_all(...).order_by(...) -> 'table(messages).get_all.order_by'
+    parts = []
+    while isinstance(term, ast.RqlQuery) and not isinstance(term, ast.Datum):
+        name = getattr(term, 'st', None) or type(term).__name__.lower()
+        if isinstance(term, ast.Table) and term._args and isinstance(term._args[-1], ast.Datum):
+            name = f'table({term._args[-1].data})'
+        parts.append(name)
+        if isinstance(term, ast.FunCall):
+            # x.do(f) is FUNCALL(f, x)
+            term = term._args[-1]
+        else:
+            term = term._args[0] if term._args else None
+    return '.'.join(reversed(parts)) or 'expr'
+
+
+def _endpoint() -> str:
+    if has_request_context():
+        return request.endpoint or request.path
+    return threading.current_thread().name
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = defaultdict(lambda: {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                            'max_seconds': 0.0, 'rows': 0, 'slow': 0})
+        self.endpoints = defaultdict(lambda: {'requests': 0, 'queries': 0,
+                                              'db_seconds': 0.0, 'filter_seconds': 0.0})
+        self.filters = defaultdict(lambda: {'calls': 0, 'errors': 0, 'seconds': 0.0})
+        self.stages = defaultdict(lambda: {'runs': 0, 'errors': 0, 'seconds': 0.0})
+
+    def record_query(self, shape: str, seconds: float, rows, error: bool, slow: bool):
+        with self._lock:
+            stats = self.queries[shape]
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += rows or 0
+            stats['slow'] += int(slow)
+
+    def record_filter(self, filter_id: str, seconds: float, error: bool):
+        with self._lock:
+            stats = self.filters[filter_id]
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+
+    def record_stage(self, filter_id: str, seconds: float, error: bool):
+        with self._lock:
+            stats = self.stages[filter_id]
+            stats['runs'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+
+    def record_request(self, endpoint: str, request_stats: dict):
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats['requests'] += 1
+            stats['queries'] += request_stats['queries']
+            stats['db_seconds'] += request_stats['db_seconds']
+            stats['filter_seconds'] += request_stats['filter_seconds']
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'queries': {k: dict(v) for k, v in self.queries.items()},
+                'endpoints': {k: dict(v) for k, v in self.endpoints.items()},
+                'filters': {k: dict(v) for k, v in self.filters.items()},
+                'stages': {k: dict(v) for k, v in self.stages.items()},
+            }
+
+
+STATS = Stats()
+
+
+# The asyncio server has no app context, its requests are tasks of their own
+_async_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def start_async_request() -> dict:
+    stats = {'queries': 0, 'db_seconds': 0.0, 'filter_seconds': 0.0}
+    _async_request_stats.set(stats)
+    return stats
+
+
+def request_stats() -> dict:
+    # Totals of the current request, None outside of one
+    stats = _async_request_stats.get()
+    if stats is not None:
+        return stats
+    if not has_app_context():
+        return None
+    if 'query_stats' not in g:
+        g.query_stats = {'queries': 0, 'db_seconds': 0.0, 'filter_seconds': 0.0}
+    return g.query_stats
+
+
+def _rows(result):
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        return 1
+    # A cursor, only its first batch is known at this point
+    items = getattr(result, 'items', None)
+    return len(items) if items is not None else None
+
+
+def record_filter_call(filter_id: str, seconds: float, error: bool = False):
+    STATS.record_filter(filter_id or 'unknown', seconds, error)
+
+
+def record_stage(filter_id: str, seconds: float, error: bool = False):
+    # A pipeline stage, retries and cache hits included
+    STATS.record_stage(filter_id or 'unknown', seconds, error)
+
+
+def add_filter_time(seconds: float):
+    stats = request_stats()
+    if stats is not None:
+        stats['filter_seconds'] += seconds
+
+
+class InstrumentedConnection(object):
+    # Wraps a driver connection, every `query.run(conn)` passes through `_start`
+    def __init__(self, conn: r.Connection):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._conn.close(noreply_wait=False)
+
+    def _start(self, term, **global_optargs):
+        started = time.perf_counter()
+        try:
+            result = self._conn._start(term, **global_optargs)
+        except r.ReqlError:
+            self._record(term, started, None, True)
+            raise
+        if inspect.isawaitable(result):
+            # An asyncio connection, the query is done once awaited
+            return self._finish(term, started, result)
+        self._record(term, started, result, False)
+        return result
+
+    async def _finish(self, term, started, pending):
+        try:
+            result = await pending
+        except r.ReqlError:
+            self._record(term, started, None, True)
+            raise
+        self._record(term, started, result, False)
+        return result
+
+    def _record(self, term, started, result, error):
+        seconds = time.perf_counter() - started
+        shape = query_shape(term)
+        rows = _rows(result)
+        slow = seconds * 1000 >= INSTRUMENTATION_CONFIG['slow_query_ms']
+        STATS.record_query(shape, seconds, rows, error, slow)
+        stats = request_stats()
+        if stats is not None:
+            stats['queries'] += 1
+            stats['db_seconds'] += seconds
+        if slow:
+            slow_query_logger.warning(
+                '%.1fms rows=%s endpoint=%s shape=%s query=%.500s',
+                seconds * 1000, rows, _endpoint(), shape, term)
+
+
+def stats_headers(stats: dict) -> dict:
+    if not INSTRUMENTATION_CONFIG['response_headers']:
+        return {}
+    return {
+        'X-DB-Queries': str(stats['queries']),
+        'X-DB-Time-Ms': '%.2f' % (stats['db_seconds'] * 1000),
+        'X-Filter-Time-Ms': '%.2f' % (stats['filter_seconds'] * 1000),
+        'Server-Timing': 'db;dur=%.2f, filter;dur=%.2f' % (
+            stats['db_seconds'] * 1000, stats['filter_seconds'] * 1000),
+    }
+
+
+def add_response_headers(response):
+    stats = request_stats()
+    if stats is None:
+        return response
+    STATS.record_request(request.endpoint or 'unknown', stats)
+    response.headers.extend(stats_headers(stats))
+    return response
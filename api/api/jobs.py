@@ -0,0 +1,281 @@
+# Filters of sent messages run here, after the send request has returned.
+# Jobs live in the `filter_jobs` table, one per message, so they survive
+# restarts and any number of workers can share them.
+#
+#   python -m api.jobs [--concurrency N]
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+
+from rethinkdb import r
+
+from api import models
+from api.db import pooled_connection
+from api.deliveries import append_overlays, delivery_id, message_deliveries, touch
+from api.filtering import FilterError
+from api.idempotency import idempotent_id, keep_existing
+from api.pipelines import apply_chain, apply_many
+from api.summaries import record_filtered_values
+
+logger = logging.getLogger(__name__)
+
+JOBS_TABLE = 'filter_jobs'
+
+JOB_CONFIG = {
+    # seconds an idle worker waits before looking for new jobs again
+    'poll_interval': float(os.environ.get('FILTER_JOBS_POLL_INTERVAL', 0.2)),
+    'max_attempts': int(os.environ.get('FILTER_JOBS_MAX_ATTEMPTS', 3)),
+    # seconds after which a running job is considered abandoned by its worker
+    'stale_after': float(os.environ.get('FILTER_JOBS_STALE_AFTER', 300)),
+}
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def enqueue(conn: r.Connection, message_id: str, chat_id: str, value_id: str):
+    # The job id is the message id, so its status is a primary key lookup
+    r.table(JOBS_TABLE).insert({
+        'id': message_id,
+        'chat_id': chat_id,
+        'value_id': value_id,
+        'status': PENDING,
+        'attempts': 0,
+        'error': None,
+        'created_at': r.now(),
+        'updated_at': r.now(),
+    }, conflict='error').run(conn)
+
+
+def job_status(conn: r.Connection, message_id: str) -> dict:
+    return r.table(JOBS_TABLE).get(message_id).pluck(
+        'status', 'attempts', 'error', 'stages', 'created_at', 'updated_at'
+    ).default(None).run(conn)
+
+
+def _jobs_with_status(status):
+    return r.table(JOBS_TABLE).between(
+        [status, r.minval], [status, r.maxval], index='status_created_at')
+
+
+def claim(conn: r.Connection, worker: str) -> dict:
+    # The branch makes the claim atomic, of two workers only one sees a change
+    res = _jobs_with_status(PENDING).order_by(
+        index='status_created_at'
+    ).limit(1).update(
+        lambda job: r.branch(
+            job['status'].eq(PENDING),
+            {
+                'status': RUNNING,
+                'worker': worker,
+                'attempts': job['attempts'].add(1),
+                'claimed_at': r.now(),
+                'updated_at': r.now()
+            },
+            {}),
+        return_changes=True
+    ).run(conn)
+    changes = res.get('changes', [])
+    return changes[0]['new_val'] if changes else None
+
+
+def requeue_stale(conn: r.Connection, stale_after: float) -> int:
+    res = _jobs_with_status(RUNNING).filter(
+        lambda job: job['claimed_at'].lt(r.now().sub(stale_after))
+    ).update({
+        'status': PENDING,
+        'error': 'abandoned by its worker',
+        'updated_at': r.now()
+    }).run(conn)
+    return res.get('replaced', 0)
+
+
+def process(conn: r.Connection, job: dict) -> list:
+    message_id = job['id']
+    chat = r.table('chats').get(job['chat_id']).pluck('default_filter_ids').run(conn)
+    value = r.table('values').get(job['value_id']).run(conn)
+
+    # Chat default filters are applied one after another
+    chain = [models.Filter(**f) for f in r.expr(chat['default_filter_ids']).map(
+        lambda filter_id: r.table('filters').get(filter_id)
+    ).filter(
+        lambda f: f.ne(None)
+    ).run(conn)]
+    current_value, current_type, applied, timings = apply_chain(
+        conn, chain, value['content'], value['type'])
+    # Values get ids derived from the message, a retried job finds the
+    # values of the first attempt instead of appending them again
+    chain_value_ids, chain_filter_ids = [], []
+    if applied:
+        chain_value_ids = [idempotent_id('chain', message_id)]
+        chain_filter_ids = [applied[-1]]
+        r.table('values').insert({
+            'id': chain_value_ids[0],
+            'content': current_value,
+            'type': current_type,
+            'created_at': r.now()
+        }, conflict=keep_existing).run(conn)
+
+    # Every receiver's default filter gets the same input, so each
+    # distinct filter, or stage shared by pipelines, runs once and its
+    # output is shared
+    receivers = list(r.table('users').get_all(
+        r.args(message_deliveries(message_id)['receiver_id'].coerce_to('array'))
+    ).pluck('id', 'default_filter_ids').run(conn))
+    filter_ids = list({f_id for u in receivers for f_id in u['default_filter_ids']})
+    user_filters = [models.Filter(**f) for f in r.table('filters').get_all(
+        r.args(filter_ids)
+    ).filter({
+        'input_type': current_type
+    }).run(conn)] if filter_ids else []
+    results, user_timings = apply_many(conn, user_filters, current_value, current_type)
+    timings.extend(user_timings)
+    filtered = {f.id: {'id': idempotent_id(f.id, message_id), 'content': result['content'],
+                       'type': result['type']}
+                for f, result in zip(user_filters, results)
+                if not isinstance(result, FilterError)}
+    if filtered:
+        r.table('values').insert([dict(value, created_at=r.now()) for value in filtered.values()],
+                                 conflict=keep_existing).run(conn)
+
+    # The chain's value is every receiver's and goes to the message, the
+    # values of receivers' own filters to their overlays
+    overlays = []
+    last_values = {}
+    for receiver in receivers:
+        own_filter_ids = [f_id for f_id in receiver['default_filter_ids'] if f_id in filtered]
+        if own_filter_ids:
+            overlays.append({
+                'id': delivery_id(message_id, receiver['id']),
+                'message_id': message_id,
+                'receiver_id': receiver['id'],
+                'value_ids': [filtered[f_id]['id'] for f_id in own_filter_ids],
+                'filter_ids': own_filter_ids
+            })
+        if not (chain_value_ids or own_filter_ids):
+            continue
+        last_values[receiver['id']] = filtered[own_filter_ids[-1]] if own_filter_ids else {
+            'content': current_value,
+            'type': current_type
+        }
+
+    # A retry does not append the chain's value twice, append_overlays skips
+    # values an overlay already has
+    r.expr([
+        r.table('messages').get(message_id).update(
+            lambda message: r.branch(
+                message['value_ids'].contains(chain_value_ids[0]) if chain_value_ids else True,
+                {'filters_pending': False},
+                {
+                    'value_ids': message['value_ids'].add(chain_value_ids),
+                    'filter_ids': message['filter_ids'].add(chain_filter_ids),
+                    'filters_pending': False
+                })
+        ),
+        append_overlays(overlays)
+    ]).do(
+        lambda _: touch(message_deliveries(message_id))
+    ).run(conn)
+    record_filtered_values(conn, job['chat_id'], message_id, last_values)
+    return timings
+
+
+def finish(conn: r.Connection, job: dict, error: str = None, max_attempts: int = 3,
+           stages: list = None):
+    if error is None:
+        status = DONE
+    elif job['attempts'] >= max_attempts:
+        status = FAILED
+        # Give up on the filters, the raw message stays as it is
+        r.table('messages').get(job['id']).update({'filters_pending': False}).do(
+            lambda _: touch(message_deliveries(job['id']))
+        ).run(conn)
+    else:
+        status = PENDING
+    r.table(JOBS_TABLE).get(job['id']).update({
+        'status': status,
+        'error': error,
+        # [{'filter_id', 'seconds', 'error'}] of the filter calls of the attempt
+        'stages': stages or [],
+        'updated_at': r.now()
+    }).run(conn)
+
+
+class Worker(object):
+    def __init__(self, poll_interval=0.2, max_attempts=3, stale_after=300):
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run_once(self) -> bool:
+        with pooled_connection() as conn:
+            job = claim(conn, self.name)
+            if job is None:
+                return False
+            try:
+                stages = process(conn, job)
+            except Exception as e:
+                # Any error counts as an attempt, a job failing every time
+                # ends up FAILED instead of being claimed again and again
+                logger.exception('Filter job %s failed', job['id'])
+                finish(conn, job, str(e), self.max_attempts)
+            else:
+                finish(conn, job, stages=stages)
+        return True
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                if not self.run_once():
+                    self._stopped.wait(self.poll_interval)
+            except r.ReqlError:
+                logger.exception('Filter job worker lost the database')
+                self._stopped.wait(self.poll_interval * 10)
+            except Exception:
+                # The worker thread keeps running whatever happened to a job
+                logger.exception('Filter job worker failed')
+                self._stopped.wait(self.poll_interval * 10)
+
+    def requeue_loop(self):
+        while not self._stopped.wait(self.stale_after / 2):
+            try:
+                with pooled_connection() as conn:
+                    requeued = requeue_stale(conn, self.stale_after)
+                if requeued:
+                    logger.warning('Requeued %d abandoned filter jobs', requeued)
+            except r.ReqlError:
+                logger.exception('Could not requeue abandoned filter jobs')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run filter jobs')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='jobs processed at the same time')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    worker = Worker(**JOB_CONFIG)
+    threads = [threading.Thread(target=worker.requeue_loop, daemon=True)]
+    threads += [threading.Thread(target=worker.run, daemon=True)
+                for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
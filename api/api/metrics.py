@@ -0,0 +1,118 @@
+# GET /metrics, counters of this worker process in the Prometheus text format.
+# Every gunicorn worker keeps its own, a scraper sees the one it happens to hit
+# unless the service is scraped per worker.
+from flask import Response
+
+from api.access import ACCESS
+from api.catalog import FILTER_CATALOG
+from api.db import POOL
+from api.filter_cache import FILTER_CACHE
+from api.filter_health import FILTER_HEALTH
+from api.instrumentation import STATS
+from api.realtime import FEED
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name: str, value, **labels) -> str:
+    if labels:
+        label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+        return f'{name}{{{label_text}}} {value}'
+    return f'{name} {value}'
+
+
+def render() -> str:
+    lines = []
+
+    def family(name, type, help, samples):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {type}')
+        lines.extend(samples)
+
+    stats = STATS.snapshot()
+    queries = stats['queries']
+    family('rethinkdb_queries_total', 'counter', 'Queries run, by query shape.',
+           [_sample('rethinkdb_queries_total', s['count'], shape=shape) for shape, s in queries.items()])
+    family('rethinkdb_query_errors_total', 'counter', 'Queries that raised a ReqlError.',
+           [_sample('rethinkdb_query_errors_total', s['errors'], shape=shape) for shape, s in queries.items()])
+    family('rethinkdb_slow_queries_total', 'counter', 'Queries over the slow query threshold.',
+           [_sample('rethinkdb_slow_queries_total', s['slow'], shape=shape) for shape, s in queries.items()])
+    family('rethinkdb_query_seconds_total', 'counter', 'Time spent in queries.',
+           [_sample('rethinkdb_query_seconds_total', '%.6f' % s['seconds'], shape=shape)
+            for shape, s in queries.items()])
+    family('rethinkdb_query_seconds_max', 'gauge', 'Slowest query so far.',
+           [_sample('rethinkdb_query_seconds_max', '%.6f' % s['max_seconds'], shape=shape)
+            for shape, s in queries.items()])
+    family('rethinkdb_query_rows_total', 'counter', 'Rows returned, only the first batch of cursors.',
+           [_sample('rethinkdb_query_rows_total', s['rows'], shape=shape) for shape, s in queries.items()])
+
+    endpoints = stats['endpoints']
+    family('http_requests_total', 'counter', 'Requests handled, by endpoint.',
+           [_sample('http_requests_total', s['requests'], endpoint=e) for e, s in endpoints.items()])
+    family('http_request_queries_total', 'counter', 'Queries run by requests, by endpoint.',
+           [_sample('http_request_queries_total', s['queries'], endpoint=e) for e, s in endpoints.items()])
+    family('http_request_db_seconds_total', 'counter', 'Time requests spent in queries.',
+           [_sample('http_request_db_seconds_total', '%.6f' % s['db_seconds'], endpoint=e)
+            for e, s in endpoints.items()])
+    family('http_request_filter_seconds_total', 'counter', 'Time requests spent waiting for filters.',
+           [_sample('http_request_filter_seconds_total', '%.6f' % s['filter_seconds'], endpoint=e)
+            for e, s in endpoints.items()])
+
+    filters = stats['filters']
+    family('filter_calls_total', 'counter', 'HTTP calls to filters, retries included.',
+           [_sample('filter_calls_total', s['calls'], filter_id=f) for f, s in filters.items()])
+    family('filter_call_errors_total', 'counter', 'Failed HTTP calls to filters.',
+           [_sample('filter_call_errors_total', s['errors'], filter_id=f) for f, s in filters.items()])
+    family('filter_call_seconds_total', 'counter', 'Time spent in HTTP calls to filters.',
+           [_sample('filter_call_seconds_total', '%.6f' % s['seconds'], filter_id=f)
+            for f, s in filters.items()])
+
+    stages = stats['stages']
+    family('pipeline_stage_runs_total', 'counter', 'Pipeline stages run, by filter.',
+           [_sample('pipeline_stage_runs_total', s['runs'], filter_id=f) for f, s in stages.items()])
+    family('pipeline_stage_errors_total', 'counter', 'Pipeline stages that failed.',
+           [_sample('pipeline_stage_errors_total', s['errors'], filter_id=f) for f, s in stages.items()])
+    family('pipeline_stage_seconds_total', 'counter', 'Time spent in pipeline stages.',
+           [_sample('pipeline_stage_seconds_total', '%.6f' % s['seconds'], filter_id=f)
+            for f, s in stages.items()])
+
+    for name, value in POOL.metrics().items():
+        type = 'counter' if name in ('checkouts', 'checkout_failures', 'created', 'closed',
+                                     'evicted', 'health_check_failures', 'wait_time_total') else 'gauge'
+        family(f'rethinkdb_pool_{name}', type, f'Connection pool {name}.',
+               [_sample(f'rethinkdb_pool_{name}', value)])
+
+    cache = FILTER_CACHE.metrics()
+    memory = cache.pop('memory')
+    for name, value in cache.items():
+        family(f'filter_cache_{name}', 'counter', f'Filter result cache {name}.',
+               [_sample(f'filter_cache_{name}', value)])
+    for name, value in memory.items():
+        type = 'gauge' if name in ('size', 'maxsize') else 'counter'
+        family(f'filter_cache_memory_{name}', type, f'In-memory filter result cache {name}.',
+               [_sample(f'filter_cache_memory_{name}', value)])
+
+    for name, value in ACCESS.metrics().items():
+        type = 'gauge' if name in ('size', 'maxsize') else 'counter'
+        family(f'access_cache_{name}', type, f'Permission check cache {name}.',
+               [_sample(f'access_cache_{name}', value)])
+
+    for name, value in FILTER_CATALOG.metrics().items():
+        type = 'counter' if name in ('changes', 'not_modified') else 'gauge'
+        family(f'filter_catalog_{name}', type, f'In-memory filter catalog {name}.',
+               [_sample(f'filter_catalog_{name}', value)])
+
+    for name, value in FILTER_HEALTH.metrics().items():
+        type = 'gauge' if name == 'open' else 'counter'
+        family(f'filter_circuits_{name}', type, f'Filter circuit breakers {name}.',
+               [_sample(f'filter_circuits_{name}', value)])
+
+    family('event_stream_subscribers', 'gauge', 'Open event streams.',
+           [_sample('event_stream_subscribers', FEED.subscribers_count())])
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -1,7 +1,6 @@
 from dataclasses import dataclass, field
 
-import rethinkdb as r
-from typing import List
+from typing import Dict, List
 
 
 @dataclass
@@ -14,6 +13,8 @@ class User(object):
     id: str = None
     default_filter_ids: List[str] = field(default_factory=list)
     added_filter_ids: List[str] = field(default_factory=list)
+    # added_filter_ids by input type, see api.catalog
+    filter_ids_by_type: Dict[str, List[str]] = field(default_factory=dict)
 
 
 @dataclass
@@ -32,6 +33,24 @@ class Filter(object):
     is_pipeline: bool = False
     filter_ids: List[str] = field(default_factory=list)
     description: str = None
-    avatar = None
+    avatar: str = None
+    id: str = None
+    # seconds per HTTP attempt, None uses FILTER_TIMEOUT
+    timeout: float = None
+    # seconds for all attempts together, None uses FILTER_BUDGET
+    budget: float = None
+    # extra attempts after a failed one, None uses FILTER_RETRIES
+    retries: int = None
+    # deterministic filters return the same output for the same input,
+    # so their results may be served from the filter result cache
+    cacheable: bool = False
+    # more URLs serving the same filter, calls go to the fastest healthy
+    # one of these and external_url, see api.filter_health
+    replica_urls: List[str] = field(default_factory=list)
+    # the service also takes {'values': [...]} and answers {'values': [...]}
+    # in the same order, concurrent calls are then sent together
+    batchable: bool = False
+    # values per batched request, None uses FILTER_MAX_BATCH_SIZE
+    max_batch_size: int = None
 
 
@@ -0,0 +1,233 @@
+# Filters with `is_pipeline` set run the filters of their `filter_ids` one
+# after another, and any of those may be a pipeline itself. A pipeline is
+# compiled once into its flat list of stages, with the types of neighbouring
+# stages checked, and the list is cached per pipeline.
+#
+# Filters applied to the same value are merged into a tree of stages: a
+# prefix shared by several pipelines runs once, the branches after it run in
+# parallel, and every output goes on to the next stages as soon as it is there.
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Any, Dict, List, Sequence, Tuple
+
+from rethinkdb import r
+
+from api import models
+from api.cache import LRUCache
+from api.db import pooled_connection
+from api.filtering import EXECUTOR, FilterError, FilterExecutor
+from api.instrumentation import add_filter_time, record_stage
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_CONFIG = {
+    'cache_size': int(os.environ.get('PIPELINE_CACHE_SIZE', 1024)),
+    # seconds a compiled pipeline is used before its filters are read again
+    'cache_ttl': float(os.environ.get('PIPELINE_CACHE_TTL', 300)),
+}
+
+PLANS = LRUCache(maxsize=PIPELINE_CONFIG['cache_size'], ttl=PIPELINE_CONFIG['cache_ttl'])
+
+
+class PipelineError(FilterError):
+    # The pipeline can not run at all, e.g. its stages' types do not match
+    pass
+
+
+def _load_nested(conn: r.Connection, pipelines: List[models.Filter]) -> Dict[str, models.Filter]:
+    # One query per level of nesting
+    filters = {f.id: f for f in pipelines}
+    requested = set(filters)
+    pending = {f_id for f in pipelines for f_id in f.filter_ids} - requested
+    while pending:
+        requested |= pending
+        found = [models.Filter(**f) for f in r.table('filters').get_all(r.args(list(pending))).run(conn)]
+        filters.update((f.id, f) for f in found)
+        pending = {f_id for f in found if f.is_pipeline for f_id in f.filter_ids} - requested
+    return filters
+
+
+def _flatten(f: models.Filter, filters: Dict[str, models.Filter], path: Tuple[str, ...]) -> List[models.Filter]:
+    if not f.is_pipeline:
+        return [f]
+    if f.id in path:
+        raise PipelineError(f, 'contains itself')
+    if not f.filter_ids:
+        raise PipelineError(f, 'has no stages')
+    stages = []
+    for filter_id in f.filter_ids:
+        if filter_id not in filters:
+            raise PipelineError(f, f'unknown filter {filter_id}')
+        nested = _flatten(filters[filter_id], filters, path + (f.id,))
+        if stages and stages[-1].output_type != nested[0].input_type:
+            raise PipelineError(
+                f, f'{stages[-1].name or stages[-1].id} outputs {stages[-1].output_type}, '
+                   f'{filters[filter_id].name or filter_id} takes {nested[0].input_type}')
+        stages.extend(nested)
+    if stages[0].input_type != f.input_type or stages[-1].output_type != f.output_type:
+        raise PipelineError(
+            f, f'stages take {stages[0].input_type} and output {stages[-1].output_type}, '
+               f'not {f.input_type} and {f.output_type}')
+    return stages
+
+
+def compile_filters(conn: r.Connection, filters: Sequence[models.Filter]) -> Dict[str, Any]:
+    # Maps filter ids to their stages, or to a PipelineError. A plain filter
+    # is a pipeline of one stage.
+    plans = {}
+    missing = []
+    for f in filters:
+        if not f.is_pipeline:
+            plans[f.id] = (f,)
+            continue
+        # Changing a pipeline's own stages changes the key, nested pipelines
+        # are picked up once the entry expires
+        plan = PLANS.get((f.id, tuple(f.filter_ids)), None)
+        if plan is None:
+            missing.append(f)
+        else:
+            plans[f.id] = plan
+    if missing:
+        known = _load_nested(conn, missing)
+        for f in missing:
+            try:
+                plan = tuple(_flatten(f, known, ()))
+            except PipelineError as e:
+                plan = e
+            PLANS.put((f.id, tuple(f.filter_ids)), plan)
+            plans[f.id] = plan
+    return plans
+
+
+class Stage(object):
+    def __init__(self, f: models.Filter = None):
+        self.filter = f
+        # next stages by filter id
+        self.children = {}
+        # ids of the filters whose output this stage is
+        self.targets = []
+
+    def subtree_targets(self) -> List[str]:
+        targets = list(self.targets)
+        for child in self.children.values():
+            targets.extend(child.subtree_targets())
+        return targets
+
+
+def build_tree(plans: Dict[str, Sequence[models.Filter]]) -> Stage:
+    root = Stage()
+    for target, stages in plans.items():
+        node = root
+        for f in stages:
+            node = node.children.setdefault(f.id, Stage(f))
+        node.targets.append(target)
+    return root
+
+
+def _run_stage(executor: FilterExecutor, f: models.Filter, value: Any, deadline: float):
+    started = time.perf_counter()
+    try:
+        result = executor.run(f, value, deadline)
+    except FilterError as e:
+        return e, time.perf_counter() - started
+    return result, time.perf_counter() - started
+
+
+def execute(root: Stage, value: Any, type: str, executor: FilterExecutor = EXECUTOR,
+            budget: float = None) -> Tuple[Dict[str, Any], List[dict]]:
+    # Returns {target: {'content', 'type'} or FilterError} and the timings of
+    # the stages that ran, [{'filter_id', 'seconds', 'error'}]
+    deadline = time.monotonic() + budget if budget is not None else None
+    started = time.perf_counter()
+    results, timings = {}, []
+    running = {}
+
+    def fail(stage, error):
+        for target in stage.subtree_targets():
+            results[target] = error
+
+    def start(stage, value, type):
+        for child in stage.children.values():
+            if child.filter.input_type != type:
+                fail(child, FilterError(child.filter, f'takes {child.filter.input_type}, not {type}'))
+                continue
+            running[executor.submit(_run_stage, executor, child.filter, value, deadline)] = child
+
+    start(root, value, type)
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = running.pop(future)
+            output, seconds = future.result()
+            error = isinstance(output, FilterError)
+            timings.append({'filter_id': stage.filter.id, 'seconds': round(seconds, 6), 'error': error})
+            record_stage(stage.filter.id, seconds, error)
+            if error:
+                fail(stage, output)
+                continue
+            for target in stage.targets:
+                results[target] = {'content': output, 'type': stage.filter.output_type}
+            start(stage, output, stage.filter.output_type)
+    add_filter_time(time.perf_counter() - started)
+    return results, timings
+
+
+def apply_many(conn: r.Connection, filters: List[models.Filter], value: Any, type: str,
+               executor: FilterExecutor = EXECUTOR, budget: float = None) -> Tuple[List[Any], List[dict]]:
+    # Like FilterExecutor.run_many, results are {'content', 'type'} or a FilterError
+    plans = compile_filters(conn, filters)
+    runnable = {f_id: plan for f_id, plan in plans.items() if not isinstance(plan, PipelineError)}
+    results, timings = execute(build_tree(runnable), value, type, executor, budget)
+    return [plans[f.id] if isinstance(plans[f.id], PipelineError) else results[f.id]
+            for f in filters], timings
+
+
+def apply_chain(conn: r.Connection, filters: List[models.Filter], value: Any, type: str,
+                executor: FilterExecutor = EXECUTOR) -> Tuple[Any, str, List[str], List[dict]]:
+    # Like FilterExecutor.run_chain, with a pipeline being one link of the
+    # chain. Returns the output, its type, the applied filter ids and timings.
+    plans = compile_filters(conn, filters)
+    applied, timings = [], []
+    for f in filters:
+        if type != f.input_type:
+            break
+        if isinstance(plans[f.id], PipelineError):
+            logger.warning('%s', plans[f.id])
+            continue
+        results, stage_timings = execute(build_tree({f.id: plans[f.id]}), value, type, executor)
+        timings.extend(stage_timings)
+        if isinstance(results[f.id], FilterError):
+            logger.warning('%s', results[f.id])
+            continue
+        value, type = results[f.id]['content'], results[f.id]['type']
+        applied.append(f.id)
+    return value, type, applied, timings
+
+
+def apply(conn: r.Connection, f: models.Filter, value: Any, type: str,
+          executor: FilterExecutor = EXECUTOR, cache: bool = True) -> Any:
+    # The output of a single filter or pipeline, raises FilterError
+    if not f.is_pipeline:
+        return executor.run(f, value, cache=cache)
+    plan = compile_filters(conn, [f])[f.id]
+    if isinstance(plan, PipelineError):
+        raise plan
+    result = execute(build_tree({f.id: plan}), value, type, executor)[0][f.id]
+    if isinstance(result, FilterError):
+        raise result
+    return result['content']
+
+
+async def apply_async(f: models.Filter, value: Any, type: str,
+                      executor: FilterExecutor = EXECUTOR, cache: bool = True) -> Any:
+    # apply() for the asyncio server, a pipeline runs on a thread of the loop
+    import asyncio
+    if not f.is_pipeline:
+        return await executor.run_async(f, value, cache=cache)
+
+    def run():
+        with pooled_connection() as conn:
+            return apply(conn, f, value, type, executor, cache)
+    return await asyncio.get_event_loop().run_in_executor(None, run)
@@ -0,0 +1,145 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+from rethinkdb import r
+
+from api.db import connect, run_steps
+from api.deliveries import DELIVERIES_TABLE, receiver_view
+from api.history import format_cursor, resolve_values_steps
+
+logger = logging.getLogger(__name__)
+
+REALTIME_CONFIG = {
+    # events buffered per client before it is told to reconnect and resume
+    'queue_size': int(os.environ.get('REALTIME_QUEUE_SIZE', 1000)),
+    # seconds between keep-alive comments on an idle stream
+    'heartbeat': float(os.environ.get('REALTIME_HEARTBEAT', 15)),
+    # messages replayed on resume before the client is told to reload instead
+    'replay_limit': int(os.environ.get('REALTIME_REPLAY_LIMIT', 500)),
+}
+
+# Put on a client's queue when it fell too far behind
+OVERFLOW = object()
+
+
+class MessageFeed(object):
+    # All clients of a worker share one changefeed on `deliveries`. A
+    # get_all(..., index='receiver_id') feed can not change its keys, so the
+    # feed covers the table and changes are routed to subscribers in process.
+    # A delivery's version goes up when its message changes.
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self, receiver_id: str) -> queue.Queue:
+        subscription = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(receiver_id, set()).add(subscription)
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='message-feed', daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, receiver_id: str, subscription: queue.Queue):
+        with self._lock:
+            subscriptions = self._subscribers.get(receiver_id)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[receiver_id]
+
+    def subscribers_count(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    def _dispatch(self, change: dict):
+        delivery = change.get('new_val')
+        if delivery is None:
+            return
+        with self._lock:
+            subscriptions = list(self._subscribers.get(delivery['receiver_id'], ()))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(change)
+            except queue.Full:
+                self.unsubscribe(delivery['receiver_id'], subscription)
+                # Make room for the marker, the client resumes from its cursor anyway
+                try:
+                    subscription.get_nowait()
+                except queue.Empty:
+                    pass
+                subscription.put_nowait(OVERFLOW)
+
+    def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                conn = connect()
+                try:
+                    feed = r.table(DELIVERIES_TABLE).changes().run(conn)
+                    delay = 0.5
+                    for change in feed:
+                        self._dispatch(change)
+                finally:
+                    conn.close(noreply_wait=False)
+            except r.ReqlError as e:
+                logger.warning('Message changefeed failed, reconnecting in %.1fs: %s', delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+FEED = MessageFeed(queue_size=REALTIME_CONFIG['queue_size'])
+
+
+def message_event(message: dict, kind: str) -> dict:
+    return {
+        'type': kind,
+        'message': {
+            'id': message['id'],
+            'message_id': message['message_id'],
+            'chat_id': message['chat_id'],
+            'sender_id': message['sender_id'],
+            'created_at': message['created_at'],
+            'cursor': format_cursor(message['created_at']),
+            'filter_ids': message['filter_ids'],
+            'values': message['values'],
+        }
+    }
+
+
+def replay_steps(receiver_id: str, after: float, limit: int):
+    # Messages received after the cursor, oldest first, or None if there are
+    # too many of them and the client should reload its chats instead
+    messages = yield r.table(DELIVERIES_TABLE).between(
+        [receiver_id, r.epoch_time(after)],
+        [receiver_id, r.maxval],
+        left_bound='open',
+        index='receiver_created_at'
+    ).order_by(index='receiver_created_at').limit(limit + 1).map(receiver_view)
+    if len(messages) > limit:
+        return None
+    return (yield from resolve_values_steps(messages))
+
+
+def replay(conn: r.Connection, receiver_id: str, after: float,
+           limit: int) -> Optional[list]:
+    return run_steps(replay_steps(receiver_id, after, limit), conn)
+
+
+def delivered_steps(delivery: dict):
+    # The receiver's message of a delivery from the feed, with its values
+    message = yield receiver_view(r.expr(delivery))
+    return (yield from resolve_values_steps([message]))[0]
+
+
+def delivered(conn: r.Connection, delivery: dict) -> dict:
+    return run_steps(delivered_steps(delivery), conn)
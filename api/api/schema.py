@@ -0,0 +1,117 @@
+from rethinkdb import r
+
+from api.db import db_connection, rdb_config
+from api.search import search_terms
+
+TABLES = [
+    'chat_summaries',
+    'chats',
+    'deliveries',
+    'deliveries_archive',
+    'filter_jobs',
+    'filter_results',
+    'filters',
+    'message_overlays',
+    'messages',
+    'users',
+    'values',
+]
+
+# table -> [(index name, index function or None for a plain field, index_create options)]
+INDEXES = {
+    'chat_summaries': [
+        ('chat_id', None, {}),
+        ('user_id', None, {}),
+    ],
+    'chats': [
+        ('name', None, {}),
+        ('user_ids', None, {'multi': True}),
+    ],
+    'filter_jobs': [
+        ('status_created_at',
+         lambda job: [job['status'], job['created_at']],
+         {}),
+    ],
+    'filter_results': [
+        # For api.compaction: results of deleted values
+        ('value_id', None, {}),
+    ],
+    'filters': [
+        ('input_type', None, {}),
+    ],
+    'deliveries': [
+        ('receiver_created_at',
+         lambda delivery: [delivery['receiver_id'],
+                           delivery['created_at']],
+         {}),
+        ('chat_receiver_created_at',
+         lambda delivery: [delivery['chat_id'],
+                           delivery['receiver_id'],
+                           delivery['created_at']],
+         {}),
+        ('message_id', None, {}),
+        # For api.compaction: deliveries to archive
+        ('created_at', None, {}),
+    ],
+    'deliveries_archive': [
+        ('chat_receiver_created_at',
+         lambda delivery: [delivery['chat_id'],
+                           delivery['receiver_id'],
+                           delivery['created_at']],
+         {}),
+    ],
+    'message_overlays': [
+        ('value_ids', None, {'multi': True}),
+    ],
+    'messages': [
+        # For api.compaction: values still referenced
+        ('value_ids', None, {'multi': True}),
+    ],
+    'users': [
+        ('username', None, {}),
+        ('search_terms', search_terms, {'multi': True}),
+    ],
+    'values': [
+        # Values sharing a blob file, text content is not indexed
+        ('blob', lambda value: value['content']['blob'], {}),
+    ],
+}
+
+
+def ensure_schema(conn: r.Connection, db: str = None) -> dict:
+    db = db or rdb_config()['db']
+    created = {'tables': [], 'indexes': []}
+    if db not in r.db_list().run(conn):
+        r.db_create(db).run(conn)
+    existing_tables = r.db(db).table_list().run(conn)
+    for table in TABLES:
+        if table not in existing_tables:
+            r.db(db).table_create(table).run(conn)
+            created['tables'].append(table)
+    for table, indexes in INDEXES.items():
+        existing_indexes = r.db(db).table(table).index_list().run(conn)
+        for name, function, options in indexes:
+            if name in existing_indexes:
+                continue
+            if function is None:
+                r.db(db).table(table).index_create(name, **options).run(conn)
+            else:
+                r.db(db).table(table).index_create(
+                    name, function, **options).run(conn)
+            created['indexes'].append(f'{table}.{name}')
+        r.db(db).table(table).index_wait().run(conn)
+    return created
+
+
+def main():
+    with db_connection() as conn:
+        created = ensure_schema(conn)
+    for table in created['tables']:
+        print(f'created table {table}')
+    for index in created['indexes']:
+        print(f'created index {index}')
+    print('schema is up to date')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# Username and name search. Every worker keeps the users in memory: a sorted
+# list of lowercased terms answers prefix queries with a binary search, and
+# trigram posting lists answer queries matching inside a term. The index is
+# loaded in the background and kept current by a changefeed on `users`; until
+# it is ready queries go to the `search_terms` index of the table.
+import bisect
+import logging
+import os
+import threading
+import time
+from array import array
+from typing import Iterable, List, Optional
+
+from rethinkdb import r
+
+from api.db import connect, db_connection
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CONFIG = {
+    # 'memory' or 'table', the latter only answers prefix queries
+    'backend': os.environ.get('USER_SEARCH_BACKEND', 'memory'),
+    'limit': int(os.environ.get('USER_SEARCH_LIMIT', 20)),
+    'max_limit': int(os.environ.get('USER_SEARCH_MAX_LIMIT', 100)),
+}
+
+USER_FIELDS = ('id', 'username', 'name', 'avatar')
+
+# Ranks, lower first
+EXACT = 0
+USERNAME_PREFIX = 1
+NAME_PREFIX = 2
+INFIX = 3
+
+
+def normalize(text: Optional[str]) -> str:
+    return ' '.join((text or '').casefold().split())
+
+
+def user_terms(user: dict) -> List[tuple]:
+    # (term, is_name) pairs a user is found by, its name also by each word
+    terms = {(normalize(user.get('username')), False)}
+    name = normalize(user.get('name'))
+    if name:
+        terms.add((name, True))
+        terms.update((word, True) for word in name.split(' '))
+    return [term for term in terms if term[0]]
+
+
+def trigrams(text: str) -> Iterable[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def search_terms(user):
+    # The `users.search_terms` multi index, the same terms as user_terms
+    username = user['username'].downcase()
+    name = user['name'].default('').downcase()
+    return r.expr([username, name]).union(name.split()).distinct().filter(
+        lambda term: term.ne(''))
+
+
+class UserSearchIndex(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+        self._thread_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.ready = False
+
+    def _clear(self):
+        # doc number -> user dict, None once deleted
+        self._users = []
+        self._numbers = {}
+        # sorted (term, doc number), usernames and names apart so that a
+        # prefix shared by many names does not hide matching usernames
+        self._terms = {False: [], True: []}
+        # trigram -> doc numbers, a user's are removed with their terms
+        self._trigrams = {}
+        # doc number -> its terms joined, what a trigram candidate is checked against
+        self._matchable = []
+
+    def build(self, users: Iterable[dict]):
+        # Replaces the contents, terms are sorted once instead of on every insert
+        with self._lock:
+            self._clear()
+            for user in users:
+                self._add(user, sort=False)
+            for terms in self._terms.values():
+                terms.sort()
+            self.ready = True
+
+    def _add(self, user: dict, sort: bool = True):
+        user = {field: user.get(field) for field in USER_FIELDS}
+        number = self._numbers.get(user['id'])
+        if number is not None:
+            self._remove_terms(number)
+        else:
+            number = len(self._users)
+            self._numbers[user['id']] = number
+            self._users.append(None)
+            self._matchable.append(None)
+        self._users[number] = user
+        terms = user_terms(user)
+        self._matchable[number] = '\n'.join(term for term, _ in terms)
+        grams = set()
+        for term, is_name in terms:
+            if sort:
+                bisect.insort(self._terms[is_name], (term, number))
+            else:
+                self._terms[is_name].append((term, number))
+            grams.update(trigrams(term))
+        for trigram in grams:
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                postings = self._trigrams[trigram] = array('L')
+            postings.append(number)
+
+    def _remove_terms(self, number: int):
+        grams = set()
+        for term, is_name in user_terms(self._users[number]):
+            terms = self._terms[is_name]
+            index = bisect.bisect_left(terms, (term, number))
+            if index < len(terms) and terms[index] == (term, number):
+                del terms[index]
+            grams.update(trigrams(term))
+        for trigram in grams:
+            postings = self._trigrams.get(trigram)
+            if postings is not None and number in postings:
+                postings.remove(number)
+                if not postings:
+                    del self._trigrams[trigram]
+
+    def add(self, user: dict):
+        with self._lock:
+            self._add(user)
+
+    def remove(self, user_id: str):
+        with self._lock:
+            number = self._numbers.pop(user_id, None)
+            if number is not None:
+                self._remove_terms(number)
+                self._users[number] = None
+                self._matchable[number] = None
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        query = normalize(query)
+        if not query:
+            return []
+        found = {}
+        with self._lock:
+            # Prefix matches in term order, an exact username sorts first
+            for is_name in (False, True):
+                terms = self._terms[is_name]
+                index = bisect.bisect_left(terms, (query,))
+                while index < len(terms) and len(found) < limit:
+                    term, number = terms[index]
+                    if not term.startswith(query):
+                        break
+                    if number not in found:
+                        rank = NAME_PREFIX if is_name else (EXACT if term == query else USERNAME_PREFIX)
+                        found[number] = (rank, len(found))
+                    index += 1
+            if len(found) < limit and len(query) >= 3:
+                # Matches inside a term, candidates from the rarest trigram
+                postings = min((self._trigrams.get(t, ()) for t in trigrams(query)), key=len)
+                for number in postings:
+                    if len(found) >= limit:
+                        break
+                    if number in found:
+                        continue
+                    matchable = self._matchable[number]
+                    if matchable is not None and query in matchable:
+                        found[number] = (INFIX, len(found))
+            ranked = sorted(found.items(), key=lambda item: item[1])
+            return [dict(self._users[number]) for number, _ in ranked]
+
+    def ensure_loaded(self):
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.ready = False
+            self._thread = threading.Thread(target=self._run, name='user-search', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                conn = connect()
+                try:
+                    # The feed is opened before loading, so no change made
+                    # during the load is missed
+                    feed = r.table('users').changes().filter(
+                        lambda change: change['old_val'].pluck(*USER_FIELDS).default(None).ne(
+                            change['new_val'].pluck(*USER_FIELDS).default(None))
+                    ).map(
+                        lambda change: {
+                            'old_id': change['old_val']['id'].default(None),
+                            'user': change['new_val'].pluck(*USER_FIELDS).default(None)
+                        }
+                    ).run(conn)
+                    started = time.monotonic()
+                    with db_connection() as load_conn:
+                        self.build(r.table('users').pluck(*USER_FIELDS).run(load_conn))
+                    logger.info('Loaded %d users for search in %.1fs', len(self), time.monotonic() - started)
+                    delay = 0.5
+                    for change in feed:
+                        if change['user'] is None:
+                            self.remove(change['old_id'])
+                        else:
+                            self.add(change['user'])
+                finally:
+                    self.ready = False
+                    conn.close(noreply_wait=False)
+            except r.ReqlError as e:
+                logger.warning('User search changefeed failed, reconnecting in %.1fs: %s', delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+def _search_table(conn: r.Connection, query: str, limit: int) -> List[dict]:
+    query = normalize(query)
+    if not query:
+        return []
+    # A range of a multi index comes unordered, exact matches are read first
+    rows = r.table('users').get_all(
+        query, index='search_terms'
+    ).limit(limit).union(
+        r.table('users').between(
+            query, query + '\uffff', index='search_terms'
+        ).limit(limit * 4)
+    ).pluck(*USER_FIELDS).run(conn)
+    found = {}
+    for user in rows:
+        ranks = [NAME_PREFIX if is_name else (EXACT if term == query else USERNAME_PREFIX)
+                 for term, is_name in user_terms(user) if term.startswith(query)]
+        if ranks:
+            found.setdefault(user['id'], (min(ranks), normalize(user['username']), user))
+    return [user for _, _, user in sorted(found.values(), key=lambda f: f[:2])][:limit]
+
+
+USER_SEARCH = UserSearchIndex()
+
+
+def search_users(query: str, limit: int = 20) -> List[dict]:
+    if SEARCH_CONFIG['backend'] == 'memory':
+        USER_SEARCH.ensure_loaded()
+        if USER_SEARCH.ready:
+            return USER_SEARCH.search(query, limit)
+    with db_connection() as conn:
+        return _search_table(conn, query, limit)
+
+
+def user_created(user: dict):
+    # Searchable in this worker right away, others get it from the changefeed
+    if USER_SEARCH.ready:
+        USER_SEARCH.add(user)
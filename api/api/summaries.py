@@ -0,0 +1,159 @@
+# Chat list entries per (chat, user), kept up to date on write so that
+# GET /chats is a single indexed read.
+#
+#   python -m api.summaries [--chat CHAT_ID]    rebuilds them from messages
+import argparse
+from typing import Dict, List
+
+from rethinkdb import r
+
+from api.db import db_connection
+from api.deliveries import receiver_view
+from api.history import HISTORY_INDEX, chat_messages
+
+SUMMARIES_TABLE = 'chat_summaries'
+
+
+def summary_id(chat_id, user_id):
+    if isinstance(chat_id, str) and isinstance(user_id, str):
+        return f'{chat_id}:{user_id}'
+    return r.expr(chat_id).add(':').add(user_id)
+
+
+def last_message(chat_id, user_id):
+    # The newest message of the chat delivered to the user, or None
+    return chat_messages(chat_id, user_id).order_by(
+        index=r.desc(HISTORY_INDEX)
+    ).limit(1).coerce_to('array').do(
+        lambda last_messages: r.branch(
+            last_messages.is_empty(), None,
+            receiver_view(last_messages[0]).do(
+                lambda message: r.table('values').get(message['value_ids'][-1]).do(
+                    lambda value: {
+                        'message_id': message['message_id'],
+                        'created_at': message['created_at'],
+                        'sender_name': r.table('users').get(message['sender_id'])['name'],
+                        'content': value['content'],
+                        'type': value['type']
+                    }
+                )
+            )
+        )
+    )
+
+
+def _keep_newest(id, old, new):
+    return old.merge({
+        'name': new['name'],
+        'participants_count': new['participants_count'],
+        'last_message': r.branch(
+            old['last_message'].eq(None).or_(
+                new['last_message'].ne(None).and_(
+                    old['last_message']['created_at'].le(new['last_message']['created_at']))),
+            new['last_message'],
+            old['last_message'])
+    })
+
+
+def record_message(conn: r.Connection, chat_id: str, name: str, participants_count: int,
+                   last_messages: List[dict]):
+    # `last_messages` are the receivers' views of a message just sent,
+    # {'user_id', 'message_id', 'sender_name', 'content', 'type'}
+    r.table(SUMMARIES_TABLE).insert([{
+        'id': summary_id(chat_id, message['user_id']),
+        'chat_id': chat_id,
+        'user_id': message['user_id'],
+        'name': name,
+        'participants_count': participants_count,
+        'last_message': {
+            'message_id': message['message_id'],
+            'created_at': r.now(),
+            'sender_name': message['sender_name'],
+            'content': message['content'],
+            'type': message['type']
+        }
+    } for message in last_messages], conflict=_keep_newest).run(conn)
+
+
+def filtered_values_query(chat_id: str, message_id: str, values: Dict[str, dict]):
+    # A filter applied to a user's latest message changes what the list
+    # shows, `values` maps user ids to their new {'content', 'type'}
+    return r.table(SUMMARIES_TABLE).get_all(
+        r.args([summary_id(chat_id, user_id) for user_id in values])
+    ).update(
+        lambda summary: r.branch(
+            summary['last_message']['message_id'].default(None).eq(message_id),
+            {
+                'last_message': r.expr(values)[summary['user_id']].pluck('content', 'type')
+            },
+            {})
+    )
+
+
+def record_filtered_values(conn: r.Connection, chat_id: str, message_id: str,
+                           values: Dict[str, dict]):
+    if not values:
+        return
+    filtered_values_query(chat_id, message_id, values).run(conn)
+
+
+def refresh_members(conn: r.Connection, chat_id):
+    # Membership changed: every member gets an entry, counts are updated
+    r.table('chats').get(chat_id).do(
+        lambda chat: r.table(SUMMARIES_TABLE).insert(
+            chat['user_ids'].map(
+                lambda user_id: {
+                    'id': summary_id(chat['id'], user_id),
+                    'chat_id': chat['id'],
+                    'user_id': user_id,
+                    'name': chat['name'],
+                    'participants_count': chat['user_ids'].count(),
+                    'last_message': None
+                }
+            ),
+            conflict=_keep_newest
+        )
+    ).run(conn)
+
+
+def rebuild(conn: r.Connection, chat_id: str = None) -> dict:
+    chats = r.table('chats') if chat_id is None else r.table('chats').get_all(chat_id)
+    written = chats.for_each(
+        lambda chat: r.table(SUMMARIES_TABLE).insert(
+            chat['user_ids'].map(
+                lambda user_id: {
+                    'id': summary_id(chat['id'], user_id),
+                    'chat_id': chat['id'],
+                    'user_id': user_id,
+                    'name': chat['name'],
+                    'participants_count': chat['user_ids'].count(),
+                    'last_message': last_message(chat['id'], user_id)
+                }
+            ),
+            conflict='replace'
+        )
+    ).run(conn)
+    summaries = r.table(SUMMARIES_TABLE)
+    if chat_id is not None:
+        summaries = summaries.get_all(chat_id, index='chat_id')
+    deleted = summaries.filter(
+        lambda summary: r.table('chats').get(summary['chat_id'])['user_ids'].contains(
+            summary['user_id']).not_().default(True)
+    ).delete().run(conn)
+    return {
+        'written': written.get('inserted', 0) + written.get('replaced', 0) + written.get('unchanged', 0),
+        'deleted': deleted.get('deleted', 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild chat summaries')
+    parser.add_argument('--chat', default=None, help='only this chat')
+    args = parser.parse_args()
+    with db_connection() as conn:
+        stats = rebuild(conn, args.chat)
+    print(f"{stats['written']} summaries written, {stats['deleted']} stale removed")
+
+
+if __name__ == '__main__':
+    main()
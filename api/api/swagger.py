@@ -0,0 +1,75 @@
+# The swagger schema of the API is built once, by `python -m api.swagger`
+# when the image is built, instead of by every worker on its first docs
+# request. Workers load the file from SWAGGER_SCHEMA_FILE and serve it from
+# memory; without it the schema is built on the first request as before.
+#
+#   python -m api.swagger                  updates swagger_docs/v1.0.json
+#   python -m api.swagger --optional --output /var/cache/api/swagger.json
+import argparse
+import json
+import logging
+import os
+
+from flask import Flask
+
+logger = logging.getLogger(__name__)
+
+SWAGGER_CONFIG = {
+    'schema_file': os.environ.get('SWAGGER_SCHEMA_FILE', ''),
+}
+
+DEFAULT_SCHEMA_FILE = os.path.join(
+    os.path.dirname(__file__), '..', 'swagger_docs', 'v1.0.json')
+
+
+def build_schema() -> dict:
+    # Needs neither the database nor the app's configuration
+    from api.apis import v1_0
+    app = Flask(__name__)
+    app.register_blueprint(v1_0.api_bp, url_prefix='/api/v1.0')
+    with app.test_request_context():
+        schema = v1_0.api.__schema__
+    if 'error' in schema:
+        raise RuntimeError(schema['error'])
+    return schema
+
+
+def load_schema(api, path: str = None) -> bool:
+    path = path if path is not None else SWAGGER_CONFIG['schema_file']
+    if not path:
+        return False
+    try:
+        with open(path) as f:
+            schema = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning('Can not load the swagger schema from %s, it is built on demand: %s', path, e)
+        return False
+    if 'paths' not in schema:
+        logger.warning('%s is not a swagger schema, it is built on demand', path)
+        return False
+    # flask_restplus only builds `__schema__` while `_schema` is empty
+    api._schema = schema
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the swagger schema of the API')
+    parser.add_argument('--output', default=DEFAULT_SCHEMA_FILE)
+    parser.add_argument('--optional', action='store_true',
+                        help='write nothing instead of failing when the schema can not be built')
+    args = parser.parse_args()
+    try:
+        schema = build_schema()
+    except Exception as e:
+        if not args.optional:
+            raise
+        # Workers find no file and build the schema on their first docs request
+        logger.warning('Can not build the swagger schema, %s is not written: %s', args.output, e)
+        return
+    with open(args.output, 'w') as f:
+        json.dump(schema, f)
+    print(f"wrote {len(schema['paths'])} paths to {os.path.normpath(args.output)}")
+
+
+if __name__ == '__main__':
+    main()
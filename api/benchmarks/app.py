@@ -0,0 +1,21 @@
+import os
+
+
+def bench_app(db: str):
+    # The API reads its configuration from the environment when imported,
+    # so the benchmark database has to be set before the first `api` import.
+    os.environ['RDB_DB'] = db
+    os.environ.setdefault('RDB_HOST', 'localhost')
+    os.environ.setdefault('RDB_PORT', '28015')
+    os.environ.setdefault('BUNDLE_API_ERRORS', '1')
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+
+    from api import init_app
+    return init_app()
+
+
+def auth_headers(app, user_id: str) -> dict:
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        token = create_access_token(user_id)
+    return {'Authorization': f'Bearer {token}'}
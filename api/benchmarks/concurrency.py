@@ -0,0 +1,117 @@
+# Concurrent connections one worker holds, the gunicorn sync worker against
+# the asyncio server (api.aio). Every level opens that many event streams,
+# counts those answered with 'ready' in time, and while they are held times
+# chat list requests. Start one worker of each mode against the same database:
+#
+#   gunicorn --workers 1 --threads 16 --bind 127.0.0.1:5001 'api:init_app()'
+#   gunicorn --workers 1 --bind 127.0.0.1:5002 --worker-class aiohttp.GunicornWebWorker 'api.aio:create_app()'
+#   python -m benchmarks.concurrency --url sync=http://127.0.0.1:5001 --url aio=http://127.0.0.1:5002 \
+#       --username ivan_ivanov --password Qwerty123 --connections 10 100 1000 5000
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+from benchmarks.run import percentile
+
+BASE = '/api/v1.0'
+
+
+async def login(session, url, username, password) -> str:
+    async with session.post(f'{url}{BASE}/auth/', json={'username': username, 'password': password}) as res:
+        res.raise_for_status()
+        return (await res.json())['access_token']['token']
+
+
+async def hold_stream(session, url, token, ready: asyncio.Event, release: asyncio.Event) -> bool:
+    # True once the stream sent 'ready', then kept open until released
+    try:
+        async with session.get(f'{url}{BASE}/events/', params={'jwt': token}) as res:
+            if res.status != 200:
+                return False
+            async for line in res.content:
+                if line.startswith(b'event: ready'):
+                    ready.set()
+                    await release.wait()
+                    return True
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    return False
+
+
+async def measure(url, token, connections, requests, timeout) -> dict:
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        release = asyncio.Event()
+        readies = [asyncio.Event() for _ in range(connections)]
+        streams = [asyncio.ensure_future(hold_stream(session, url, token, ready, release))
+                   for ready in readies]
+        started = time.perf_counter()
+        deadline = started + timeout
+        while time.perf_counter() < deadline and not all(ready.is_set() for ready in readies):
+            await asyncio.sleep(0.05)
+        held = sum(ready.is_set() for ready in readies)
+        open_seconds = time.perf_counter() - started
+
+        timings, errors = [], 0
+        headers = {'Authorization': f'Bearer {token}'}
+        for _ in range(requests):
+            started = time.perf_counter()
+            try:
+                async with session.get(f'{url}{BASE}/chats/', headers=headers,
+                                       timeout=aiohttp.ClientTimeout(total=timeout)) as res:
+                    await res.read()
+                    errors += res.status >= 400
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+            timings.append(time.perf_counter() - started)
+
+        release.set()
+        for stream in streams:
+            stream.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
+    timings.sort()
+    ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+    return {
+        'connections': connections,
+        'held': held,
+        'open_s': round(open_seconds, 2),
+        'errors': errors,
+        'p50_ms': ms(percentile(timings, 50)),
+        'p99_ms': ms(percentile(timings, 99)),
+    }
+
+
+async def run(args):
+    urls = dict(url.split('=', 1) for url in args.url)
+    rows = []
+    for name, url in urls.items():
+        async with aiohttp.ClientSession() as session:
+            token = await login(session, url, args.username, args.password)
+        for connections in args.connections:
+            row = await measure(url, token, connections, args.requests, args.timeout)
+            rows.append(dict(row, mode=name))
+            print(f"{name:<6} {row['connections']:>6} streams  held {row['held']:>6} "
+                  f"in {row['open_s']:>6.2f}s  chats p50 {row['p50_ms']}ms  p99 {row['p99_ms']}ms  "
+                  f"errors {row['errors']}", flush=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare held connections per worker')
+    parser.add_argument('--url', action='append', required=True,
+                        help='name=base url of a server with one worker, repeatable')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--requests', type=int, default=50,
+                        help='chat list requests timed while the streams are held')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='seconds for the streams to open and per request')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
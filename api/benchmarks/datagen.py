@@ -0,0 +1,192 @@
+# Fills a database with synthetic users, chats, messages and values shaped
+# like the documents of the checked-in dump, or with the dump itself scaled
+# up N times.
+#
+#   python -m benchmarks.datagen --db pied_piperline_bench --users 10000 --chats 1000
+#   python -m benchmarks.datagen --db pied_piperline_bench --from-dump --scale 100
+import argparse
+import random
+import time
+import uuid
+
+from rethinkdb import r
+
+from api.deliveries import DELIVERIES_TABLE, delivery_id, drop_legacy, migrate_table
+from benchmarks.dump import find_dump, read_dump, scale_dump
+
+WORDS = ('hello', 'world', 'pipeline', 'filter', 'message', 'chat', 'piper',
+         'compression', 'middle', 'out', 'weissman', 'score', 'hooli', 'nucleus')
+
+
+def _insert(conn, table, docs, batch_size):
+    for start in range(0, len(docs), batch_size):
+        r.table(table).insert(docs[start:start + batch_size]).run(conn, durability='soft')
+
+
+def stub_filters(dump_filters, filter_url: str):
+    # The dump's filter catalog, pointed at a stub filter service
+    filters = []
+    for f in dump_filters:
+        f = dict(f)
+        f['external_url'] = f"{filter_url.rstrip('/')}/{f['id']}"
+        filters.append(f)
+    return filters
+
+
+def generate(conn, users=1000, chats=100, members=10, messages=50,
+             default_filters=0.1, shared_chat=True, filter_url='http://127.0.0.1:9999',
+             dump=None, batch_size=1000, seed=0) -> dict:
+    rng = random.Random(seed)
+    filters = stub_filters(read_dump(find_dump(dump))['filters'], filter_url)
+    text_filter_ids = [f['id'] for f in filters if f['input_type'] == 'text']
+    _insert(conn, 'filters', filters, batch_size)
+
+    user_docs = [{
+        'id': str(uuid.uuid4()),
+        'username': f'user{i}',
+        'name': f'User {i}',
+        'password': 'password',
+        'avatar': None,
+        'added_filter_ids': text_filter_ids,
+        'filter_ids_by_type': {'text': text_filter_ids} if text_filter_ids else {},
+        'default_filter_ids': rng.sample(text_filter_ids, 1)
+        if text_filter_ids and rng.random() < default_filters else [],
+    } for i in range(users)]
+    _insert(conn, 'users', user_docs, batch_size)
+    user_ids = [u['id'] for u in user_docs]
+
+    chat_docs = [{
+        'id': str(uuid.uuid4()),
+        'name': f'Chat {i}',
+        'user_ids': rng.sample(user_ids, min(members, len(user_ids))),
+        'default_filter_ids': [],
+    } for i in range(chats)]
+    if shared_chat:
+        chat_docs.append({
+            'id': str(uuid.uuid4()),
+            'name': 'Shared Chat',
+            'user_ids': list(user_ids),
+            'default_filter_ids': [],
+        })
+    _insert(conn, 'chats', chat_docs, batch_size)
+
+    now = time.time()
+    message_count = 0
+    values, messages_docs, deliveries = [], [], []
+    for chat in chat_docs:
+        if chat['name'] == 'Shared Chat':
+            continue
+        for k in range(messages):
+            value_id = str(uuid.uuid4())
+            values.append({
+                'id': value_id,
+                'type': 'text',
+                'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))),
+            })
+            message_id = str(uuid.uuid4())
+            created_at = r.epoch_time(now - (messages - k) * 60)
+            messages_docs.append({
+                'id': message_id,
+                'chat_id': chat['id'],
+                'sender_id': rng.choice(chat['user_ids']),
+                'created_at': created_at,
+                'value_ids': [value_id],
+                'filter_ids': [],
+                'filters_pending': False,
+            })
+            for receiver_id in chat['user_ids']:
+                deliveries.append({
+                    'id': delivery_id(message_id, receiver_id),
+                    'message_id': message_id,
+                    'chat_id': chat['id'],
+                    'receiver_id': receiver_id,
+                    'created_at': created_at,
+                    'version': 0,
+                })
+            if len(deliveries) >= batch_size:
+                _insert(conn, 'values', values, batch_size)
+                _insert(conn, 'messages', messages_docs, batch_size)
+                _insert(conn, DELIVERIES_TABLE, deliveries, batch_size)
+                message_count += len(messages_docs)
+                values, messages_docs, deliveries = [], [], []
+    _insert(conn, 'values', values, batch_size)
+    _insert(conn, 'messages', messages_docs, batch_size)
+    _insert(conn, DELIVERIES_TABLE, deliveries, batch_size)
+    message_count += len(messages_docs)
+    return {
+        'users': len(user_docs),
+        'chats': len(chat_docs),
+        'messages': message_count,
+        'deliveries': message_count * min(members, len(user_ids)),
+        'filters': len(filters),
+    }
+
+
+def load_scaled_dump(conn, scale: int, filter_url: str, dump=None, batch_size=1000) -> dict:
+    tables = scale_dump(read_dump(find_dump(dump)), scale)
+    tables['filters'] = stub_filters(tables['filters'], filter_url)
+    for table, docs in tables.items():
+        _insert(conn, table, docs, batch_size)
+    # The dump has a message row per receiver
+    migrated = migrate_table(conn, 'messages', DELIVERIES_TABLE, batch_size)
+    drop_legacy(conn)
+    return dict({table: len(docs) for table, docs in tables.items()}, **migrated)
+
+
+def prepare(conn, db: str, drop: bool = True):
+    from api.schema import ensure_schema
+    if drop and db in r.db_list().run(conn):
+        r.db_drop(db).run(conn)
+    ensure_schema(conn, db)
+
+
+def finalize(conn):
+    from api.summaries import rebuild
+    rebuild(conn)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--members', type=int, default=10, help='users per chat')
+    parser.add_argument('--messages', type=int, default=50, help='messages per chat')
+    parser.add_argument('--default-filters', type=float, default=0.1,
+                        help='share of users with a default filter')
+    parser.add_argument('--no-shared-chat', action='store_true')
+    parser.add_argument('--from-dump', action='store_true',
+                        help='load the dump scaled --scale times instead')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--dump', default=None)
+    parser.add_argument('--filter-url', default='http://127.0.0.1:9999')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def populate(conn, args) -> dict:
+    if args.from_dump:
+        stats = load_scaled_dump(conn, args.scale, args.filter_url, args.dump, args.batch_size)
+    else:
+        stats = generate(conn, args.users, args.chats, args.members, args.messages,
+                         args.default_filters, not args.no_shared_chat, args.filter_url,
+                         args.dump, args.batch_size, args.seed)
+    finalize(conn)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a benchmark dataset')
+    parser.add_argument('--db', default='pied_piperline_bench')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    from benchmarks.app import bench_app
+    bench_app(args.db)
+    from api.db import db_connection
+    with db_connection() as conn:
+        prepare(conn, args.db)
+        stats = populate(conn, args)
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import glob
+import json
+import os
+import tarfile
+import uuid
+
+from rethinkdb import r
+
+DEFAULT_DUMP = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'rethinkdb_dump_*.tar.gz')
+
+# Fields holding ids of other documents, per table
+ID_FIELDS = {
+    'chats': ['id', 'user_ids'],
+    'messages': ['id', 'message_id', 'chat_id', 'sender_id', 'receiver_id', 'value_ids'],
+    'users': ['id'],
+    'values': ['id'],
+    'filters': [],
+}
+
+
+def find_dump(path: str = None) -> str:
+    matches = sorted(glob.glob(path or DEFAULT_DUMP))
+    if not matches:
+        raise FileNotFoundError(path or DEFAULT_DUMP)
+    return matches[-1]
+
+
+def read_dump(path: str) -> dict:
+    tables = {}
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            name = os.path.basename(member.name)
+            if not name.endswith('.json'):
+                continue
+            tables[name[:-len('.json')]] = json.load(tar.extractfile(member))
+    return tables
+
+
+def _scaled_id(value, copy: int):
+    if copy == 0 or value is None:
+        return value
+    if isinstance(value, list):
+        return [_scaled_id(v, copy) for v in value]
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f'{value}:{copy}'))
+
+
+def scale_dump(tables: dict, scale: int) -> dict:
+    # Every copy gets its own users, chats, messages and values, so the
+    # per-user working set stays the same while the tables grow `scale` times.
+    # Filters are a shared catalog and are never copied.
+    scaled = {}
+    for table, docs in tables.items():
+        copies = range(scale) if ID_FIELDS.get(table) else range(1)
+        scaled[table] = []
+        for copy in copies:
+            for doc in docs:
+                doc = dict(doc)
+                for field in ID_FIELDS.get(table, []):
+                    if field in doc:
+                        doc[field] = _scaled_id(doc[field], copy)
+                if table == 'users' and copy:
+                    doc['username'] = f"{doc['username']}_{copy}"
+                scaled[table].append(doc)
+    return scaled
+
+
+def load_tables(conn: r.Connection, db: str, tables: dict, batch_size: int = 1000):
+    if db in r.db_list().run(conn):
+        r.db_drop(db).run(conn)
+    r.db_create(db).run(conn)
+    for table, docs in tables.items():
+        r.db(db).table_create(table).run(conn)
+        for start in range(0, len(docs), batch_size):
+            r.db(db).table(table).insert(
+                docs[start:start + batch_size]).run(conn, durability='soft')
@@ -0,0 +1,130 @@
+# Sends messages to one big chat through POST /chats/<chat_id>/messages and,
+# for comparison, through the former per-participant write loop.
+#
+#   python -m benchmarks.fanout --members 1000 --filters 3
+import argparse
+import statistics
+import time
+import uuid
+
+from benchmarks.app import auth_headers, bench_app
+from benchmarks.stub_filter import start_stub_filter, stub_url
+
+
+def populate(conn, r, members: int, filters: int, server):
+    filter_ids = [str(uuid.uuid4()) for _ in range(filters)]
+    r.table('filters').insert([{
+        'id': filter_id,
+        'name': f'stub {i}',
+        'external_url': stub_url(server, f'/f{i}'),
+        'input_type': 'text',
+        'output_type': 'text',
+        'is_pipeline': False,
+        'filter_ids': [],
+    } for i, filter_id in enumerate(filter_ids)]).run(conn)
+    user_ids = [str(uuid.uuid4()) for _ in range(members)]
+    for start in range(0, members, 1000):
+        r.table('users').insert([{
+            'id': user_id,
+            'username': f'member_{start + i}',
+            'name': f'Member {start + i}',
+            'password': 'benchmark',
+            'avatar': None,
+            'added_filter_ids': filter_ids,
+            'default_filter_ids': filter_ids,
+        } for i, user_id in enumerate(user_ids[start:start + 1000])]).run(conn)
+    chat_id = r.table('chats').insert({
+        'name': 'Benchmark Chat',
+        'user_ids': user_ids,
+        'default_filter_ids': [],
+    }).run(conn)['generated_keys'][0]
+    return chat_id, user_ids
+
+
+def legacy_send(conn, r, chat_id, user_id, value, executor):
+    # The per-participant loop the endpoint used before batching
+    from api import models
+    chat = models.Chat(**r.table('chats').get(chat_id).run(conn))
+    value_id = r.table('values').insert({'content': value, 'type': 'text'}).run(conn)['generated_keys'][0]
+    for current_user_id in chat.user_ids:
+        current_user = models.User(**r.table('users').get(current_user_id).run(conn))
+        message_generated_id = r.table('messages').insert({
+            'message_id': r.uuid(),
+            'chat_id': chat_id,
+            'sender_id': user_id,
+            'receiver_id': current_user.id,
+            'created_at': r.now(),
+            'value_ids': [value_id],
+            'filter_ids': list()
+        }).run(conn)['generated_keys'][0]
+        for f_id in current_user.default_filter_ids:
+            f = models.Filter(**r.table('filters').get(f_id).run(conn))
+            result = executor.run(f, value)
+            filtered_id = r.table('values').insert({'content': result, 'type': f.output_type}).run(conn)['generated_keys'][0]
+            r.table('messages').get(message_generated_id).update(
+                lambda message: {
+                    'value_ids': message['value_ids'].append(filtered_id),
+                    'filter_ids': message['filter_ids'].append(f_id)
+                }
+            ).run(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='pied_piperline_bench')
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--filters', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--legacy', action='store_true',
+                        help='also time the per-participant loop')
+    args = parser.parse_args()
+
+    app = bench_app(args.db)
+    import rethinkdb as r
+    from api.db import db_connection
+    from api.filtering import EXECUTOR
+    from api.jobs import Worker
+    from api.schema import ensure_schema
+
+    server = start_stub_filter(latency=args.latency)
+    with db_connection() as conn:
+        if args.db in r.db_list().run(conn):
+            r.db_drop(args.db).run(conn)
+        ensure_schema(conn, args.db)
+        chat_id, user_ids = populate(conn, r, args.members, args.filters, server)
+
+    client = app.test_client()
+    headers = auth_headers(app, user_ids[0])
+    worker = Worker()
+    timings, job_timings = [], []
+    for i in range(args.repeat):
+        started = time.perf_counter()
+        res = client.post(f'/api/v1.0/chats/{chat_id}/messages',
+                          json={'type': 'text', 'value': f'hello {i}'},
+                          headers=headers)
+        timings.append(time.perf_counter() - started)
+        assert res.status_code == 200, res.data
+        started = time.perf_counter()
+        worker.run_once()
+        job_timings.append(time.perf_counter() - started)
+    print(f'{args.members} members, {args.filters} default filters each')
+    print(f"batched send   median {statistics.median(timings) * 1000:9.1f}ms")
+    print(f"filter job     median {statistics.median(job_timings) * 1000:9.1f}ms")
+
+    if args.legacy:
+        timings = []
+        with db_connection() as conn:
+            for i in range(args.repeat):
+                started = time.perf_counter()
+                legacy_send(conn, r, chat_id, user_ids[0], f'hello {i}', EXECUTOR)
+                timings.append(time.perf_counter() - started)
+        print(f"legacy send    median {statistics.median(timings) * 1000:9.1f}ms")
+
+    with db_connection() as conn:
+        r.db_drop(args.db).run(conn)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
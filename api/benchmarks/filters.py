@@ -0,0 +1,77 @@
+# Compares the former one-request-per-filter loop with FilterExecutor against a
+# local stub filter service that injects latency, and concurrent calls of one
+# filter sent one by one or in batches to a service serving one request at a
+# time.
+#
+#   python -m benchmarks.filters --filters 8 --latency 0.05 --calls 32
+import argparse
+import statistics
+import time
+
+import requests
+
+from api import models
+from api.filtering import FilterExecutor
+from benchmarks.stub_filter import start_stub_filter, stub_url
+
+
+def serial_without_session(filters, value):
+    for f in filters:
+        value = requests.post(f.external_url, json={'value': value}).json()['value']
+    return value
+
+
+def concurrent_calls(executor, f, calls):
+    futures = [executor.submit(executor.run, f, f'hello {i}', None, False) for i in range(calls)]
+    return [future.result() for future in futures]
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000, max(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filters', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--slow-latency', type=float, default=2.0,
+                        help='latency of one misbehaving filter')
+    parser.add_argument('--calls', type=int, default=32,
+                        help='concurrent calls of one filter on a serial service')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    server = start_stub_filter(latency=args.latency)
+    filters = [models.Filter(external_url=stub_url(server, f'/f{i}'), id=str(i))
+               for i in range(args.filters)]
+    slow = models.Filter(external_url=stub_url(server, '/slow', latency=args.slow_latency),
+                         id='slow', timeout=args.latency * 4, retries=0)
+    executor = FilterExecutor(workers=max(args.filters + 1, args.calls))
+    serial_server = start_stub_filter(latency=args.latency, serial=True)
+    model = models.Filter(external_url=stub_url(serial_server, '/model'), id='model')
+    batched_model = models.Filter(external_url=stub_url(serial_server, '/batched'), id='batched',
+                                  batchable=True)
+
+    cases = {
+        'serial, new connection per call': lambda: serial_without_session(filters, 'hello'),
+        'chain, keep-alive session': lambda: executor.run_chain(filters, 'hello', 'text'),
+        'concurrent fan-out': lambda: executor.run_many(filters, 'hello'),
+        'fan-out with a slow filter': lambda: executor.run_many(filters + [slow], 'hello'),
+        f'{args.calls} calls, one by one': lambda: concurrent_calls(executor, model, args.calls),
+        f'{args.calls} calls, batched': lambda: concurrent_calls(executor, batched_model, args.calls),
+    }
+    print(f'{args.filters} filters, {args.latency * 1000:.0f}ms each')
+    for name, fn in cases.items():
+        median, worst = measure(fn, args.repeat)
+        print(f'{name:<34} median {median:8.1f}ms  max {worst:8.1f}ms')
+    server.shutdown()
+    serial_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Measures the hot read queries against the dump scaled up N times, migrated
+# to deliveries, with the secondary indexes from `api.schema` and with the
+# full table scans they replaced.
+#
+#   python -m benchmarks.indexes --scales 1 10 100
+import argparse
+import statistics
+import time
+
+from rethinkdb import r
+
+from api.db import rdb_config
+from api.deliveries import DELIVERIES_TABLE, delivery_id, drop_legacy, migrate_table, receiver_view
+from api.schema import ensure_schema
+from benchmarks.dump import find_dump, load_tables, read_dump, scale_dump
+
+
+def indexed_queries(user_id, username, chat_id, message_id):
+    deliveries = r.table(DELIVERIES_TABLE).between(
+        [chat_id, user_id, r.minval],
+        [chat_id, user_id, r.maxval],
+        index='chat_receiver_created_at')
+    return {
+        'chat list': r.table('chats').get_all(user_id, index='user_ids').merge(
+            lambda chat: {
+                'last_message': r.table(DELIVERIES_TABLE).between(
+                    [chat['id'], user_id, r.minval],
+                    [chat['id'], user_id, r.maxval],
+                    index='chat_receiver_created_at'
+                ).order_by(index=r.desc('chat_receiver_created_at')).limit(1).map(
+                    receiver_view).coerce_to('array')
+            }).coerce_to('array'),
+        'chat history': deliveries.order_by(index='chat_receiver_created_at').map(receiver_view).merge(
+            lambda message: {
+                'values': message['value_ids'].map(
+                    lambda value_id: r.table('values').get(value_id))
+            }).coerce_to('array'),
+        'message exists': r.table(DELIVERIES_TABLE).get(delivery_id(message_id, user_id)).ne(None),
+        'username lookup': r.table('users').get_all(
+            username, index='username').count(),
+    }
+
+
+def scan_queries(user_id, username, chat_id, message_id):
+    return {
+        'chat list': r.table('chats').filter(
+            lambda chat: chat['user_ids'].contains(user_id)
+        ).merge(
+            lambda chat: {
+                'last_message': r.table(DELIVERIES_TABLE).filter({
+                    'chat_id': chat['id'],
+                    'receiver_id': user_id,
+                }).order_by(r.desc('created_at')).limit(1).map(receiver_view).coerce_to('array')
+            }).coerce_to('array'),
+        'chat history': r.table(DELIVERIES_TABLE).filter({
+            'chat_id': chat_id,
+            'receiver_id': user_id,
+        }).order_by(r.asc('created_at')).map(receiver_view).merge(
+            lambda message: {
+                'values': r.table('values').filter(
+                    lambda value: message['value_ids'].contains(value['id'])
+                ).coerce_to('array')
+            }).coerce_to('array'),
+        'message exists': r.table(DELIVERIES_TABLE).filter({
+            'message_id': message_id,
+            'receiver_id': user_id,
+        }).count(),
+        'username lookup': r.table('users').filter({
+            'username': username
+        }).count(),
+    }
+
+
+def measure(conn, query, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        query.run(conn)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dump', default=None)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--db', default='pied_piperline_bench')
+    parser.add_argument('--no-scan', action='store_true',
+                        help='skip the unindexed baseline')
+    args = parser.parse_args()
+
+    tables = read_dump(find_dump(args.dump))
+    message = max(tables['messages'], key=lambda m: m['created_at']['epoch_time'])
+    user = next(u for u in tables['users'] if u['id'] == message['receiver_id'])
+    params = (message['receiver_id'], user['username'],
+              message['chat_id'], message['message_id'])
+
+    conn = r.connect(**dict(rdb_config(), db=args.db))
+    print(f"{'scale':>6} {'messages':>9} {'query':<16} {'indexed ms':>11} {'scan ms':>9}")
+    for scale in args.scales:
+        scaled = scale_dump(tables, scale)
+        load_tables(conn, args.db, scaled)
+        ensure_schema(conn, args.db)
+        # The dump has a message row per receiver
+        migrate_table(conn, 'messages', DELIVERIES_TABLE)
+        drop_legacy(conn)
+        indexed = indexed_queries(*params)
+        scans = scan_queries(*params)
+        for name, query in indexed.items():
+            indexed_ms = measure(conn, query, args.repeat)
+            scan_ms = '-' if args.no_scan else '%.2f' % measure(conn, scans[name], args.repeat)
+            print(f"{scale:>6} {len(scaled['messages']):>9} {name:<16} {indexed_ms:>11.2f} {scan_ms:>9}")
+    r.db_drop(args.db).run(conn)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
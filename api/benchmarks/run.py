@@ -0,0 +1,257 @@
+# Load test of every v1.0 endpoint. Generates a dataset (see benchmarks.datagen),
+# starts a stub filter service, then fires requests at each endpoint through
+# the Flask test client, or at a running server with --base-url, and reports
+# throughput and latency percentiles per endpoint as JSON.
+#
+#   python -m benchmarks.run --users 10000 --chats 1000 --requests 500 --concurrency 8 \
+#       --output bench_output.json
+import argparse
+import json
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+
+from rethinkdb import r
+
+from benchmarks import datagen
+from benchmarks.app import auth_headers, bench_app
+from benchmarks.stub_filter import start_stub_filter, stub_url
+
+
+class FlaskClient(object):
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def request(self, method, path, json=None, headers=None) -> int:
+        # Test clients are not shared between threads
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        res = client.open(path, method=method, json=json, headers=headers)
+        res.close()
+        return res.status_code
+
+
+class HttpClient(object):
+    def __init__(self, base_url):
+        import requests
+        self._requests = requests
+        self._base_url = base_url.rstrip('/')
+        self._local = threading.local()
+
+    def request(self, method, path, json=None, headers=None) -> int:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        res = session.request(method, self._base_url + path, json=json, headers=headers)
+        return res.status_code
+
+
+def load_fixture(conn, sample: int, rng: random.Random) -> dict:
+    # What the scenarios pick from: users with their chats, messages and filters
+    users = list(r.table('users').sample(sample).pluck(
+        'id', 'username', 'password', 'added_filter_ids').run(conn))
+    fixture = []
+    for user in users:
+        chat_ids = list(r.table('chats').get_all(user['id'], index='user_ids')['id'].limit(20).run(conn))
+        if not chat_ids:
+            continue
+        messages = list(r.table('deliveries').between(
+            [user['id'], r.minval], [user['id'], r.maxval], index='receiver_created_at'
+        ).order_by(index=r.desc('receiver_created_at')).limit(20)['message_id'].run(conn))
+        fixture.append(dict(user, chat_ids=chat_ids, message_ids=messages))
+    if not fixture:
+        raise RuntimeError('The dataset has no users in chats')
+    return {'users': fixture}
+
+
+def scenarios(fixture: dict, headers_for, rng: random.Random) -> dict:
+    base = '/api/v1.0'
+
+    def pick():
+        user = rng.choice(fixture['users'])
+        return user, headers_for(user['id'])
+
+    def auth():
+        user = rng.choice(fixture['users'])
+        return 'POST', f'{base}/auth/', {'username': user['username'], 'password': user['password']}, None
+
+    def chat_list():
+        user, headers = pick()
+        return 'GET', f'{base}/chats/', None, headers
+
+    def chat_history():
+        user, headers = pick()
+        return 'GET', f"{base}/chats/{rng.choice(user['chat_ids'])}/messages?limit=50", None, headers
+
+    def send():
+        user, headers = pick()
+        return ('POST', f"{base}/chats/{rng.choice(user['chat_ids'])}/messages",
+                {'type': 'text', 'value': f'benchmark {rng.random()}'}, headers)
+
+    def apply_filter():
+        user, headers = pick()
+        if not user['message_ids'] or not user['added_filter_ids']:
+            return chat_list()
+        return ('POST', f"{base}/messages/{rng.choice(user['message_ids'])}/apply_filter/"
+                        f"{rng.choice(user['added_filter_ids'])}", None, headers)
+
+    def applicable_filters():
+        user, headers = pick()
+        if not user['message_ids']:
+            return chat_list()
+        return ('GET', f"{base}/messages/{rng.choice(user['message_ids'])}/applicable_filters",
+                None, headers)
+
+    def user_search():
+        user, headers = pick()
+        return 'POST', f'{base}/users/search', {'query': user['username'][:rng.randint(1, 5)]}, headers
+
+    def filters():
+        return 'GET', f'{base}/filters/', None, None
+
+    return {
+        'auth': auth,
+        'chat list': chat_list,
+        'chat history': chat_history,
+        'send': send,
+        'apply filter': apply_filter,
+        'applicable filters': applicable_filters,
+        'user search': user_search,
+        'filters': filters,
+    }
+
+
+def percentile(sorted_timings, q):
+    if not sorted_timings:
+        return None
+    index = max(0, math.ceil(q / 100 * len(sorted_timings)) - 1)
+    return sorted_timings[index]
+
+
+def run_endpoint(client, make_request, requests: int, concurrency: int) -> dict:
+    timings, errors = [], []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def loop():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            method, path, body, headers = make_request()
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, json=body, headers=headers)
+            except Exception as e:
+                status = repr(e)
+            elapsed = time.perf_counter() - started
+            with lock:
+                timings.append(elapsed)
+                if not isinstance(status, int) or status >= 400:
+                    errors.append(status)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    timings.sort()
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        'requests': len(timings),
+        'errors': len(errors),
+        'error_statuses': sorted({str(e) for e in errors})[:10],
+        'throughput_rps': round(len(timings) / wall, 2) if wall else None,
+        'mean_ms': ms(statistics.mean(timings)) if timings else None,
+        'p50_ms': ms(percentile(timings, 50)),
+        'p95_ms': ms(percentile(timings, 95)),
+        'p99_ms': ms(percentile(timings, 99)),
+        'max_ms': ms(timings[-1]) if timings else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the v1.0 API')
+    parser.add_argument('--db', default='pied_piperline_bench')
+    parser.add_argument('--reuse', action='store_true',
+                        help='keep the existing benchmark database')
+    parser.add_argument('--base-url', default=None,
+                        help='e.g. http://127.0.0.1:8000, instead of the Flask test client')
+    parser.add_argument('--endpoints', nargs='+', default=None)
+    parser.add_argument('--requests', type=int, default=200, help='per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--filter-latency', type=float, default=0.02)
+    parser.add_argument('--filter-port', type=int, default=0)
+    parser.add_argument('--sample', type=int, default=100, help='users to act as')
+    parser.add_argument('--output', default=None, help='write the JSON report here')
+    datagen.add_arguments(parser)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    app = bench_app(args.db)
+    from api.db import db_connection
+    from api.jobs import Worker
+
+    server = start_stub_filter(args.filter_port, latency=args.filter_latency)
+    args.filter_url = stub_url(server, '')
+    with db_connection() as conn:
+        dataset = None
+        if not args.reuse:
+            datagen.prepare(conn, args.db)
+            dataset = datagen.populate(conn, args)
+        else:
+            # Filters of a reused dataset point at a previous stub service
+            r.table('filters').update(
+                lambda f: {'external_url': r.expr(args.filter_url + '/').add(f['id'])}
+            ).run(conn)
+        fixture = load_fixture(conn, args.sample, rng)
+
+    # Drain filter jobs created by sends, like the worker service would
+    worker = Worker()
+    worker_thread = threading.Thread(target=worker.run, daemon=True)
+    worker_thread.start()
+
+    headers_cache = {}
+
+    def headers_for(user_id):
+        if user_id not in headers_cache:
+            headers_cache[user_id] = auth_headers(app, user_id)
+        return headers_cache[user_id]
+
+    client = HttpClient(args.base_url) if args.base_url else FlaskClient(app)
+    cases = scenarios(fixture, headers_for, rng)
+    report = {
+        'config': {
+            'client': args.base_url or 'flask-test-client',
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'filter_latency_s': args.filter_latency,
+        },
+        'dataset': dataset,
+        'endpoints': {},
+    }
+    for name in args.endpoints or cases:
+        report['endpoints'][name] = run_endpoint(
+            client, cases[name], args.requests, args.concurrency)
+        print(f"{name:<20} {json.dumps(report['endpoints'][name])}", file=sys.stderr)
+
+    worker.stop()
+    server.shutdown()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Latency of the in-memory user search over synthetic users, no database needed.
+#
+#   python -m benchmarks.search --users 1000000 --queries 10000
+import argparse
+import random
+import statistics
+import string
+import time
+
+from api.search import UserSearchIndex
+
+FIRST_NAMES = ('Richard', 'Erlich', 'Bertram', 'Dinesh', 'Jared', 'Monica', 'Gavin',
+               'Laurie', 'Jian', 'Nelson', 'Peter', 'Russ', 'Ivan', 'Maria', 'Olga')
+LAST_NAMES = ('Hendricks', 'Bachman', 'Gilfoyle', 'Chugtai', 'Dunn', 'Hall', 'Belson',
+              'Bream', 'Yang', 'Bighetti', 'Gregory', 'Hanneman', 'Ivanov', 'Petrova')
+
+
+def synthetic_users(count, rng):
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield {
+            'id': f'{i:08d}',
+            'username': f'{first.lower()}_{last.lower()}{i}',
+            'name': f'{first} {last}',
+            'avatar': None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    index = UserSearchIndex()
+    started = time.perf_counter()
+    index.build(synthetic_users(args.users, rng))
+    print(f'built the index of {args.users} users in {time.perf_counter() - started:.1f}s')
+
+    usernames = [f'{rng.choice(FIRST_NAMES).lower()}_{rng.choice(LAST_NAMES).lower()}{rng.randrange(args.users)}'
+                 for _ in range(args.queries)]
+    kinds = {
+        # what a search box sends while the username is typed
+        'prefix': [u[:rng.randint(1, len(u))] for u in usernames],
+        'name': [rng.choice(LAST_NAMES)[:rng.randint(2, 6)] for _ in range(args.queries)],
+        'infix': [u[rng.randint(1, 4):][:rng.randint(3, 6)] for u in usernames],
+        'miss': [''.join(rng.choice(string.ascii_lowercase) for _ in range(8)) for _ in range(args.queries)],
+    }
+    for kind, queries in kinds.items():
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            index.search(query, args.limit)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f'{kind:<8} median {statistics.median(timings) * 1000:.3f}ms  '
+              f'p99 {timings[int(len(timings) * 0.99)] * 1000:.3f}ms  '
+              f'max {timings[-1] * 1000:.3f}ms')
+
+    started = time.perf_counter()
+    index.add({'id': 'new', 'username': 'new_user', 'name': 'New User', 'avatar': None})
+    print(f'adding a user took {(time.perf_counter() - started) * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
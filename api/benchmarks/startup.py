@@ -0,0 +1,98 @@
+# Cold start of a worker, what every gunicorn (re)start and every new
+# autoscaled instance pays: importing the app, creating it, and its first
+# requests, each run in a fresh interpreter. No database is needed. Runs with
+# the swagger schema built on the first docs request and with it loaded from
+# a file written by `python -m api.swagger`.
+#
+#   python -m benchmarks.startup --runs 10 --importtime 15
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = '''
+import json, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+app = api.init_app()
+created = time.perf_counter()
+client = app.test_client()
+statuses = []
+timings = {'import_ms': imported - started, 'init_app_ms': created - imported}
+for name, path in (('first_swagger_ms', '/api/v1.0/swagger.json'),
+                   ('second_swagger_ms', '/api/v1.0/swagger.json'),
+                   ('first_docs_ms', '/api/v1.0/doc/')):
+    request_started = time.perf_counter()
+    statuses.append(client.get(path).status_code)
+    timings[name] = time.perf_counter() - request_started
+timings['total_ms'] = time.perf_counter() - started
+print(json.dumps({'timings': {k: v * 1000 for k, v in timings.items()}, 'statuses': statuses}))
+'''
+
+
+def child_env(schema_file: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault('RDB_HOST', 'localhost')
+    env.setdefault('RDB_PORT', '28015')
+    env.setdefault('RDB_DB', 'pied_piperline')
+    env.setdefault('BUNDLE_API_ERRORS', '1')
+    env.setdefault('JWT_SECRET_KEY', 'benchmark')
+    env['SWAGGER_SCHEMA_FILE'] = schema_file
+    return env
+
+
+def run_once(env: dict) -> dict:
+    out = subprocess.run([sys.executable, '-c', CHILD], env=env, check=True,
+                         stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(__file__)))
+    return json.loads(out.stdout.decode())
+
+
+def slowest_imports(env: dict, count: int) -> list:
+    # -X importtime lines: 'import time: self [us] | cumulative | imported package'
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import api; api.init_app()'],
+                         env=env, check=True, stderr=subprocess.PIPE,
+                         cwd=os.path.dirname(os.path.dirname(__file__)))
+    rows = []
+    for line in out.stderr.decode().splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        # top level packages only, their cumulative time includes the rest
+        if len(name) - len(name.lstrip()) == 1:
+            rows.append((int(parts[1]) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure worker cold starts')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', type=int, default=0,
+                        help='also list this many slowest top level imports')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        schema_file = os.path.join(tmp, 'v1.0.json')
+        subprocess.run([sys.executable, '-m', 'api.swagger', '--output', schema_file],
+                       env=child_env(''), check=True, stdout=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.dirname(__file__)))
+        for mode, path in (('built on demand', ''), ('precomputed', schema_file)):
+            env = child_env(path)
+            runs = [run_once(env) for _ in range(args.runs)]
+            statuses = {status for run in runs for status in run['statuses']}
+            print(f'{mode} (statuses {sorted(statuses)}):')
+            for phase in runs[0]['timings']:
+                timings = [run['timings'][phase] for run in runs]
+                print(f'  {phase:<18} median {statistics.median(timings):8.1f}  max {max(timings):8.1f}')
+        if args.importtime:
+            print('slowest imports (cumulative ms):')
+            for ms, name in slowest_imports(child_env(schema_file), args.importtime):
+                print(f'  {ms:8.1f}  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Write volume and history read cost of messages in a big chat, stored the
+# former way, a full message row per receiver, and as one message with a
+# delivery per receiver and overlays for receivers with a default filter.
+# Both are written like a send followed by its filter job.
+#
+#   python -m benchmarks.storage --members 100 1000 5000 --messages 100
+import argparse
+import statistics
+import time
+import uuid
+
+from rethinkdb import r
+
+from api.db import rdb_config
+from api.deliveries import (DELIVERIES_TABLE,
+                            OVERLAYS_TABLE,
+                            append_overlays,
+                            delivery_id,
+                            message_deliveries,
+                            touch)
+from api.history import messages_page, resolve_values
+from api.schema import ensure_schema
+
+LEGACY_TABLE = 'legacy_messages'
+BATCH_SIZE = 1000
+
+
+def _written(res) -> int:
+    if isinstance(res, list):
+        return sum(_written(item) for item in res)
+    return res.get('inserted', 0) + res.get('replaced', 0)
+
+
+def prepare(conn, db: str):
+    if db in r.db_list().run(conn):
+        r.db_drop(db).run(conn)
+    ensure_schema(conn, db)
+    r.table_create(LEGACY_TABLE).run(conn)
+    r.table(LEGACY_TABLE).index_create(
+        'chat_receiver_created_at',
+        lambda message: [message['chat_id'], message['receiver_id'], message['created_at']]
+    ).run(conn)
+    r.table(LEGACY_TABLE).index_create(
+        'message_receiver', lambda message: [message['message_id'], message['receiver_id']]
+    ).run(conn)
+    r.table(LEGACY_TABLE).index_wait().run(conn)
+
+
+def send_legacy(conn, chat_id, sender_id, receiver_ids, value_id, filtered) -> int:
+    message_id = str(uuid.uuid4())
+    rows = [{
+        'message_id': message_id,
+        'chat_id': chat_id,
+        'sender_id': sender_id,
+        'receiver_id': receiver_id,
+        'created_at': r.now(),
+        'value_ids': [value_id],
+        'filter_ids': [],
+        'filters_pending': bool(filtered)
+    } for receiver_id in receiver_ids]
+    written = 0
+    for start in range(0, len(rows), BATCH_SIZE):
+        written += _written(r.table(LEGACY_TABLE).insert(rows[start:start + BATCH_SIZE]).run(conn))
+    if filtered:
+        # The filter job appended to every receiver's row
+        additions = {receiver_id: [filtered['value_id']] for receiver_id in filtered['receiver_ids']}
+        written += _written(r.table(LEGACY_TABLE).between(
+            [message_id, r.minval], [message_id, r.maxval], index='message_receiver'
+        ).update(
+            lambda message: {
+                'value_ids': message['value_ids'].add(
+                    r.expr(additions)[message['receiver_id']].default([])),
+                'filter_ids': message['filter_ids'].add(
+                    r.branch(r.expr(additions).has_fields(message['receiver_id']),
+                             [filtered['filter_id']], [])),
+                'filters_pending': False
+            }
+        ).run(conn))
+    return written
+
+
+def send(conn, chat_id, sender_id, receiver_ids, value_id, filtered) -> int:
+    message_id = str(uuid.uuid4())
+    deliveries = [{
+        'id': delivery_id(message_id, receiver_id),
+        'message_id': message_id,
+        'chat_id': chat_id,
+        'receiver_id': receiver_id,
+        'created_at': r.now(),
+        'version': 0
+    } for receiver_id in receiver_ids]
+    written = _written(r.table('messages').insert({
+        'id': message_id,
+        'chat_id': chat_id,
+        'sender_id': sender_id,
+        'created_at': r.now(),
+        'value_ids': [value_id],
+        'filter_ids': [],
+        'filters_pending': bool(filtered)
+    }).run(conn))
+    for start in range(0, len(deliveries), BATCH_SIZE):
+        written += _written(r.table(DELIVERIES_TABLE).insert(deliveries[start:start + BATCH_SIZE]).run(conn))
+    if filtered:
+        # What api.jobs.process writes
+        written += _written(r.expr([
+            r.table('messages').get(message_id).update({'filters_pending': False}),
+            append_overlays([{
+                'id': delivery_id(message_id, receiver_id),
+                'message_id': message_id,
+                'receiver_id': receiver_id,
+                'value_ids': [filtered['value_id']],
+                'filter_ids': [filtered['filter_id']]
+            } for receiver_id in filtered['receiver_ids']]),
+            touch(message_deliveries(message_id))
+        ]).run(conn))
+    return written
+
+
+def legacy_page(conn, chat_id, receiver_id, limit):
+    messages = list(r.table(LEGACY_TABLE).between(
+        [chat_id, receiver_id, r.minval], [chat_id, receiver_id, r.maxval],
+        index='chat_receiver_created_at'
+    ).order_by(index=r.desc('chat_receiver_created_at')).limit(limit + 1).pluck(
+        'message_id', 'sender_id', 'created_at', 'value_ids', 'filter_ids', 'filters_pending'
+    ).run(conn))
+    return resolve_values(conn, messages[:limit])
+
+
+def data_bytes(conn, db: str, tables: list) -> int:
+    # What the tables take on disk, garbage and preallocation left out
+    for table in tables:
+        r.db(db).table(table).sync().run(conn)
+    return r.db('rethinkdb').table('stats').filter(
+        lambda stats: stats['id'][0].eq('table_server').and_(
+            stats['db'].eq(db)).and_(r.expr(tables).contains(stats['table']))
+    )['storage_engine']['disk']['space_usage']['data_bytes'].sum().run(conn)
+
+
+def measure(conn, db: str, members: int, messages: int, filtered_share: float,
+            page_size: int, repeat: int) -> dict:
+    prepare(conn, db)
+    chat_id = str(uuid.uuid4())
+    receiver_ids = [str(uuid.uuid4()) for _ in range(members)]
+    value_id = r.table('values').insert({'type': 'text', 'content': 'hello'}).run(conn)['generated_keys'][0]
+    filtered = None
+    if filtered_share:
+        filtered = {
+            'filter_id': str(uuid.uuid4()),
+            'value_id': r.table('values').insert(
+                {'type': 'text', 'content': 'HELLO'}).run(conn)['generated_keys'][0],
+            'receiver_ids': receiver_ids[:int(members * filtered_share)]
+        }
+
+    results = {}
+    for name, write, tables in (
+            ('per receiver', send_legacy, [LEGACY_TABLE]),
+            ('deliveries', send, ['messages', DELIVERIES_TABLE, OVERLAYS_TABLE])):
+        timings, written = [], 0
+        for _ in range(messages):
+            started = time.perf_counter()
+            written += write(conn, chat_id, receiver_ids[0], receiver_ids, value_id, filtered)
+            timings.append(time.perf_counter() - started)
+        results[name] = {
+            'send ms': statistics.median(timings) * 1000,
+            'docs/message': written / messages,
+            'MB on disk': data_bytes(conn, db, tables) / 2 ** 20,
+        }
+
+    for name, read in (('per receiver', legacy_page),
+                       ('deliveries', lambda conn, chat_id, receiver_id, limit:
+                        messages_page(conn, chat_id, receiver_id, limit=limit))):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            read(conn, chat_id, receiver_ids[-1], page_size)
+            timings.append(time.perf_counter() - started)
+        results[name]['page ms'] = statistics.median(timings) * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per receiver message rows with deliveries')
+    parser.add_argument('--db', default='pied_piperline_bench')
+    parser.add_argument('--members', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--messages', type=int, default=100, help='messages sent per layout')
+    parser.add_argument('--filtered', type=float, default=0.1,
+                        help='share of members with a default filter')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    conn = r.connect(**dict(rdb_config(), db=args.db))
+    columns = ('send ms', 'docs/message', 'MB on disk', 'page ms')
+    print(f"{'members':>8} {'layout':<13}" + ''.join(f'{column:>14}' for column in columns))
+    for members in args.members:
+        results = measure(conn, args.db, members, args.messages, args.filtered,
+                          args.page_size, args.repeat)
+        for layout, result in results.items():
+            print(f'{members:>8} {layout:<13}' + ''.join(f'{result[column]:>14.2f}' for column in columns))
+    r.db_drop(args.db).run(conn)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# A local filter service for benchmarks. Every POST echoes `{'value': ...}`
+# back after an injected delay; the delay and the failure rate can be set
+# for the whole server and overridden per request with the `latency` and
+# `error_rate` query parameters, e.g. http://127.0.0.1:9999/slow?latency=0.5
+# A batch, `{'values': [...]}`, takes as long as a single value. With
+# `--serial` one request is served at a time, like a model on one GPU.
+#
+#   python -m benchmarks.stub_filter --port 9999 --latency 0.1
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubFilterHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _option(self, query, name):
+        if name in query:
+            return float(query[name][0])
+        return getattr(self.server, name)
+
+    def do_POST(self):
+        query = parse_qs(urlsplit(self.path).query)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with self.server.serial:
+            time.sleep(self._option(query, 'latency'))
+        if random.random() < self._option(query, 'error_rate'):
+            self._reply(500, {'error': 'injected failure'})
+            return
+        if 'values' in body:
+            self._reply(200, {'values': body['values']})
+        else:
+            self._reply(200, {'value': body['value']})
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Concurrent(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+def start_stub_filter(port: int = 0, latency: float = 0.0,
+                      error_rate: float = 0.0, serial: bool = False) -> HTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubFilterHandler)
+    server.latency = latency
+    server.error_rate = error_rate
+    server.serial = threading.Lock() if serial else _Concurrent()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stub_url(server: HTTPServer, path: str = '/filter', **query) -> str:
+    host, port = server.server_address[:2]
+    params = '&'.join(f'{k}={v}' for k, v in query.items())
+    return f'http://{host}:{port}{path}' + (f'?{params}' if params else '')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--serial', action='store_true', help='serve one request at a time')
+    args = parser.parse_args()
+    server = start_stub_filter(args.port, args.latency, args.error_rate, args.serial)
+    print(f'stub filter listening on {stub_url(server)}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def app():
+    # The app registers its blueprint once, every test shares it
+    os.environ.setdefault('BUNDLE_API_ERRORS', 'true')
+    os.environ.setdefault('JWT_SECRET_KEY', 'test')
+    from api import init_app
+    return init_app()
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # time.monotonic() answers clock.now, tests move it forward
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
@@ -0,0 +1,12 @@
+import pytest
+from werkzeug.exceptions import NotFound
+
+from api.apis.v1_0.messsages import apply_filter_steps
+
+
+def test_message_gone_is_not_found():
+    # Neither delivered nor archived by the time the handler reads it
+    steps = apply_filter_steps('message', 'filter', 'user')
+    next(steps)
+    with pytest.raises(NotFound):
+        steps.send(None)
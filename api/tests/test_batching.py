@@ -0,0 +1,81 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from api import models
+from api.filtering import FilterError, FilterExecutor
+
+UPPER = models.Filter(external_url='http://upper', id='upper', batchable=True)
+
+
+class Executor(FilterExecutor):
+    # Answers like a service taking {'values': [...]}, without HTTP
+    def __init__(self, fail=False, **config):
+        super().__init__(retries=0, **config)
+        self.fail = fail
+        self.batches = []
+        self.singles = []
+        self._calls_lock = threading.Lock()
+
+    def _post(self, f, url, value, timeout):
+        with self._calls_lock:
+            self.singles.append(value)
+        return value.upper()
+
+    def _post_batch(self, f, url, values, timeout):
+        with self._calls_lock:
+            self.batches.append(list(values))
+        if self.fail:
+            raise FilterError(f, 'HTTP 400')
+        return [value.upper() for value in values]
+
+
+def run_concurrently(executor, f, values):
+    # Every call is waiting on the batch of the first before it goes out
+    with ThreadPoolExecutor(max_workers=len(values)) as pool:
+        futures = [pool.submit(executor.run, f, value) for value in values]
+        return [future.exception() or future.result() for future in futures]
+
+
+def test_concurrent_calls_share_a_request():
+    executor = Executor(batch_window=0.5)
+    values = [f'value {i}' for i in range(8)]
+    assert run_concurrently(executor, UPPER, values) == [value.upper() for value in values]
+    assert len(executor.batches) == 1
+    assert sorted(executor.batches[0]) == values
+    assert executor.singles == []
+
+
+def test_full_batches_go_out_right_away():
+    executor = Executor(batch_window=5, max_batch_size=4)
+    values = [f'value {i}' for i in range(8)]
+    assert run_concurrently(executor, UPPER, values) == [value.upper() for value in values]
+    assert sorted(len(batch) for batch in executor.batches) == [4, 4]
+
+
+def test_filter_batch_size_takes_precedence():
+    executor = Executor(batch_window=5, max_batch_size=32)
+    f = models.Filter(external_url='http://upper', id='upper', batchable=True, max_batch_size=2)
+    run_concurrently(executor, f, ['a', 'b', 'c', 'd'])
+    assert [len(batch) for batch in executor.batches] == [2, 2]
+
+
+def test_batch_error_fails_every_call():
+    executor = Executor(fail=True, batch_window=0.5)
+    results = run_concurrently(executor, UPPER, ['a', 'b', 'c'])
+    assert len(executor.batches) == 1
+    assert all(isinstance(result, FilterError) for result in results)
+
+
+def test_other_filters_are_not_batched():
+    executor = Executor(batch_window=0.5)
+    single = models.Filter(external_url='http://upper', id='single')
+    assert run_concurrently(executor, single, ['a', 'b']) == ['A', 'B']
+    assert executor.batches == []
+    assert sorted(executor.singles) == ['a', 'b']
+
+
+def test_lone_call_waits_the_window_only():
+    executor = Executor(batch_window=0.01)
+    assert executor.run(UPPER, 'a') == 'A'
+    assert executor.batches == [['a']]
+    assert executor._batches == {}
@@ -0,0 +1,51 @@
+import io
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from api.apis.v1_0 import chats
+from api.blobs import BlobStore, is_blob
+
+DIGEST = 'ab' * 32
+
+
+@pytest.mark.parametrize('digest', [
+    '/proc/self/environ',
+    '../' * 10 + 'etc/passwd',
+    'AB' * 32,
+    DIGEST + '/..',
+    None,
+])
+def test_path_takes_digests_only(tmp_path, digest):
+    store = BlobStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.path(digest)
+    with pytest.raises(ValueError):
+        store.open(digest)
+    assert not store.delete(digest)
+    assert not is_blob({'blob': digest, 'mime_type': 'text/plain'})
+
+
+def test_stored_blob_round_trip(tmp_path):
+    store = BlobStore(str(tmp_path))
+    blob = store.put_stream(io.BytesIO(b'content'), 'text/plain')
+    assert is_blob(blob)
+    assert store.path(blob['blob']).startswith(str(tmp_path))
+    with store.open(blob['blob']) as f:
+        assert f.read() == b'content'
+    assert store.delete(blob['blob'])
+
+
+def test_json_value_can_not_refer_to_a_file(app, monkeypatch):
+    monkeypatch.setattr(chats.ACCESS, 'chat_membership', lambda chat_id, user_id: True)
+
+    def no_database():
+        raise AssertionError('the request is refused before the database is used')
+    monkeypatch.setattr(chats, 'db_connection', no_database)
+    with app.test_request_context():
+        token = create_access_token('user')
+    response = app.test_client().post(
+        '/api/v1.0/chats/chat/messages',
+        headers={'Authorization': f'Bearer {token}'},
+        json={'type': 'image', 'value': {'blob': '/proc/self/environ', 'mime_type': 'text/plain'}})
+    assert response.status_code == 400
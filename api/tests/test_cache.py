@@ -0,0 +1,58 @@
+from api.cache import LRUCache, MISSING
+
+
+def test_least_recently_used_is_evicted():
+    lru = LRUCache(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert lru.get('b') is MISSING
+    assert lru.get('a') == 1 and lru.get('c') == 3
+    assert lru.metrics()['evictions'] == 1
+    assert lru.metrics()['size'] == 2
+
+
+def test_missing_key_returns_default():
+    lru = LRUCache()
+    assert lru.get('a') is MISSING
+    assert lru.get('a', None) is None
+    assert lru.metrics()['misses'] == 2
+
+
+def test_entries_expire(clock):
+    lru = LRUCache(ttl=10)
+    lru.put('a', 1)
+    lru.put('b', 2, ttl=30)
+    clock.now += 10
+    assert lru.get('a') is MISSING
+    assert lru.get('b') == 2
+    clock.now += 20
+    assert lru.get('b') is MISSING
+    assert lru.metrics()['expirations'] == 2
+
+
+def test_put_replaces_and_refreshes():
+    lru = LRUCache(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    lru.put('a', 3)
+    lru.put('c', 4)
+    assert lru.get('a') == 3
+    assert lru.get('b') is MISSING
+
+
+def test_invalidation():
+    lru = LRUCache()
+    for key in [('filter', 'f1', 'u1'), ('filter', 'f1', 'u2'), ('chat', 'c1', 'u1')]:
+        lru.put(key, True)
+    lru.invalidate(('chat', 'c1', 'u1'))
+    lru.invalidate(('chat', 'c1', 'u1'))
+    assert lru.get(('chat', 'c1', 'u1')) is MISSING
+    lru.invalidate_where(lambda key: key[1] == 'f1')
+    assert lru.metrics()['size'] == 0
+    assert lru.metrics()['invalidations'] == 3
+    lru.put('a', 1)
+    lru.clear()
+    assert lru.get('a') is MISSING
+    assert lru.metrics()['invalidations'] == 4
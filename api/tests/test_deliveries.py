@@ -0,0 +1,96 @@
+from api.deliveries import _common_prefix, delivery_id, split_legacy_rows
+
+
+def legacy_row(receiver_id, value_ids, filter_ids, created_at=1, filters_pending=False):
+    return {
+        'id': f'row-{receiver_id}',
+        'message_id': 'message',
+        'chat_id': 'chat',
+        'sender_id': 'sender',
+        'receiver_id': receiver_id,
+        'created_at': created_at,
+        'value_ids': value_ids,
+        'filter_ids': filter_ids,
+        'filters_pending': filters_pending
+    }
+
+
+def views(message, deliveries, overlays) -> dict:
+    # What api.deliveries.receiver_view puts back together
+    overlays = {overlay['id']: overlay for overlay in overlays}
+    empty = {'value_ids': [], 'filter_ids': []}
+    return {
+        delivery['receiver_id']: (
+            message['value_ids'] + overlays.get(delivery['id'], empty)['value_ids'],
+            message['filter_ids'] + overlays.get(delivery['id'], empty)['filter_ids'])
+        for delivery in deliveries
+    }
+
+
+def assert_round_trip(rows):
+    message, deliveries, overlays = split_legacy_rows(rows)
+    assert views(message, deliveries, overlays) == {
+        row['receiver_id']: (row['value_ids'], row['filter_ids']) for row in rows}
+    return message, deliveries, overlays
+
+
+def test_common_prefix():
+    assert _common_prefix([['a', 'b', 'c'], ['a', 'b'], ['a', 'b', 'd']]) == ['a', 'b']
+    assert _common_prefix([['a'], ['b']]) == []
+    assert _common_prefix([['a', 'b']]) == ['a', 'b']
+
+
+def test_unfiltered_message():
+    message, deliveries, overlays = assert_round_trip([
+        legacy_row('alice', ['raw'], [], created_at=2),
+        legacy_row('bob', ['raw'], [], created_at=1),
+    ])
+    assert message == {
+        'id': 'message',
+        'chat_id': 'chat',
+        'sender_id': 'sender',
+        'created_at': 1,
+        'value_ids': ['raw'],
+        'filter_ids': [],
+        'filters_pending': False
+    }
+    assert [delivery['id'] for delivery in deliveries] == [delivery_id('message', 'alice'),
+                                                           delivery_id('message', 'bob')]
+    assert [delivery['created_at'] for delivery in deliveries] == [2, 1]
+    assert overlays == []
+
+
+def test_chat_filter_is_shared_and_own_filters_go_to_overlays():
+    message, _, overlays = assert_round_trip([
+        legacy_row('alice', ['raw', 'chain', 'alice-1', 'alice-2'], ['chat-filter', 'f1', 'f2']),
+        legacy_row('bob', ['raw', 'chain'], ['chat-filter']),
+        legacy_row('carol', ['raw', 'chain', 'carol-1'], ['chat-filter', 'f3']),
+    ])
+    assert message['value_ids'] == ['raw', 'chain']
+    assert message['filter_ids'] == ['chat-filter']
+    assert overlays == [
+        {'id': 'message:alice', 'message_id': 'message', 'receiver_id': 'alice',
+         'value_ids': ['alice-1', 'alice-2'], 'filter_ids': ['f1', 'f2']},
+        {'id': 'message:carol', 'message_id': 'message', 'receiver_id': 'carol',
+         'value_ids': ['carol-1'], 'filter_ids': ['f3']},
+    ]
+
+
+def test_same_own_filter_for_every_receiver_stays_in_overlays():
+    # Filter ids are one behind value ids: without a shared value from it,
+    # a filter every receiver applied on their own is not the message's
+    message, _, overlays = assert_round_trip([
+        legacy_row('alice', ['raw', 'alice-1'], ['f1']),
+        legacy_row('bob', ['raw', 'bob-1'], ['f1']),
+    ])
+    assert message['value_ids'] == ['raw']
+    assert message['filter_ids'] == []
+    assert [overlay['filter_ids'] for overlay in overlays] == [['f1'], ['f1']]
+
+
+def test_pending_filters_and_rows_without_filter_ids():
+    rows = [legacy_row('alice', ['raw'], [], filters_pending=True), legacy_row('bob', ['raw'], [])]
+    del rows[1]['filter_ids']
+    message, _, overlays = split_legacy_rows(rows)
+    assert message['filters_pending'] is True
+    assert message['filter_ids'] == [] and overlays == []
@@ -0,0 +1,41 @@
+import io
+import json
+
+import pytest
+
+from api.dump import DumpError, _batches, iter_documents
+
+DOCUMENTS = '[\n{"id": "1", "tags": ["a", "b"], "nested": {"x": [1, 2]}},\n' \
+            '{"id": "2", "text": "with ] and , inside"},\n123456,\n-7.25e3,\ntrue,\nnull,\n"x"\n]'
+
+
+@pytest.mark.parametrize('read_size', range(1, 20))
+def test_documents_across_chunk_boundaries(read_size):
+    assert list(iter_documents(io.StringIO(DOCUMENTS), read_size)) == json.loads(DOCUMENTS)
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 3, 4, 1 << 20])
+def test_numbers_cut_by_a_read(read_size):
+    assert list(iter_documents(io.StringIO('[123456, 7]'), read_size)) == [123456, 7]
+    assert list(iter_documents(io.StringIO('[12.5,1e10]'), read_size)) == [12.5, 1e10]
+
+
+def test_empty_arrays():
+    assert list(iter_documents(io.StringIO('[]'))) == []
+    assert list(iter_documents(io.StringIO(' [\n] \n'), 1)) == []
+
+
+@pytest.mark.parametrize('text, error', [
+    ('{"id": 1}', 'Expected a JSON array'),
+    ('[{"id": 1},', 'not terminated'),
+    ('[{"id": 1}, {"id":', 'Invalid JSON'),
+    ('[1, nope]', 'Invalid JSON'),
+])
+def test_invalid_dumps(text, error):
+    with pytest.raises(DumpError, match=error):
+        list(iter_documents(io.StringIO(text), 4))
+
+
+def test_batches():
+    assert list(_batches(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(_batches(iter([]), 2)) == []
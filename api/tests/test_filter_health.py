@@ -0,0 +1,101 @@
+from api import models
+from api.filter_health import CLOSED, HALF_OPEN, OPEN, FilterHealth, filter_urls
+
+FILTER = models.Filter(external_url='http://a', id='f', replica_urls=['http://b', 'http://a'])
+
+
+def health(**config) -> FilterHealth:
+    config = dict({'window': 60, 'min_calls': 4, 'error_rate': 0.5, 'open_for': 30,
+                   'latency_weight': 0.5}, **config)
+    return FilterHealth(**config)
+
+
+def states(health: FilterHealth) -> dict:
+    return {url['url']: url['state'] for url in health.status(FILTER)['urls']}
+
+
+def test_filter_urls():
+    assert filter_urls(FILTER) == ['http://a', 'http://b']
+    assert filter_urls(models.Filter(external_url=None, replica_urls=['http://b'])) == ['http://b']
+
+
+def test_circuit_opens_at_the_error_rate(clock):
+    breaker = health()
+    breaker.record('http://a', 0.1, True)
+    breaker.record('http://a', 0.1, True)
+    breaker.record('http://a', 0.1, False)
+    # Not enough calls yet
+    assert states(breaker)['http://a'] == CLOSED
+    breaker.record('http://a', 0.1, False)
+    assert states(breaker)['http://a'] == OPEN
+    assert breaker.metrics() == {'trips': 1, 'rejected': 0, 'open': 1}
+
+
+def test_failures_leave_the_window(clock):
+    breaker = health()
+    for _ in range(3):
+        breaker.record('http://a', 0.1, True)
+    clock.now += 61
+    for _ in range(2):
+        breaker.record('http://a', 0.1, False)
+    breaker.record('http://a', 0.1, True)
+    breaker.record('http://a', 0.1, False)
+    assert states(breaker)['http://a'] == CLOSED
+
+
+def test_open_half_open_closed(clock):
+    breaker = health()
+    single = models.Filter(external_url='http://a', id='single')
+    for _ in range(4):
+        breaker.record('http://a', 0.1, True)
+    assert breaker.choose(single) is None
+    assert breaker.metrics()['rejected'] == 1
+
+    clock.now += 30
+    assert states(breaker)['http://a'] == HALF_OPEN
+    # One probe at a time
+    assert breaker.choose(single) == 'http://a'
+    assert breaker.choose(single) is None
+    breaker.record('http://a', 0.1, False)
+    assert states(breaker)['http://a'] == CLOSED
+    # The failures from before the circuit opened are forgotten
+    breaker.record('http://a', 0.1, True)
+    breaker.record('http://a', 0.1, True)
+    assert states(breaker)['http://a'] == CLOSED
+
+
+def test_failed_probe_opens_again(clock):
+    breaker = health()
+    for _ in range(4):
+        breaker.record('http://a', 0.1, True)
+    clock.now += 30
+    assert breaker.choose(models.Filter(external_url='http://a')) == 'http://a'
+    breaker.record('http://a', 0.1, True)
+    assert states(breaker)['http://a'] == OPEN
+    assert breaker.metrics()['trips'] == 2
+    clock.now += 29
+    assert states(breaker)['http://a'] == OPEN
+
+
+def test_choose_prefers_fast_untried_urls(clock):
+    breaker = health()
+    # A URL never called counts as fast
+    assert breaker.choose(FILTER) == 'http://a'
+    breaker.record('http://a', 0.5, False)
+    breaker.record('http://b', 0.1, False)
+    assert breaker.choose(FILTER) == 'http://b'
+    assert breaker.choose(FILTER, tried={'http://b'}) == 'http://a'
+    # The latency is an average weighted towards recent calls
+    breaker.record('http://b', 1.5, False)
+    assert breaker.choose(FILTER) == 'http://a'
+
+
+def test_open_circuits_are_skipped(clock):
+    breaker = health()
+    breaker.record('http://b', 0.01, False)
+    for _ in range(4):
+        breaker.record('http://b', 0.01, True)
+    assert breaker.choose(FILTER) == 'http://a'
+    status = breaker.status(FILTER)
+    assert status['available']
+    assert status['urls'][1]['error_rate'] == 0.8
@@ -0,0 +1,65 @@
+from rethinkdb import r
+
+from api import jobs
+from api.deliveries import delivery_id
+from api.idempotency import idempotent_id
+from tests.fakes import FakeConnection, normalized
+
+JOB = {'id': 'message', 'chat_id': 'chat', 'value_id': 'raw', 'attempts': 1}
+
+UPPER = {'id': 'upper', 'external_url': 'http://upper', 'name': 'Upper'}
+REVERSE = {'id': 'reverse', 'external_url': 'http://reverse', 'name': 'Reverse'}
+
+
+def connection():
+    return FakeConnection([
+        ("r.table('chats')", {'default_filter_ids': ['upper']}),
+        ("r.table('values').get(", {'id': 'raw', 'content': 'hello', 'type': 'text'}),
+        ("r.expr(['upper'])", [UPPER]),
+        ("r.table('users')", [{'id': 'alice', 'default_filter_ids': ['reverse']},
+                              {'id': 'bob', 'default_filter_ids': []}]),
+        ("r.table('filters').get_all", [REVERSE]),
+    ])
+
+
+def process(monkeypatch) -> dict:
+    # What a run of the job writes, as the helpers it writes with see it
+    written = {}
+    monkeypatch.setattr(jobs, 'apply_chain', lambda conn, chain, value, type: (
+        value.upper(), type, [f.id for f in chain], []))
+    monkeypatch.setattr(jobs, 'apply_many', lambda conn, filters, value, type: (
+        [{'content': value[::-1], 'type': type} for f in filters], []))
+
+    def append_overlays(overlays):
+        written['overlays'] = overlays
+        return r.expr(None)
+    monkeypatch.setattr(jobs, 'append_overlays', append_overlays)
+    monkeypatch.setattr(jobs, 'record_filtered_values', lambda conn, chat_id, message_id, values:
+                        written.update(last_values=values))
+    conn = connection()
+    jobs.process(conn, JOB)
+    written['queries'] = [normalized(query) for query in conn.writes]
+    return written
+
+
+def test_process_twice_writes_the_same(monkeypatch):
+    first, retry = process(monkeypatch), process(monkeypatch)
+    # Value ids derive from the message, a retry finds the first attempt's
+    assert retry == first
+
+
+def test_values_go_to_the_message_and_overlays(monkeypatch):
+    written = process(monkeypatch)
+    reversed_id = idempotent_id('reverse', 'message')
+    # Only alice has a default filter of her own
+    assert written['overlays'] == [{
+        'id': delivery_id('message', 'alice'),
+        'message_id': 'message',
+        'receiver_id': 'alice',
+        'value_ids': [reversed_id],
+        'filter_ids': ['reverse']
+    }]
+    assert written['last_values'] == {
+        'alice': {'id': reversed_id, 'content': 'OLLEH', 'type': 'text'},
+        'bob': {'content': 'HELLO', 'type': 'text'}
+    }
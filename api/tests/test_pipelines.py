@@ -0,0 +1,130 @@
+import pytest
+
+from api import models
+from api.filtering import FilterError, FilterExecutor
+from api.pipelines import (PLANS,
+                           PipelineError,
+                           _flatten,
+                           apply_chain,
+                           apply_many,
+                           build_tree,
+                           compile_filters)
+from tests.fakes import FakeConnection
+
+
+def make_filter(id, input_type='text', output_type='text', filter_ids=None):
+    return models.Filter(external_url=f'http://{id}', id=id, name=id,
+                         input_type=input_type, output_type=output_type,
+                         is_pipeline=filter_ids is not None, filter_ids=filter_ids or [])
+
+
+A, B, C = make_filter('a'), make_filter('b'), make_filter('c')
+CAPTION = make_filter('caption', 'image', 'text')
+INNER = make_filter('inner', filter_ids=['a', 'b'])
+OUTER = make_filter('outer', filter_ids=['inner', 'c'])
+FILTERS = {f.id: f for f in (A, B, C, CAPTION, INNER, OUTER)}
+
+
+class Executor(FilterExecutor):
+    # Appends the filter id to the value instead of calling the service
+    def __init__(self, failing=()):
+        super().__init__(workers=4)
+        self.failing = failing
+        self.calls = []
+
+    def run(self, f, value, deadline=None, cache=True):
+        self.calls.append(f.id)
+        if f.id in self.failing:
+            raise FilterError(f, 'failed')
+        return f'{value}|{f.id}'
+
+
+@pytest.fixture(autouse=True)
+def clear_plans():
+    PLANS.clear()
+
+
+def test_flatten_nested_pipelines():
+    assert _flatten(OUTER, FILTERS, ()) == [A, B, C]
+    assert _flatten(A, FILTERS, ()) == [A]
+
+
+def test_flatten_rejects_cycles():
+    loop = make_filter('loop', filter_ids=['again'])
+    again = make_filter('again', filter_ids=['loop'])
+    with pytest.raises(PipelineError, match='contains itself'):
+        _flatten(loop, {'loop': loop, 'again': again}, ())
+
+
+def test_flatten_checks_types():
+    mismatched = make_filter('mismatched', filter_ids=['a', 'caption'])
+    with pytest.raises(PipelineError, match='a outputs text, caption takes image'):
+        _flatten(mismatched, FILTERS, ())
+    wrong_output = make_filter('wrong_output', 'text', 'image', filter_ids=['a'])
+    with pytest.raises(PipelineError, match='not text and image'):
+        _flatten(wrong_output, FILTERS, ())
+
+
+def test_flatten_rejects_unknown_and_empty():
+    with pytest.raises(PipelineError, match='unknown filter missing'):
+        _flatten(make_filter('p', filter_ids=['a', 'missing']), FILTERS, ())
+    empty = make_filter('empty', filter_ids=[])
+    empty.is_pipeline = True
+    with pytest.raises(PipelineError, match='has no stages'):
+        _flatten(empty, FILTERS, ())
+
+
+def test_compile_filters_loads_nested_and_caches():
+    conn = FakeConnection([("r.table('filters').get_all", [vars(INNER), vars(A), vars(B), vars(C)])])
+    plans = compile_filters(conn, [OUTER, A])
+    assert plans == {'outer': (A, B, C), 'a': (A,)}
+
+    cached = FakeConnection([])
+    assert compile_filters(cached, [OUTER]) == {'outer': (A, B, C)}
+    assert cached.writes == []
+
+
+def test_compile_filters_keeps_errors():
+    broken = make_filter('broken', filter_ids=['a', 'caption'])
+    plans = compile_filters(FakeConnection([("r.table('filters').get_all", [vars(A), vars(CAPTION)])]),
+                            [broken])
+    assert isinstance(plans['broken'], PipelineError)
+
+
+def test_build_tree_shares_prefixes():
+    root = build_tree({'outer': (A, B, C), 'inner': (A, B), 'a': (A,), 'c': (C,)})
+    assert sorted(root.children) == ['a', 'c']
+    a = root.children['a']
+    assert a.targets == ['a']
+    assert a.children['b'].targets == ['inner']
+    assert a.children['b'].children['c'].targets == ['outer']
+    assert sorted(root.subtree_targets()) == ['a', 'c', 'inner', 'outer']
+
+
+def test_apply_many_runs_shared_stages_once():
+    PLANS.put(('inner', ('a', 'b')), (A, B))
+    PLANS.put(('outer', ('inner', 'c')), (A, B, C))
+    executor = Executor()
+    results, timings = apply_many(FakeConnection([]), [OUTER, INNER, C], 'v', 'text', executor)
+    assert results == [{'content': 'v|a|b|c', 'type': 'text'},
+                       {'content': 'v|a|b', 'type': 'text'},
+                       {'content': 'v|c', 'type': 'text'}]
+    assert sorted(executor.calls) == ['a', 'b', 'c', 'c']
+    assert len(timings) == 4
+
+
+def test_apply_many_fails_the_targets_after_a_failed_stage():
+    PLANS.put(('inner', ('a', 'b')), (A, B))
+    PLANS.put(('outer', ('inner', 'c')), (A, B, C))
+    results, _ = apply_many(FakeConnection([]), [OUTER, INNER, C, CAPTION], 'v', 'text',
+                            Executor(failing=['b']))
+    assert isinstance(results[0], FilterError) and isinstance(results[1], FilterError)
+    assert results[2] == {'content': 'v|c', 'type': 'text'}
+    assert isinstance(results[3], FilterError)
+
+
+def test_apply_chain_skips_failed_links():
+    PLANS.put(('inner', ('a', 'b')), (A, B))
+    value, type, applied, _ = apply_chain(FakeConnection([]), [INNER, C, CAPTION], 'v', 'text',
+                                          Executor(failing=['c']))
+    assert (value, type, applied) == ('v|a|b', 'text', ['inner'])
@@ -0,0 +1,70 @@
+from api.search import UserSearchIndex, normalize, user_terms
+
+USERS = [
+    {'id': '1', 'username': 'ann', 'name': 'Ann Smith'},
+    {'id': '2', 'username': 'annabel', 'name': 'Annabel Lee'},
+    {'id': '3', 'username': 'bob', 'name': 'Bob Annandale'},
+    {'id': '4', 'username': 'joanna', 'name': 'Jo Anna'},
+    {'id': '5', 'username': 'carl', 'name': None},
+]
+
+
+def index(users=USERS) -> UserSearchIndex:
+    search_index = UserSearchIndex()
+    search_index.build(users)
+    return search_index
+
+
+def ids(users) -> list:
+    return [user['id'] for user in users]
+
+
+def test_terms():
+    assert normalize('  Ann   SMITH ') == 'ann smith'
+    assert sorted(user_terms(USERS[0])) == [('ann', False), ('ann', True),
+                                            ('ann smith', True), ('smith', True)]
+    assert user_terms(USERS[4]) == [('carl', False)]
+
+
+def test_exact_username_then_prefixes_then_infixes():
+    # ann exactly, annabel by username, then names in term order: anna of
+    # joanna before annandale of bob
+    assert ids(index().search('Ann')) == ['1', '2', '4', '3']
+    # Only in the middle of a term
+    assert ids(index().search('nna')) == ['2', '3', '4']
+
+
+def test_short_queries_match_prefixes_only():
+    assert ids(index().search('an')) == ['1', '2', '4', '3']
+    assert ids(index().search('nn')) == []
+    assert index().search('   ') == []
+
+
+def test_limit():
+    assert ids(index().search('ann', limit=2)) == ['1', '2']
+
+
+def test_results_have_public_fields_only():
+    search_index = index([dict(USERS[0], password='secret')])
+    assert search_index.search('ann') == [{'id': '1', 'username': 'ann', 'name': 'Ann Smith',
+                                           'avatar': None}]
+
+
+def test_changes():
+    search_index = index()
+    search_index.remove('1')
+    search_index.add({'id': '2', 'username': 'belle', 'name': 'Belle'})
+    search_index.add({'id': '6', 'username': 'annie', 'name': 'Annie'})
+    assert len(search_index) == 5
+    assert ids(search_index.search('ann')) == ['6', '4', '3']
+    assert ids(search_index.search('bel')) == ['2']
+    assert search_index.search('smith') == []
+
+
+def test_updates_replace_trigrams():
+    search_index = index()
+    for name in ('Ann Smith', 'Ann Jones', 'Ann Smith'):
+        search_index.add({'id': '1', 'username': 'ann', 'name': name})
+    assert list(search_index._trigrams['mit']).count(0) == 1
+    assert 'jon' not in search_index._trigrams
+    assert ids(search_index.search('mith')) == ['1']
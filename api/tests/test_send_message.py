@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+
+from flask_jwt_extended import create_access_token
+
+from api.apis.v1_0 import chats
+from tests.fakes import FakeConnection
+
+CHAT = {'id': 'chat', 'name': 'Chat', 'user_ids': ['sender', 'receiver'], 'default_filter_ids': ['filter']}
+
+
+def test_summaries_are_recorded_before_the_job_is_queued(app, monkeypatch):
+    conn = FakeConnection([
+        ("r.table('chats').get('chat').do(", {
+            'chat': CHAT,
+            'participants': [{'id': user_id, 'name': user_id, 'default_filter_ids': []}
+                             for user_id in CHAT['user_ids']],
+            'value': {'generated_keys': ['value']}
+        }),
+        ("r.table('messages').insert(", {'inserted': 2, 'unchanged': 0}),
+    ])
+    calls = []
+    monkeypatch.setattr(chats.ACCESS, 'chat_membership', lambda chat_id, user_id: True)
+    monkeypatch.setattr(chats, 'db_connection', contextmanager(lambda: iter([conn])))
+    monkeypatch.setattr(chats, 'record_message', lambda *args: calls.append('record_message'))
+    monkeypatch.setattr(chats, 'enqueue', lambda *args: calls.append('enqueue'))
+    with app.test_request_context():
+        token = create_access_token('sender')
+    response = app.test_client().post(
+        '/api/v1.0/chats/chat/messages',
+        headers={'Authorization': f'Bearer {token}'},
+        json={'type': 'text', 'value': 'Hello'})
+    assert response.status_code == 200
+    assert calls == ['record_message', 'enqueue']
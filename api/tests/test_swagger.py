@@ -0,0 +1,57 @@
+import json
+import sys
+
+import pytest
+
+from api import swagger
+
+
+def test_schema_renders():
+    schema = swagger.build_schema()
+    assert 'error' not in schema
+    assert len(schema['paths']) == 17
+    assert 'Last Message' in schema['definitions']
+
+
+def test_committed_schema_is_current():
+    with open(swagger.DEFAULT_SCHEMA_FILE) as f:
+        committed = json.load(f)
+    assert committed == json.loads(json.dumps(swagger.build_schema())), \
+        'run python -m api.swagger and commit swagger_docs/v1.0.json'
+
+
+def test_load_schema(tmp_path):
+    class Api(object):
+        _schema = None
+
+    path = tmp_path / 'v1.0.json'
+    path.write_text(json.dumps({'error': 'Unable to render schema'}))
+    api = Api()
+    assert not swagger.load_schema(api, str(path))
+    assert not swagger.load_schema(api, str(tmp_path / 'missing.json'))
+    assert api._schema is None
+    path.write_text(json.dumps({'paths': {}}))
+    assert swagger.load_schema(api, str(path))
+    assert api._schema == {'paths': {}}
+
+
+def fail():
+    raise RuntimeError('Unable to render schema')
+
+
+def test_failed_build_fails(tmp_path, monkeypatch):
+    output = tmp_path / 'v1.0.json'
+    output.write_text('{}')
+    monkeypatch.setattr(swagger, 'build_schema', fail)
+    monkeypatch.setattr(sys, 'argv', ['api.swagger', '--output', str(output)])
+    with pytest.raises(RuntimeError):
+        swagger.main()
+    assert output.read_text() == '{}'
+
+
+def test_optional_build_writes_nothing(tmp_path, monkeypatch):
+    output = tmp_path / 'swagger.json'
+    monkeypatch.setattr(swagger, 'build_schema', fail)
+    monkeypatch.setattr(sys, 'argv', ['api.swagger', '--optional', '--output', str(output)])
+    swagger.main()
+    assert not output.exists()